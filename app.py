@@ -1,19 +1,46 @@
 import os
+import sys
+import io
 import requests
 import json
 import re
 from flask import Flask, request
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import httpx
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+from google.auth.transport import requests as google_auth_requests
 from datetime import datetime
 import time
+import threading
+import asyncio
+import contextvars
+import zlib
+import hashlib
+import hmac
+import atexit
+import sqlite3
+import mmap
+import struct
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # no flock (Windows): every process reads Sheets itself
+    fcntl = None
+
+try:
+    import redis
+except ImportError:  # only needed for USER_STATE_BACKEND=redis
+    redis = None
 
 app = Flask(__name__)
 
 # Environment Variables
 VERIFY_TOKEN = os.environ.get("VERIFY_TOKEN")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")  # /metrics is off unless this is set
 GRAPH_API_VERSION = os.environ.get("GRAPH_API_VERSION", "v24.0")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 GOOGLE_SHEETS_CREDS = os.environ.get("GOOGLE_SHEETS_CREDS")
@@ -36,6 +63,8 @@ if PAGE_ID_2 and PAGE_ACCESS_TOKEN_2:
 if PAGE_ID_3 and PAGE_ACCESS_TOKEN_3:
     PAGE_MAP[PAGE_ID_3] = PAGE_ACCESS_TOKEN_3
 
+PAGE_ID_BY_TOKEN = {token: page_id for page_id, token in PAGE_MAP.items()}
+
 # Initialize OpenAI with timeout and retry settings
 client = OpenAI(
     api_key=OPENAI_API_KEY,
@@ -43,1050 +72,2542 @@ client = OpenAI(
     max_retries=2
 )
 
-# User conversation state tracking
-user_states = {}
+# Same settings for the ASGI path (see asgi_app)
+async_client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    timeout=httpx.Timeout(30.0, connect=10.0),
+    max_retries=2
+)
+
+LLM_MODEL = "gpt-4o-mini"
+
+# =====================
+# BACKGROUND EVENT QUEUE
+# =====================
+# Events run in per-sender lanes: one sender's events are handled one at a time,
+# in the order Meta delivered them, while different senders run in parallel on a
+# shared pool. A striped flock keeps one sender's turns from overlapping across
+# gunicorn workers too.
+#
+# Customers often split one question over several quick messages ("hi" /
+# "racks thiyanawada" / "price?"). Text messages are buffered per sender until
+# they go quiet for MESSAGE_COALESCE_WINDOW seconds (typing indicator on
+# meanwhile) and then answered as one turn. The lane waits for that on the
+# timer wheel, so a buffering sender does not hold an event worker.
+
+EVENT_WORKERS = int(os.environ.get("EVENT_WORKERS", 4))
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", 200))  # per worker
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", 25))  # whole drain; keep below gunicorn's graceful_timeout
+SENDER_LOCK_DIR = os.environ.get("SENDER_LOCK_DIR", "sender_locks")  # "" disables cross-process locking
+SENDER_LOCK_STRIPES = int(os.environ.get("SENDER_LOCK_STRIPES", 256))
+SENDER_LOCK_RETRY = 0.05  # seconds between attempts while another worker holds a sender
+MESSAGE_COALESCE_WINDOW = float(os.environ.get("MESSAGE_COALESCE_WINDOW", 1.5))  # seconds, 0 = off
+MESSAGE_COALESCE_MAX_WAIT = float(os.environ.get("MESSAGE_COALESCE_MAX_WAIT", 6))  # answer a chatty sender anyway
+TIMER_TICK = float(os.environ.get("TIMER_TICK", 0.05))  # timer wheel resolution, seconds
+TIMER_WHEEL_SLOTS = int(os.environ.get("TIMER_WHEEL_SLOTS", 512))
+
+event_workers_lock = threading.Lock()
+event_workers_state = {"executor": None, "accepting": True}
+event_stats = {
+    "enqueued": 0,
+    "processed": 0,
+    "failed": 0,
+    "rejected": 0,
+    "coalesced": 0,
+    "max_queue_depth": 0,
+    "max_wait": 0.0,
+    "last_wait": 0.0,
+    "max_lock_wait": 0.0,
+    "lock_retries": 0,
+}
+event_stats_lock = threading.Lock()
+timer_wheel_lock = threading.Lock()
+timer_wheel_state = {"wheel": None}
+
+
+class KeyedExecutor:
+    """Worker threads that run calls one at a time per key, in submission order.
+
+    Each key with work has a lane (a deque); one worker drains a lane and
+    gives it up once it is empty, so a busy sender never holds up another
+    sender's events the way a shared shard queue would.
+
+    A call may return a number of seconds to be called again after that long.
+    Its lane stays blocked meanwhile but the worker is freed; the timer wheel
+    puts the lane back in the ready queue.
+    """
+
+    def __init__(self, max_workers, max_pending, name="event-worker"):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._lanes = {}
+        self._ready = deque()  # keys whose lane is waiting for a worker
+        self._pending = 0
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        # Own threads rather than a ThreadPoolExecutor: those refuse new work
+        # once the interpreter starts exiting, which is when atexit drains us
+        self._threads = [threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True) for i in range(max_workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, key, fn, *args):
+        """Queue fn(*args) behind key's earlier calls. Returns False when full."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+            lane = self._lanes.get(key)
+            if lane is not None:
+                lane.append((fn, args))
+                return True
+            self._lanes[key] = deque([(fn, args)])
+            self._make_ready(key)
+        return True
+
+    def _make_ready(self, key):
+        self._ready.append(key)
+        self._work.notify()
+
+    def _resume(self, key):
+        with self._lock:
+            self._make_ready(key)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._ready and not self._stopped:
+                    self._work.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+            self._drain(key)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                lane = self._lanes[key]
+                if not lane:
+                    del self._lanes[key]
+                    return
+                fn, args = lane.popleft()
+
+            retry_in = None
+            try:
+                retry_in = fn(*args)
+            except Exception as e:
+                print(f"Error in event lane {key}: {e}", flush=True)
+
+            with self._lock:
+                if isinstance(retry_in, (int, float)) and retry_in > 0:
+                    lane.appendleft((fn, args))
+                else:
+                    self._pending -= 1
+                    if not self._pending:
+                        self._idle.notify_all()
+                    continue
+
+            get_timer_wheel().schedule(time.monotonic() + retry_in, lambda: self._resume(key))
+            return
+
+    def join(self, timeout):
+        """Wait until nothing is queued or running. Returns False on timeout."""
+        deadline = time.time() + timeout
+        with self._lock:
+            while self._pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def shutdown(self):
+        """Let the workers exit once the ready queue is empty"""
+        with self._lock:
+            self._stopped = True
+            self._work.notify_all()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def lanes(self):
+        return len(self._lanes)
+
+
+class TimerWheel:
+    """Hashed timer wheel. schedule() is O(1); one thread advances a tick at a
+    time and runs due callbacks in due order (FIFO within a tick). The thread
+    only ticks while something is scheduled, and callbacks must be quick."""
+
+    def __init__(self, tick, slots, name="timer-wheel"):
+        self.tick = tick
+        self._slots = [deque() for _ in range(slots)]
+        self._origin = time.monotonic()
+        self._current = 0
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _now_tick(self):
+        return int((time.monotonic() - self._origin) / self.tick)
+
+    def schedule(self, due, callback):
+        """Run callback() at monotonic time `due` (rounded up to the next tick)"""
+        tick = -int(-(due - self._origin) // self.tick)
+        with self._cond:
+            if not self._pending:
+                # Idle wheel: skip the ticks that passed while nothing was scheduled
+                self._current = max(self._current, self._now_tick())
+            tick = max(tick, self._current + 1)
+            self._slots[tick % len(self._slots)].append((tick, callback))
+            self._pending += 1
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._pending:
+                        self._cond.wait()
+                        continue
+                    now_tick = self._now_tick()
+                    if now_tick > self._current:
+                        break
+                    self._cond.wait(self._origin + (self._current + 1) * self.tick - time.monotonic())
+
+                due = []
+                while self._current < now_tick and self._pending:
+                    self._current += 1
+                    slot = self._slots[self._current % len(self._slots)]
+                    for _ in range(len(slot)):
+                        entry = slot.popleft()
+                        if entry[0] <= self._current:
+                            due.append(entry[1])
+                        else:
+                            slot.append(entry)  # a later lap around the wheel
+                self._pending -= len(due)
+
+            for callback in due:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"Error firing timer: {e}", flush=True)
+
+    @property
+    def pending(self):
+        return self._pending
+
+
+def get_timer_wheel():
+    """One wheel per process, started on first use (after gunicorn forks)"""
+    with timer_wheel_lock:
+        if timer_wheel_state["wheel"] is None:
+            timer_wheel_state["wheel"] = TimerWheel(TIMER_TICK, TIMER_WHEEL_SLOTS)
+        return timer_wheel_state["wheel"]
+
+
+class MessageBurst:
+    """Text messages one sender sent in quick succession, answered as one turn"""
+
+    __slots__ = ("events", "first_at", "last_at", "closed", "typing")
+
+    def __init__(self, event):
+        self.events = [event]
+        self.first_at = self.last_at = time.time()
+        self.closed = False
+        self.typing = False
+
+    def merged_event(self):
+        """The latest event, carrying every text of the burst"""
+        if len(self.events) == 1:
+            return self.events[0]
+        event = dict(self.events[-1])
+        event["message"] = dict(event["message"], text="\n".join(e["message"]["text"] for e in self.events))
+        return event
+
+
+open_bursts = {}  # lane key -> burst still taking messages
+open_bursts_lock = threading.Lock()
+
+
+def get_lane_key(page_token, event):
+    return (PAGE_ID_BY_TOKEN.get(page_token, ""), str(event["sender"]["id"]))
+
+
+def can_coalesce(event):
+    return MESSAGE_COALESCE_WINDOW > 0 and "referral" not in event and bool(event.get("message", {}).get("text"))
+
+
+def join_burst(lane_key, event):
+    """Add a text event to the sender's open burst. Returns a new burst to schedule,
+    or None when the event was folded into one that has not been answered yet."""
+    with open_bursts_lock:
+        burst = open_bursts.get(lane_key)
+        if burst is not None and not burst.closed:
+            burst.events.append(event)
+            burst.last_at = time.time()
+            with event_stats_lock:
+                event_stats["coalesced"] += 1
+            return None
+        burst = open_bursts[lane_key] = MessageBurst(event)
+        return burst
+
+
+def burst_quiet_for(burst):
+    """Seconds left until the sender has been quiet for MESSAGE_COALESCE_WINDOW
+    (or the burst has been open for MESSAGE_COALESCE_MAX_WAIT)"""
+    return min(burst.last_at + MESSAGE_COALESCE_WINDOW, burst.first_at + MESSAGE_COALESCE_MAX_WAIT) - time.time()
+
+
+def close_burst(lane_key, burst):
+    with open_bursts_lock:
+        burst.closed = True
+        if open_bursts.get(lane_key) is burst:
+            del open_bursts[lane_key]
+    return burst.merged_event()
+
+
+def acquire_sender_lock(lane_key):
+    """Try to take the flock stripe for this sender. Returns an fd for release_sender_lock,
+    None when cross-process locking is off, or False if another turn holds it.
+
+    Callers wait by retrying rather than blocking in flock: the holder may be
+    waiting for the very threads a blocked caller would tie up."""
+    if not SENDER_LOCK_DIR or fcntl is None:
+        return None
+
+    stripe = zlib.crc32(repr(lane_key).encode()) % SENDER_LOCK_STRIPES
+    try:
+        os.makedirs(SENDER_LOCK_DIR, exist_ok=True)
+        fd = os.open(os.path.join(SENDER_LOCK_DIR, f"{stripe}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        print(f"⚠️ Sender lock unavailable: {e}", flush=True)
+        return None
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    except OSError as e:
+        os.close(fd)
+        print(f"⚠️ Sender lock failed: {e}", flush=True)
+        return None
+
+    # Another worker may have answered this sender a moment ago
+    user_states.expire(lane_key[1])
+    return fd
+
+
+async def acquire_sender_lock_async(lane_key):
+    """acquire_sender_lock for the event loop"""
+    started = time.time()
+    while (fd := acquire_sender_lock(lane_key)) is False:
+        await asyncio.sleep(0.01)
+    record_lock_wait(time.time() - started)
+    return fd
+
+
+def record_lock_wait(waited):
+    with event_stats_lock:
+        event_stats["max_lock_wait"] = max(event_stats["max_lock_wait"], waited)
+
+
+def release_sender_lock(fd):
+    if fd is None:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def start_event_workers():
+    """Create the executor lazily so each gunicorn worker process owns its own pool"""
+    with event_workers_lock:
+        if event_workers_state["executor"] is None:
+            event_workers_state["executor"] = KeyedExecutor(EVENT_WORKERS, EVENT_QUEUE_SIZE * EVENT_WORKERS)
+            print(f"🧵 Started {EVENT_WORKERS} event workers", flush=True)
+        return event_workers_state["executor"]
+
+
+def enqueue_event(page_token, event):
+    """Queue a messaging event in its sender's lane"""
+    if not event_workers_state["accepting"]:
+        return False
+
+    executor = start_event_workers()
+    lane_key = get_lane_key(page_token, event)
+
+    if can_coalesce(event):
+        burst = join_burst(lane_key, event)
+        if burst is None:
+            return True
+        queued = executor.submit(lane_key, run_burst, page_token, lane_key, burst, time.time())
+        if not queued:
+            close_burst(lane_key, burst)
+    else:
+        queued = executor.submit(lane_key, run_event, page_token, lane_key, event, time.time())
+
+    if not queued:
+        with event_stats_lock:
+            event_stats["rejected"] += 1
+        print(f"⚠️ Event queue full, rejecting event from {lane_key[1]}", flush=True)
+        return False
+
+    with event_stats_lock:
+        event_stats["enqueued"] += 1
+        event_stats["max_queue_depth"] = max(event_stats["max_queue_depth"], executor.pending)
+    return True
+
+
+def run_burst(page_token, lane_key, burst, enqueued_at):
+    """Answer everything the sender sent in one turn once they pause. Until then
+    return the time left, so the lane waits on the timer wheel, not a thread."""
+    remaining = burst_quiet_for(burst)
+    if remaining > 0:
+        if not burst.typing:
+            burst.typing = True
+            send_sender_action(lane_key[1], "typing_on", page_token)
+        return remaining
+    # The indicator is already showing if we waited for the sender to pause
+    return run_event(page_token, lane_key, close_burst(lane_key, burst), enqueued_at, typing=not burst.typing)
+
+
+def run_event(page_token, lane_key, event, enqueued_at, typing=True):
+    """Process one event under the sender's cross-process lock. While another
+    worker holds it, return a retry delay so the lane waits on the timer wheel."""
+    lock_fd = acquire_sender_lock(lane_key)
+    if lock_fd is False:
+        with event_stats_lock:
+            event_stats["lock_retries"] += 1
+        return SENDER_LOCK_RETRY
+
+    wait = time.time() - enqueued_at
+    with event_stats_lock:
+        event_stats["last_wait"] = wait
+        event_stats["max_wait"] = max(event_stats["max_wait"], wait)
+
+    try:
+        process_event(page_token, event, typing)
+        with event_stats_lock:
+            event_stats["processed"] += 1
+    except Exception as e:
+        with event_stats_lock:
+            event_stats["failed"] += 1
+        print(f"Error processing event: {e}", flush=True)
+    finally:
+        # Replies go out on the outbound scheduler after we return. Release the
+        # lock from the same recipient lane, behind them, so another worker's next
+        # turn for this sender cannot deliver its replies in between.
+        if lock_fd is not None and not schedule_outbound(lane_key[1], page_token, 0, release_sender_lock, lock_fd):
+            release_sender_lock(lock_fd)
+
+
+def shutdown_event_workers(deadline):
+    """Stop accepting events and let the workers finish what is already queued"""
+    event_workers_state["accepting"] = False
+    with event_workers_lock:
+        executor = event_workers_state["executor"]
+        event_workers_state["executor"] = None
+    if executor is None:
+        return
+
+    print(f"🛑 Draining {executor.pending} queued events", flush=True)
+    if executor.join(deadline - time.time()):
+        print("✅ Event workers drained", flush=True)
+    else:
+        print(f"⚠️ {executor.pending} events still pending after drain timeout", flush=True)
+    executor.shutdown()
+
+
+def get_event_queue_stats():
+    """Backpressure metrics for the event queue"""
+    with event_stats_lock:
+        stats = dict(event_stats)
+    executor = event_workers_state["executor"]
+    stats["pending"] = executor.pending if executor else 0
+    stats["lanes"] = executor.lanes if executor else 0
+    stats["queue_capacity"] = EVENT_QUEUE_SIZE * EVENT_WORKERS
+    stats["workers"] = EVENT_WORKERS if executor else 0
+    stats["open_bursts"] = len(open_bursts)
+    stats["coalesce_window"] = MESSAGE_COALESCE_WINDOW
+    stats["coalesce_max_wait"] = MESSAGE_COALESCE_MAX_WAIT
+    stats["accepting"] = event_workers_state["accepting"]
+    return stats
+
+
+# =====================
+# OUTBOUND SCHEDULER
+# =====================
+# Replies are handed to the scheduler and the caller moves on; Graph calls
+# (including rate-limit waits and retries) run on outbound workers instead of
+# the event worker that produced them. Delayed replies sit in a timer wheel
+# rather than a sleeping thread. Everything for one recipient is delivered in
+# the order it was scheduled.
+
+OUTBOUND_WORKERS = int(os.environ.get("OUTBOUND_WORKERS", 4))
+OUTBOUND_QUEUE_SIZE = int(os.environ.get("OUTBOUND_QUEUE_SIZE", 2000))
+FOLLOW_UP_DELAY = float(os.environ.get("FOLLOW_UP_DELAY", 1.0))  # gap before "Order kamathi dha?"
+
+outbound_lock = threading.Lock()
+outbound_state = {"scheduler": None, "stopped": False}
+
+
+class OutboundScheduler:
+    """Delivers send calls per recipient, in order, after an optional delay"""
+
+    def __init__(self):
+        self.executor = KeyedExecutor(OUTBOUND_WORKERS, OUTBOUND_QUEUE_SIZE, name="outbound")
+        self.wheel = get_timer_wheel()
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._waiting = {}  # recipient key -> [latest due time, calls in the wheel]
+        self.stats = {"scheduled": 0, "delayed": 0, "dropped": 0}
+
+    def schedule(self, key, delay, fn, *args):
+        """Run fn(*args) for this recipient after `delay` seconds and after
+        everything scheduled for it before. Returns False if dropped."""
+        due = time.monotonic() + delay
+        with self._lock:
+            self.stats["scheduled"] += 1
+            waiting = self._waiting.get(key)
+            if waiting is None and delay <= 0:
+                return self._submit(key, fn, args)
+
+            # Never overtake an earlier delayed call for the same recipient
+            if waiting is None:
+                waiting = self._waiting[key] = [due, 0]
+            waiting[0] = max(waiting[0], due)
+            waiting[1] += 1
+            self.stats["delayed"] += 1
+            self.wheel.schedule(waiting[0], lambda: self._release(key, fn, args))
+            return True
+
+    def _release(self, key, fn, args):
+        with self._lock:
+            waiting = self._waiting[key]
+            waiting[1] -= 1
+            if not waiting[1]:
+                del self._waiting[key]
+                if not self._waiting:
+                    self._released.notify_all()
+            # Still under the lock, so a new undelayed call cannot get in first
+            self._submit(key, fn, args)
+
+    def _submit(self, key, fn, args):
+        if self.executor.submit(key, fn, *args):
+            return True
+        self.stats["dropped"] += 1
+        print(f"⚠️ Outbound queue full, dropping {fn.__name__} for {key[1]}", flush=True)
+        return False
+
+    def drain(self, deadline):
+        """Wait for delayed and queued sends. Returns False if `deadline` passes first."""
+        with self._lock:
+            while self._waiting:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._released.wait(remaining)
+        return self.executor.join(deadline - time.time())
+
+    @property
+    def delayed(self):
+        """Calls still waiting in the timer wheel"""
+        with self._lock:
+            return sum(waiting[1] for waiting in self._waiting.values())
+
+
+def get_outbound_scheduler():
+    """Create the scheduler lazily so each gunicorn worker process owns its threads"""
+    with outbound_lock:
+        if outbound_state["scheduler"] is None:
+            outbound_state["scheduler"] = OutboundScheduler()
+        return outbound_state["scheduler"]
+
+
+def schedule_outbound(recipient_id, page_token, delay, fn, *args):
+    """Queue fn(*args) on the recipient's outbound lane. Once the scheduler has shut
+    down nothing would drain a new one, so immediate calls run inline and delayed
+    ones are dropped (returns False)."""
+    if outbound_state["stopped"]:
+        if delay > 0:
+            print(f"⚠️ Outbound scheduler stopped, dropping delayed {fn.__name__} for {recipient_id}", flush=True)
+            return False
+        fn(*args)
+        return True
+
+    key = (PAGE_ID_BY_TOKEN.get(page_token, ""), str(recipient_id))
+    return get_outbound_scheduler().schedule(key, delay, fn, *args)
+
+
+def shutdown_outbound_scheduler(deadline):
+    """Deliver what the drained event workers left scheduled"""
+    with outbound_lock:
+        scheduler = outbound_state["scheduler"]
+    if scheduler is not None:
+        pending = scheduler.delayed + scheduler.executor.pending
+        if pending:
+            print(f"🛑 Delivering {pending} outbound messages", flush=True)
+        # Still installed while draining, so sends queued meanwhile keep their order and get drained too
+        if not scheduler.drain(deadline):
+            print(f"⚠️ {scheduler.delayed + scheduler.executor.pending} outbound messages undelivered after drain timeout", flush=True)
+
+    with outbound_lock:
+        outbound_state["stopped"] = True
+        outbound_state["scheduler"] = None
+    if scheduler is not None:
+        # Workers finish whatever slipped in before the flag flipped, then exit
+        scheduler.executor.shutdown()
+    shutdown_image_uploads()
+
+
+def get_outbound_stats():
+    scheduler = outbound_state["scheduler"]
+    if scheduler is None:
+        return {"started": False}
+    stats = dict(scheduler.stats)
+    stats["started"] = True
+    stats["in_wheel"] = scheduler.delayed
+    stats["queued"] = scheduler.executor.pending
+    stats["recipients"] = scheduler.executor.lanes
+    stats["capacity"] = OUTBOUND_QUEUE_SIZE
+    return stats
+
+# =====================
+# LOCAL DATABASE
+# =====================
+
+BOT_DB_PATH = os.environ.get("BOT_DB_PATH", "bot_data.sqlite3")
+
+# Tables are created on first connection in every process
+DB_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS processed_events (
+        event_key TEXT PRIMARY KEY,
+        seen_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_processed_events_seen_at ON processed_events (seen_at)",
+    """CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id TEXT NOT NULL,
+        ad_id TEXT,
+        created_at TEXT NOT NULL,
+        role TEXT NOT NULL,
+        message TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_sender_created ON messages (sender_id, created_at, id)",
+    """CREATE TABLE IF NOT EXISTS sheet_spool (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        worksheet TEXT NOT NULL,
+        row TEXT NOT NULL,
+        queued_at REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        claimed_at REAL,
+        dead_at REAL
+    )""",
+    """CREATE TABLE IF NOT EXISTS image_attachments (
+        page_id TEXT NOT NULL,
+        image_url TEXT NOT NULL,
+        attachment_id TEXT NOT NULL,
+        uploaded_at REAL NOT NULL,
+        PRIMARY KEY (page_id, image_url)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_states (
+        sender_id TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_user_states_updated_at ON user_states (updated_at)",
+    """CREATE TABLE IF NOT EXISTS ad_attribution (
+        sender_id TEXT PRIMARY KEY,
+        ad_id TEXT NOT NULL,
+        first_seen REAL NOT NULL,
+        last_seen REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS backfill_jobs (
+        name TEXT PRIMARY KEY,
+        started_at REAL NOT NULL,
+        completed_at REAL,
+        rows INTEGER
+    )""",
+]
+
+# Columns added after a table first shipped; "duplicate column" means already applied
+DB_MIGRATIONS = [
+    "ALTER TABLE sheet_spool ADD COLUMN dead_at REAL",
+]
+
+db_local = threading.local()
+
+
+def get_db():
+    """Per-thread SQLite connection (WAL, autocommit) shared by all workers on this host"""
+    conn = getattr(db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(BOT_DB_PATH, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in DB_SCHEMA:
+            conn.execute(statement)
+        for statement in DB_MIGRATIONS:
+            try:
+                conn.execute(statement)
+            except sqlite3.OperationalError:
+                pass
+        db_local.conn = conn
+    return conn
+
 
 # =====================
 # EVENT DEDUPLICATION - NEW!
 # =====================
 
-processed_events = {}
 EVENT_CACHE_TTL = 300  # 5 minutes
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", 20000))
+DEDUP_BACKEND = os.environ.get("DEDUP_BACKEND", "memory")  # memory | sqlite
+
+
+class TTLSet:
+    """Size-bounded set whose members expire after ttl seconds.
+
+    Keys are kept in insertion order, so expired keys are always at the front
+    and eviction only ever pops from there.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """Add key, returning False if it was already present and not expired"""
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            if key in self._items:
+                return False
+            self._items[key] = now
+            if len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def _evict_expired(self, now):
+        while self._items:
+            oldest_key, added_at = next(iter(self._items.items()))
+            if now - added_at < self.ttl:
+                break
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SQLiteTTLSet:
+    """TTLSet stored in the local database so every gunicorn worker shares it"""
+
+    PRUNE_EVERY = 500
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._inserts = 0
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        now = time.time()
+        conn = get_db()
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO processed_events (event_key, seen_at) VALUES (?, ?)",
+            (key, now),
+        )
+        if cur.rowcount == 0:
+            # Present already - only counts as new if the old entry expired
+            cur = conn.execute(
+                "UPDATE processed_events SET seen_at = ? WHERE event_key = ? AND seen_at < ?",
+                (now, key, now - self.ttl),
+            )
+            if cur.rowcount == 0:
+                return False
+
+        with self._lock:
+            self._inserts += 1
+            prune = self._inserts % self.PRUNE_EVERY == 0
+        if prune:
+            self._prune(conn, now)
+        return True
+
+    def discard(self, key):
+        get_db().execute("DELETE FROM processed_events WHERE event_key = ?", (key,))
+
+    def _prune(self, conn, now):
+        conn.execute("DELETE FROM processed_events WHERE seen_at < ?", (now - self.ttl,))
+        conn.execute(
+            """DELETE FROM processed_events WHERE event_key IN (
+                SELECT event_key FROM processed_events ORDER BY seen_at DESC LIMIT -1 OFFSET ?
+            )""",
+            (self.max_entries,),
+        )
+
+    def __len__(self):
+        return get_db().execute("SELECT COUNT(*) FROM processed_events").fetchone()[0]
+
+
+processed_events = TTLSet(EVENT_CACHE_TTL, DEDUP_MAX_ENTRIES)
+shared_processed_events = SQLiteTTLSet(EVENT_CACHE_TTL, DEDUP_MAX_ENTRIES) if DEDUP_BACKEND == "sqlite" else None
+dedup_stats = {"checked": 0, "duplicates": 0}
+
+
+def get_event_key(event):
+    """Stable key for a messaging event, or None if it cannot be deduplicated"""
+    sender_id = event["sender"]["id"]
+    message = event.get("message") or {}
+
+    if message.get("mid"):
+        return f"mid:{message['mid']}"
+    if "referral" in event and event.get("timestamp"):
+        return f"ref:{sender_id}:{event['timestamp']}"
+    return None
+
+
+def mark_event_processed(event_key):
+    """Record an event key, returning False if it was seen within EVENT_CACHE_TTL"""
+    dedup_stats["checked"] += 1
+
+    if not processed_events.add(event_key):
+        dedup_stats["duplicates"] += 1
+        return False
+
+    if shared_processed_events is not None:
+        try:
+            if not shared_processed_events.add(event_key):
+                dedup_stats["duplicates"] += 1
+                return False
+        except sqlite3.Error as e:
+            print(f"Dedup store error: {e}", flush=True)
+
+    return True
+
+
+def unmark_event_processed(event_key):
+    """Forget an event key so a redelivery of it is processed"""
+    processed_events.discard(event_key)
+    if shared_processed_events is not None:
+        try:
+            shared_processed_events.discard(event_key)
+        except sqlite3.Error as e:
+            print(f"Dedup store error: {e}", flush=True)
+
+
+def get_dedup_stats():
+    return {
+        "backend": DEDUP_BACKEND,
+        "checked": dedup_stats["checked"],
+        "duplicates": dedup_stats["duplicates"],
+        "entries": len(processed_events),
+    }
 
 # =====================
 # CACHING SYSTEM
 # =====================
 
+class LRUCache:
+    """Size-bounded mapping whose entries expire after idle_ttl seconds without access.
+
+    Keys are kept in last-access order, so the least recently used and the
+    longest idle entries are both at the front and eviction only pops from there.
+    """
+
+    def __init__(self, max_entries, idle_ttl, sizeof=None):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.sizeof = sizeof
+        self._items = OrderedDict()  # key -> [value, last_access]
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            item = self._items.get(key)
+            if item is None:
+                self.stats["misses"] += 1
+                return default
+            item[1] = now
+            self._items.move_to_end(key)
+            self.stats["hits"] += 1
+            return item[0]
+
+    def peek(self, key, default=None):
+        """Value without touching recency or the hit counters"""
+        item = self._items.get(key)
+        return item[0] if item is not None else default
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            self._items[key] = [value, now]
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return default
+            self.stats["invalidations"] += 1
+            return item[0]
+
+    def _expire(self, now):
+        while self._items:
+            oldest_key, (value, last_access) = next(iter(self._items.items()))
+            if now - last_access < self.idle_ttl:
+                break
+            self._items.popitem(last=False)
+            self.stats["expirations"] += 1
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_stats(self):
+        with self._lock:
+            self._expire(time.time())
+            stats = dict(self.stats)
+            stats["entries"] = len(self._items)
+            values = [item[0] for item in self._items.values()] if self.sizeof else []
+        stats["capacity"] = self.max_entries
+        total = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / total, 3) if total else 0.0
+        if self.sizeof:
+            stats["approx_bytes"] = sum(self.sizeof(value) for value in values)
+        return stats
+
+
 products_cache = {
-    "data": None,
+    "digest": None,
+    "catalog": None,
+    "snapshot": None,
     "timestamp": 0,
     "ttl": 300
 }
 
-conversation_cache = {}
+# A background thread reloads Ad_Products ahead of the TTL; requests never wait on it
+# once the first catalog is loaded (stale-while-revalidate)
+PRODUCTS_REFRESH_INTERVAL = float(os.environ.get("PRODUCTS_REFRESH_INTERVAL", 240))
+PRODUCTS_RETRY_INTERVAL = float(os.environ.get("PRODUCTS_RETRY_INTERVAL", 30))
+
+products_refresh_lock = threading.Lock()
+products_refresher_lock = threading.Lock()
+products_refresher_wakeup = threading.Event()
+products_refresher_state = {"started": False, "stopping": False, "thread": None, "last_attempt": 0.0}
+products_refresh_stats = {"refreshes": 0, "unchanged": 0, "swaps": 0, "errors": 0, "last_duration": 0.0}
+
+# Gunicorn workers share one catalog: whichever worker holds the flock on
+# CATALOG_SNAPSHOT_PATH + ".lock" reads Sheets and publishes a snapshot file,
+# the others mmap it and rebuild when its version changes. Empty path disables.
+CATALOG_SNAPSHOT_PATH = os.environ.get("CATALOG_SNAPSHOT_PATH", "catalog_snapshot.bin")
+CATALOG_SNAPSHOT_POLL_INTERVAL = float(os.environ.get("CATALOG_SNAPSHOT_POLL_INTERVAL", 5))
+CATALOG_SNAPSHOT_MAGIC = b"CATSNAP1"
+CATALOG_SNAPSHOT_HEADER = struct.Struct("<8sQI")  # magic, version, payload length
+
+catalog_snapshot_state = {"lock_fd": None, "leader": False}
+
 CONVERSATION_CACHE_TTL = 60
+CONVERSATION_RING_SIZE = 30
+CONVERSATION_CACHE_SIZE = int(os.environ.get("CONVERSATION_CACHE_SIZE", 2000))
+
+# sender_id -> [deque of recent messages, loaded_at, id of the newest stored message]
+conversation_cache = LRUCache(
+    CONVERSATION_CACHE_SIZE,
+    CONVERSATION_CACHE_TTL,
+    sizeof=lambda cached: sum(len(m["message"]) for m in cached[0]),
+)
 
 
 def get_cached_products():
-    """Get products from cache or fetch if expired"""
-    current_time = time.time()
-    
-    if products_cache["data"] and (current_time - products_cache["timestamp"]) < products_cache["ttl"]:
-        print("✅ Using cached products", flush=True)
-        return products_cache["data"]
-    
-    print("📥 Fetching fresh products from sheet", flush=True)
-    sheet = get_sheet()
-    if not sheet:
-        return None
-    
+    """Current product Catalog. Only the very first call waits for the sheet;
+    after that stale data is served while the refresher revalidates."""
+    start_products_refresher()
+
+    catalog = products_cache["catalog"]
+    if catalog is None:
+        return refresh_products()
+
+    now = time.time()
+    if (now - products_cache["timestamp"]) >= products_cache["ttl"] and \
+            (now - products_refresher_state["last_attempt"]) >= PRODUCTS_RETRY_INTERVAL:
+        # The refresher is behind (e.g. the last reload failed): nudge it, don't block
+        products_refresher_wakeup.set()
+    return catalog
+
+
+def refresh_products():
+    """Single-flight reload of Ad_Products. Returns the (possibly unchanged) Catalog."""
+    cold = products_cache["catalog"] is None
+    # Warm callers never queue behind a reload in flight; cold ones wait for its result
+    if not products_refresh_lock.acquire(blocking=cold):
+        return products_cache["catalog"]
     try:
-        ad_products_sheet = sheet.worksheet("Ad_Products")
-        records = ad_products_sheet.get_all_records()
-        
-        products_cache["data"] = records
-        products_cache["timestamp"] = current_time
-        
-        print(f"✅ Cached {len(records)} product rows", flush=True)
-        return records
+        if cold and products_cache["catalog"] is not None:
+            return products_cache["catalog"]
+        return load_products()
+    finally:
+        products_refresh_lock.release()
+
+
+def load_products():
+    """Leader (or single process) revalidates against Sheets; followers read the shared snapshot"""
+    started = time.time()
+    products_refresher_state["last_attempt"] = started
+    try:
+        if catalog_snapshot_enabled() and not acquire_catalog_leadership():
+            catalog = load_catalog_snapshot()
+            if catalog is not None:
+                return catalog
+            if products_cache["catalog"] is not None:
+                return products_cache["catalog"]
+            # Cold follower and the leader hasn't published yet: read Sheets once ourselves
+
+        return load_products_from_sheet(started)
     except Exception as e:
+        products_refresh_stats["errors"] += 1
         print(f"Error fetching products: {e}", flush=True)
-        return products_cache["data"]
+        return products_cache["catalog"]
+
+
+def load_products_from_sheet(started):
+    """Fetch Ad_Products; swap in a new Catalog only if its rows changed.
+
+    No Drive modifiedTime shortcut: it covers the whole spreadsheet, so every
+    Conversations append would defeat it, and it costs a call just like reading
+    Ad_Products does. The row digest is what decides whether anything changed."""
+    ad_products_sheet = get_worksheet("Ad_Products")
+    if not ad_products_sheet:
+        products_refresh_stats["errors"] += 1
+        return products_cache["catalog"]
+
+    print("📥 Fetching fresh products from sheet", flush=True)
+    records = ad_products_sheet.get_all_records()
+    payload = json.dumps(records, ensure_ascii=False, sort_keys=True).encode()
+    digest = hashlib.sha1(payload).hexdigest()
+
+    catalog_changed = install_catalog(records, digest)
+    if not catalog_changed:
+        products_refresh_stats["unchanged"] += 1
+    products_cache["timestamp"] = started
+    products_refresh_stats["refreshes"] += 1
+    products_refresh_stats["last_duration"] = time.time() - started
+
+    if catalog_snapshot_state["leader"]:
+        if catalog_changed or not os.path.exists(CATALOG_SNAPSHOT_PATH):
+            write_catalog_snapshot(payload)
+        else:
+            touch_catalog_snapshot()
+
+    print(f"✅ Cached {len(records)} product rows ({len(products_cache['catalog'].products)} products)", flush=True)
+    return products_cache["catalog"]
+
+
+def install_catalog(records, digest):
+    """Swap in a Catalog for these rows unless they're what we already serve. Returns True on swap."""
+    if digest == products_cache["digest"] and products_cache["catalog"] is not None:
+        return False
+
+    # Build fully, then publish with a single assignment; readers see old or new, never partial
+    catalog = Catalog(records)
+    products_cache["catalog"] = catalog
+    products_cache["digest"] = digest
+    products_refresh_stats["swaps"] += 1
+
+    # Cached replies may quote names/prices that just changed
+    response_cache.clear()
+    # One worker uploads for everyone; the rest find its ids in image_attachments
+    if catalog_snapshot_state["leader"] or not catalog_snapshot_enabled():
+        start_attachment_prewarm(catalog.image_urls)
+    return True
+
+
+def catalog_snapshot_enabled():
+    return bool(CATALOG_SNAPSHOT_PATH) and fcntl is not None
+
+
+def acquire_catalog_leadership():
+    """Non-blocking flock; held for the life of the process, so it frees itself if the leader dies"""
+    if catalog_snapshot_state["leader"]:
+        return True
+
+    fd = catalog_snapshot_state["lock_fd"]
+    try:
+        if fd is None:
+            fd = os.open(CATALOG_SNAPSHOT_PATH + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+            catalog_snapshot_state["lock_fd"] = fd
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+
+    catalog_snapshot_state["leader"] = True
+    print(f"👑 Worker {os.getpid()} is now the catalog leader", flush=True)
+    # Taking over from a dead leader: finish any uploads it left undone
+    if products_cache["catalog"] is not None:
+        start_attachment_prewarm(products_cache["catalog"].image_urls)
+    return True
+
+
+def write_catalog_snapshot(payload):
+    """Publish rows for the other workers: write a temp file, then rename over the old snapshot"""
+    body = zlib.compress(payload)
+    version = time.time_ns()
+    tmp_path = f"{CATALOG_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(CATALOG_SNAPSHOT_HEADER.pack(CATALOG_SNAPSHOT_MAGIC, version, len(body)))
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, CATALOG_SNAPSHOT_PATH)
+        products_cache["snapshot"] = version
+        print(f"📦 Published catalog snapshot v{version} ({len(body)} bytes)", flush=True)
+    except OSError as e:
+        print(f"Error writing catalog snapshot: {e}", flush=True)
+
+
+def touch_catalog_snapshot():
+    """Leader revalidated without changes: bump mtime so followers know the snapshot is fresh"""
+    if not catalog_snapshot_state["leader"]:
+        return
+    try:
+        os.utime(CATALOG_SNAPSHOT_PATH)
+    except OSError:
+        pass
+
+
+def load_catalog_snapshot():
+    """Follower side: map the snapshot read-only and rebuild only when its version moved"""
+    try:
+        with open(CATALOG_SNAPSHOT_PATH, "rb") as f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                magic, version, length = CATALOG_SNAPSHOT_HEADER.unpack_from(mapped)
+                if magic != CATALOG_SNAPSHOT_MAGIC:
+                    return None
+                if version == products_cache["snapshot"] and products_cache["catalog"] is not None:
+                    products_cache["timestamp"] = mtime
+                    products_refresh_stats["unchanged"] += 1
+                    return products_cache["catalog"]
+                start = CATALOG_SNAPSHOT_HEADER.size
+                payload = zlib.decompress(mapped[start:start + length])
+    except (OSError, ValueError, struct.error, zlib.error) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f"Error reading catalog snapshot: {e}", flush=True)
+        return None
+
+    records = json.loads(payload)
+    install_catalog(records, hashlib.sha1(payload).hexdigest())
+    products_cache["snapshot"] = version
+    products_cache["timestamp"] = mtime
+    products_refresh_stats["refreshes"] += 1
+    print(f"📦 Loaded catalog snapshot v{version} ({len(records)} product rows)", flush=True)
+    return products_cache["catalog"]
+
+
+def start_products_refresher():
+    if products_refresher_state["started"]:
+        return
+    with products_refresher_lock:
+        if products_refresher_state["started"]:
+            return
+        thread = threading.Thread(target=products_refresher_loop, name="products-refresher", daemon=True)
+        products_refresher_state["started"] = True
+        products_refresher_state["thread"] = thread
+        thread.start()
+
+
+def products_refresher_loop():
+    """Revalidate the catalog every PRODUCTS_REFRESH_INTERVAL, or sooner when nudged"""
+    while True:
+        # Followers only stat/mmap a local file, so they can look far more often than the leader hits Sheets
+        follower = catalog_snapshot_enabled() and not catalog_snapshot_state["leader"]
+        products_refresher_wakeup.wait(CATALOG_SNAPSHOT_POLL_INTERVAL if follower else PRODUCTS_REFRESH_INTERVAL)
+        products_refresher_wakeup.clear()
+        if products_refresher_state["stopping"]:
+            return
+        refresh_products()
+
+
+def shutdown_products_refresher():
+    products_refresher_state["stopping"] = True
+    products_refresher_wakeup.set()
+
+
+def get_products_cache_stats():
+    catalog = products_cache["catalog"]
+    stats = dict(products_refresh_stats)
+    stats["age"] = time.time() - products_cache["timestamp"] if catalog else None
+    stats["snapshot_version"] = products_cache["snapshot"]
+    stats["catalog_leader"] = catalog_snapshot_state["leader"]
+    stats["products"] = len(catalog.products) if catalog else 0
+    stats["refreshing"] = products_refresh_lock.locked()
+    return stats
 
 
 def get_cached_conversation_history(sender_id, limit=30):
-    """Get conversation history with caching"""
+    """Get conversation history from the per-sender ring, loading it from the local store on a miss.
+
+    save_message keeps the ring current for turns handled here; the newest-id check
+    catches turns another gunicorn worker stored (one indexed lookup, no Sheets)."""
     current_time = time.time()
-    cache_key = f"{sender_id}_{limit}"
-    
-    if cache_key in conversation_cache:
-        cached_data, cached_time = conversation_cache[cache_key]
-        if (current_time - cached_time) < CONVERSATION_CACHE_TTL:
-            print(f"✅ Using cached history for {sender_id}", flush=True)
-            return cached_data
+    latest_id = latest_message_id(sender_id)
     
-    print(f"📥 Fetching fresh history for {sender_id}", flush=True)
-    history = get_conversation_history_from_sheet(sender_id, limit)
-    
-    conversation_cache[cache_key] = (history, current_time)
+    cached = conversation_cache.get(sender_id)
+    if cached and (current_time - cached[1]) < CONVERSATION_CACHE_TTL and cached[2] == latest_id:
+        ring = cached[0]
+    else:
+        print(f"📥 Loading history for {sender_id}", flush=True)
+        ring = deque(load_recent_messages(sender_id, CONVERSATION_RING_SIZE), maxlen=CONVERSATION_RING_SIZE)
+        conversation_cache.put(sender_id, [ring, current_time, latest_id])
     
-    return history
+    history = list(ring)
+    return history[-limit:] if limit < len(history) else history
 
 
-def clear_conversation_cache(sender_id):
-    """Clear cache for a specific user when new message arrives"""
-    keys_to_delete = [k for k in conversation_cache.keys() if k.startswith(sender_id)]
-    for key in keys_to_delete:
-        del conversation_cache[key]
+def latest_message_id(sender_id):
+    try:
+        return get_db().execute("SELECT MAX(id) FROM messages WHERE sender_id = ?", (str(sender_id),)).fetchone()[0]
+    except sqlite3.Error:
+        return None
 
 
 # =====================
 # Google Sheets helpers
 # =====================
 
+SHEETS_SCOPE = [
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/drive",
+]
+SHEETS_TOKEN_REFRESH_MARGIN = int(os.environ.get("SHEETS_TOKEN_REFRESH_MARGIN", 600))
+SHEETS_HTTP_TIMEOUT = float(os.environ.get("SHEETS_HTTP_TIMEOUT", 30))
+
+# One authorized client per process, with the spreadsheet and worksheet handles it opened
+sheets_session_lock = threading.RLock()
+sheets_session = {"client": None, "spreadsheet": None, "worksheets": {}}
+
+
+def get_sheets_client():
+    """Authorized gspread client, refreshing its access token before it expires"""
+    with sheets_session_lock:
+        gc = sheets_session["client"]
+        if gc is None:
+            creds_dict = json.loads(GOOGLE_SHEETS_CREDS)
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SHEETS_SCOPE)
+            gc = gspread.authorize(creds)
+            gc.http_client.set_timeout(SHEETS_HTTP_TIMEOUT)
+            sheets_session["client"] = gc
+            print("🔑 Authorized Google Sheets client", flush=True)
+
+        refresh_sheets_token(gc)
+        return gc
+
+
+def refresh_sheets_token(gc):
+    """Refresh the service account token ahead of expiry instead of mid-request"""
+    auth = getattr(gc.http_client, "auth", None)
+    if auth is None:
+        return
+
+    expiry = getattr(auth, "expiry", None)  # naive UTC datetime, None until first use
+    if auth.token and expiry and (expiry - datetime.utcnow()).total_seconds() > SHEETS_TOKEN_REFRESH_MARGIN:
+        return
+
+    auth.refresh(google_auth_requests.Request())
+
+
 def get_sheet():
     try:
-        creds_dict = json.loads(GOOGLE_SHEETS_CREDS)
-        scope = [
-            "https://spreadsheets.google.com/feeds",
-            "https://www.googleapis.com/auth/drive",
-        ]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        gc = gspread.authorize(creds)
-        return gc.open(SHEET_NAME)
+        with sheets_session_lock:
+            get_sheets_client()
+            if sheets_session["spreadsheet"] is None:
+                sheets_session["spreadsheet"] = sheets_session["client"].open(SHEET_NAME)
+            return sheets_session["spreadsheet"]
     except Exception as e:
         print(f"Google Sheets connection error: {e}", flush=True)
+        reset_sheets_session()
         return None
 
 
-# =====================
-# Context Memory System
-# =====================
+def get_worksheet(name):
+    """Cached Worksheet handle (Ad_Products, Conversations, Leads)"""
+    sheet = get_sheet()
+    if not sheet:
+        return None
 
-def get_user_context(sender_id):
-    """Get or create user context memory"""
-    if sender_id not in user_states:
-        user_states[sender_id] = {
-            "step": None,
-            "ad_id": None,
-            "product": None,
-            "product_name": None,
-            "location": None,
-            "phone": None,
-            "name": None,
-            "address": None,
-            "last_topic": None,
-            "asked_location": False,
-            "asked_order": False,
-            "order_retry_count": 0,
-            "collecting_name": False,
-            "collecting_address": False,
-            "collecting_phone": False,
-        }
-    return user_states[sender_id]
+    with sheets_session_lock:
+        worksheet = sheets_session["worksheets"].get(name)
+        if worksheet is None:
+            worksheet = sheet.worksheet(name)
+            sheets_session["worksheets"][name] = worksheet
+        return worksheet
 
 
-def update_user_context(sender_id, **kwargs):
-    """Update user context with new information"""
-    context = get_user_context(sender_id)
-    context.update(kwargs)
-    user_states[sender_id] = context
-    print(f"💾 Updated context: step={context.get('step')}, product={context.get('product_name')}", flush=True)
+def reset_sheets_session():
+    """Drop the client and handles so the next call re-authorizes and reopens"""
+    with sheets_session_lock:
+        sheets_session["client"] = None
+        sheets_session["spreadsheet"] = None
+        sheets_session["worksheets"] = {}
 
 
-def extract_context_from_history(sender_id):
-    """Extract context from conversation history"""
-    history = get_cached_conversation_history(sender_id, limit=10)
-    context = get_user_context(sender_id)
-    
-    for msg in reversed(history):
-        if msg["role"] == "user":
-            product = extract_product_from_query(msg["message"])
-            if product and not context.get("product_name"):
-                update_user_context(sender_id, product_name=product, last_topic=product)
-                break
-    
-    for msg in reversed(history):
-        if msg["role"] == "user":
-            if is_valid_location(msg["message"]) and not context.get("location"):
-                update_user_context(sender_id, location=msg["message"])
-                break
+# =====================
+# Batched Sheets writer
+# =====================
 
+SHEETS_BATCH_SIZE = int(os.environ.get("SHEETS_BATCH_SIZE", 25))
+SHEETS_FLUSH_INTERVAL = float(os.environ.get("SHEETS_FLUSH_INTERVAL", 3))
+SHEETS_MAX_BACKOFF = float(os.environ.get("SHEETS_MAX_BACKOFF", 60))
+SHEETS_MAX_ATTEMPTS = int(os.environ.get("SHEETS_MAX_ATTEMPTS", 5))
+SHEETS_MAX_TRANSPORT_ATTEMPTS = int(os.environ.get("SHEETS_MAX_TRANSPORT_ATTEMPTS", 30))  # no HTTP response at all
+SHEETS_CLAIM_TIMEOUT = 120  # a claimed batch older than this belongs to a dead process
+
+sheet_writer_wakeup = threading.Event()
+sheet_writer_lock = threading.Lock()
+sheet_writer_state = {"started": False, "stopping": False, "thread": None, "pending": 0, "backoff": 0.0}
+sheet_writer_stats = {
+    "rows_queued": 0,
+    "rows_flushed": 0,
+    "rows_dead_lettered": 0,
+    "flushes": 0,
+    "retries": 0,
+    "last_flush_at": None,
+    "last_flush_lag": 0.0,
+    "max_flush_lag": 0.0,
+}
 
-# =========
-# Endpoints
-# =========
 
-@app.route("/", methods=["GET", "POST"])
-def health():
-    if request.method == "GET" and request.args.get("hub.mode"):
-        mode = request.args.get("hub.mode")
-        token = request.args.get("hub.verify_token")
-        challenge = request.args.get("hub.challenge")
+def enqueue_sheet_row(worksheet_name, row):
+    """Spool a row for a worksheet; the writer thread appends it in a batch"""
+    try:
+        get_db().execute(
+            "INSERT INTO sheet_spool (worksheet, row, queued_at) VALUES (?, ?, ?)",
+            (worksheet_name, json.dumps(row, ensure_ascii=False), time.time()),
+        )
+    except sqlite3.Error as e:
+        print(f"Error spooling row for {worksheet_name}: {e}", flush=True)
+        return
 
-        if mode == "subscribe" and token == VERIFY_TOKEN:
-            print("ROOT verification successful", flush=True)
-            return challenge, 200
+    start_sheet_writer()
 
-        return "Forbidden", 403
+    with sheet_writer_lock:
+        sheet_writer_stats["rows_queued"] += 1
+        sheet_writer_state["pending"] += 1
+        if sheet_writer_state["pending"] >= SHEETS_BATCH_SIZE:
+            sheet_writer_wakeup.set()
 
-    return "OK", 200
 
+def start_sheet_writer():
+    with sheet_writer_lock:
+        if sheet_writer_state["started"]:
+            return
+        thread = threading.Thread(target=sheet_writer_loop, name="sheet-writer", daemon=True)
+        sheet_writer_state["started"] = True
+        sheet_writer_state["thread"] = thread
+        thread.start()
 
-@app.route("/webhook", methods=["GET", "POST"])
-def webhook():
-    if request.method == "GET":
-        mode = request.args.get("hub.mode")
-        token = request.args.get("hub.verify_token")
-        challenge = request.args.get("hub.challenge")
 
-        if mode == "subscribe" and token == VERIFY_TOKEN:
-            print("Webhook verification successful", flush=True)
-            return challenge, 200
+def sheet_writer_loop():
+    """Flush spooled rows every SHEETS_FLUSH_INTERVAL, or sooner once a batch fills up"""
+    while True:
+        sheet_writer_wakeup.wait(SHEETS_FLUSH_INTERVAL + sheet_writer_state["backoff"])
+        sheet_writer_wakeup.clear()
 
-        return "Forbidden", 403
+        stopping = sheet_writer_state["stopping"]
+        try:
+            while flush_sheet_spool() >= SHEETS_BATCH_SIZE:
+                pass
+        except Exception as e:
+            print(f"Sheets writer error: {e}", flush=True)
 
-    if request.method == "POST":
-        data = request.get_json()
-        print("Webhook payload:", data, flush=True)
+        if stopping:
+            return
 
-        if "entry" in data:
-            for entry in data["entry"]:
-                page_id = entry.get("id")
-                page_token = PAGE_MAP.get(page_id)
 
-                messaging_events = entry.get("messaging", [])
-                for event in messaging_events:
-                    sender_id = event["sender"]["id"]
+def flush_sheet_spool():
+    """Claim up to SHEETS_BATCH_SIZE rows per worksheet and append them. Returns rows flushed."""
+    conn = get_db()
+    now = time.time()
+    claim_id = f"{os.getpid()}:{threading.get_ident()}:{now}"
+
+    conn.execute(
+        """UPDATE sheet_spool SET claimed_by = ?, claimed_at = ?
+           WHERE id IN (
+               SELECT id FROM sheet_spool
+               WHERE dead_at IS NULL AND (claimed_by IS NULL OR claimed_at < ?)
+               ORDER BY id LIMIT ?
+           )""",
+        (claim_id, now, now - SHEETS_CLAIM_TIMEOUT, SHEETS_BATCH_SIZE * 4),
+    )
+    rows = conn.execute(
+        "SELECT id, worksheet, row, queued_at, attempts FROM sheet_spool WHERE claimed_by = ? ORDER BY id",
+        (claim_id,),
+    ).fetchall()
+
+    with sheet_writer_lock:
+        sheet_writer_state["pending"] = 0
+    if not rows:
+        return 0
+
+    by_worksheet = {}
+    for row in rows:
+        by_worksheet.setdefault(row[1], []).append(row)
+
+    flushed = 0
+    for worksheet_name, batch in by_worksheet.items():
+        flushed += append_spooled_rows(conn, worksheet_name, batch)[0]
+
+    return flushed
+
+
+def append_spooled_rows(conn, worksheet_name, batch):
+    """Append a claimed batch. When the sheet rejects its contents (400), split it in
+    half until the bad rows are isolated, so one malformed row can't sink the rest.
+    Returns (rows flushed, whether the remaining rows were put back to retry)."""
+    try:
+        worksheet = get_worksheet(worksheet_name)
+        if not worksheet:
+            raise ConnectionError("Google Sheets unavailable")
+        worksheet.append_rows([json.loads(r[2]) for r in batch])
+    except Exception as e:
+        if len(batch) == 1 or sheet_error_status(e) != 400:
+            return 0, handle_sheet_flush_error(conn, worksheet_name, batch, e)
+
+        middle = len(batch) // 2
+        flushed, requeued = append_spooled_rows(conn, worksheet_name, batch[:middle])
+        if requeued:
+            # Keep the second half behind the first rather than appending it out of order
+            release_spooled_rows(conn, [r[0] for r in batch[middle:]])
+            return flushed, True
+        more, requeued = append_spooled_rows(conn, worksheet_name, batch[middle:])
+        return flushed + more, requeued
+
+    delete_spooled_rows(conn, [r[0] for r in batch])
+
+    lag = time.time() - min(r[3] for r in batch)
+    with sheet_writer_lock:
+        sheet_writer_state["backoff"] = 0.0
+        sheet_writer_stats["rows_flushed"] += len(batch)
+        sheet_writer_stats["flushes"] += 1
+        sheet_writer_stats["last_flush_at"] = time.time()
+        sheet_writer_stats["last_flush_lag"] = lag
+        sheet_writer_stats["max_flush_lag"] = max(sheet_writer_stats["max_flush_lag"], lag)
+    print(f"✅ Flushed {len(batch)} rows to {worksheet_name} (lag {lag:.1f}s)", flush=True)
+    return len(batch), False
+
+
+def sheet_error_status(error):
+    """HTTP status of a failed Sheets call, or None if no response came back"""
+    return getattr(getattr(error, "response", None), "status_code", None)
+
+
+def handle_sheet_flush_error(conn, worksheet_name, batch, error):
+    """Back off and retry quota/server errors; count attempts for everything else and
+    dead-letter rows that run out. Returns True if the rows were put back to retry."""
+    status = sheet_error_status(error)
+    if status in (401, 404):
+        # Expired auth or a deleted/renamed worksheet - reopen everything next time
+        reset_sheets_session()
+    ids = [r[0] for r in batch]
+    placeholders = ",".join("?" * len(ids))
+
+    if status is not None and (status == 429 or status >= 500):
+        backoff = bump_sheet_writer_backoff()
+        print(f"⚠️ Sheets append to {worksheet_name} failed ({status}), retrying in {backoff:.0f}s", flush=True)
+        release_spooled_rows(conn, ids)
+        return True
 
-                    if "referral" in event:
-                        ad_id = event["referral"].get("ref")
-                        handle_ad_referral(sender_id, ad_id, page_token)
+    # A transport failure (timeout, DNS, no credentials) gets more tries than a
+    # rejected request, but not unlimited ones
+    max_attempts = SHEETS_MAX_TRANSPORT_ATTEMPTS if status is None else SHEETS_MAX_ATTEMPTS
+    conn.execute(
+        f"""UPDATE sheet_spool SET claimed_by = NULL, claimed_at = NULL, attempts = attempts + 1
+            WHERE id IN ({placeholders})""",
+        ids,
+    )
+    exhausted = [r[0] for r in batch if r[4] + 1 >= max_attempts]
+    if exhausted:
+        dead_letter_spooled_rows(conn, exhausted)
+        print(f"⚠️ Dead-lettered {len(exhausted)} rows for {worksheet_name} after {max_attempts} attempts", flush=True)
+
+    if status is None and len(exhausted) < len(ids):
+        backoff = bump_sheet_writer_backoff()
+        print(f"⚠️ Sheets append to {worksheet_name} failed ({error}), retrying in {backoff:.0f}s", flush=True)
+        return True
+    print(f"Error appending rows to {worksheet_name}: {error}", flush=True)
+    return False
 
-                    if event.get("message") and "text" in event["message"]:
-                        text = event["message"]["text"]
-                        print(f"Message from {sender_id}: {text}", flush=True)
-                        
-                        clear_conversation_cache(sender_id)
-                        
-                        handle_message(sender_id, text, page_token)
 
-        return "EVENT_RECEIVED", 200
+def bump_sheet_writer_backoff():
+    with sheet_writer_lock:
+        backoff = sheet_writer_state["backoff"]
+        sheet_writer_state["backoff"] = min(SHEETS_MAX_BACKOFF, backoff * 2 if backoff else 1.0)
+        sheet_writer_stats["retries"] += 1
+        return sheet_writer_state["backoff"]
 
 
-# ===================
-# Core flow handlers
-# ===================
+def release_spooled_rows(conn, ids):
+    placeholders = ",".join("?" * len(ids))
+    conn.execute(f"UPDATE sheet_spool SET claimed_by = NULL, claimed_at = NULL WHERE id IN ({placeholders})", ids)
 
-def handle_ad_referral(sender_id, ad_id, page_token):
-    """Handle new user from Click-to-Messenger ad"""
-    try:
-        save_message(sender_id, ad_id, "system", f"User arrived from ad {ad_id}")
 
-        products_context, product_images = get_products_for_ad(ad_id)
+def delete_spooled_rows(conn, ids):
+    placeholders = ",".join("?" * len(ids))
+    conn.execute(f"DELETE FROM sheet_spool WHERE id IN ({placeholders})", ids)
 
-        update_user_context(sender_id, step="ask_location", ad_id=ad_id, product=products_context)
 
-        if products_context:
-            product_message = f"Mehenna ape products:\n\n{products_context}"
-            send_message(sender_id, product_message, page_token)
-            save_message(sender_id, ad_id, "assistant", product_message)
+def dead_letter_spooled_rows(conn, ids):
+    """Park rows the writer gave up on; they stay in the spool for `flask requeue-sheet-rows`"""
+    placeholders = ",".join("?" * len(ids))
+    conn.execute(f"UPDATE sheet_spool SET dead_at = ? WHERE id IN ({placeholders})", [time.time(), *ids])
+    with sheet_writer_lock:
+        sheet_writer_stats["rows_dead_lettered"] += len(ids)
 
-        if product_images:
-            for img_url in product_images[:10]:
-                send_image(sender_id, img_url, page_token)
-                time.sleep(0.3)
 
-        location_msg = "Location eka kohada?\n\nDear 💙"
-        send_message(sender_id, location_msg, page_token)
-        save_message(sender_id, ad_id, "assistant", location_msg)
-        
-        update_user_context(sender_id, asked_location=True)
+def shutdown_sheet_writer(deadline):
+    """Flush whatever is spooled before the process exits; anything left stays in the spool"""
+    with sheet_writer_lock:
+        thread = sheet_writer_state["thread"]
+        sheet_writer_state["stopping"] = True
+    if thread is None:
+        return
+    sheet_writer_wakeup.set()
+    thread.join(max(0, deadline - time.time()))
 
-        print(f"Ad referral: sender={sender_id}, ad_id={ad_id}", flush=True)
-    except Exception as e:
-        print(f"Error in handle_ad_referral: {e}", flush=True)
 
+def get_sheet_writer_stats():
+    """Flush-lag metrics for the Sheets writer"""
+    with sheet_writer_lock:
+        stats = dict(sheet_writer_stats)
+        stats["backoff"] = sheet_writer_state["backoff"]
 
-def handle_message(sender_id, text, page_token):
-    """Main message handler with AI-POWERED INTENT DETECTION"""
     try:
-        context = get_user_context(sender_id)
-        ad_id = context.get("ad_id") or get_user_ad_id(sender_id)
-        
-        save_message(sender_id, ad_id, "user", text)
+        pending, oldest, dead = get_db().execute(
+            "SELECT COUNT(*) FILTER (WHERE dead_at IS NULL), MIN(queued_at) FILTER (WHERE dead_at IS NULL), "
+            "COUNT(*) FILTER (WHERE dead_at IS NOT NULL) FROM sheet_spool"
+        ).fetchone()
+    except sqlite3.Error:
+        pending, oldest, dead = None, None, None
+    stats["pending_rows"] = pending
+    stats["dead_rows"] = dead
+    stats["oldest_pending_age"] = time.time() - oldest if oldest else 0.0
+    return stats
 
-        # Get products
-        products_context, product_images = get_products_for_ad(ad_id) if ad_id else (None, [])
-        
-        if not products_context:
-            products_context, product_images = get_all_products()
-            print(f"Using ALL products", flush=True)
-        
-        if not context.get("product_name"):
-            extract_context_from_history(sender_id)
-            context = get_user_context(sender_id)
-        
-        current_product = extract_product_from_query(text)
-        if current_product:
-            update_user_context(sender_id, product_name=current_product, last_topic=current_product)
-        
-        if is_valid_location(text) and not context.get("location"):
-            update_user_context(sender_id, location=text)
-            print(f"📍 Saved location: {text}", flush=True)
-        
-        history = get_cached_conversation_history(sender_id, limit=30)
-        
-        # STRUCTURED CONTACT COLLECTION
-        if context.get("step") == "collect_name":
-            update_user_context(sender_id, name=text, step="collect_address")
-            msg = "Address eka ewanna dear.\n\nDear 💙"
-            send_message(sender_id, msg, page_token)
-            save_message(sender_id, ad_id, "assistant", msg)
-            return
-        
-        if context.get("step") == "collect_address":
-            update_user_context(sender_id, address=text, step="collect_phone")
-            msg = "Phone number ewanna dear.\n\nDear 💙"
-            send_message(sender_id, msg, page_token)
-            save_message(sender_id, ad_id, "assistant", msg)
-            return
-        
-        if context.get("step") == "collect_phone":
-            phone = extract_phone_number(text)
-            if phone:
-                update_user_context(sender_id, phone=phone)
-                
-                # Save order
-                lead_info = {
-                    "name": context.get("name", ""),
-                    "address": context.get("address", ""),
-                    "phone": phone
-                }
-                save_complete_order(sender_id, ad_id, lead_info, products_context)
-                
-                # Thank you message
-                thank_msg = f"Thank you dear! {phone} ekata call karanawa soon.\n\nDear 💙"
-                send_message(sender_id, thank_msg, page_token)
-                save_message(sender_id, ad_id, "assistant", thank_msg)
-                
-                # Reset state
-                if sender_id in user_states:
-                    del user_states[sender_id]
-                return
-            else:
-                msg = "Phone number ekak ewanna (Example: 0771234567)\n\nDear 💙"
-                send_message(sender_id, msg, page_token)
-                save_message(sender_id, ad_id, "assistant", msg)
-                return
-        
-        # Check if user is sending complete contact details (old method)
-        if detect_contact_details(text):
-            handle_contact_details(sender_id, text, page_token, ad_id, products_context)
-            return
 
-        # AI-POWERED INTENT DETECTION
-        intent_data = detect_intent_with_ai(text, history, context, products_context)
-        intent = intent_data["intent"]
-        confidence = intent_data["confidence"]
-        entities = intent_data["entities"]
-        
-        print(f"🤖 AI Intent: {intent} (confidence: {confidence}), Entities: {entities}", flush=True)
+# =====================
+# Context Memory System
+# =====================
 
-        # Handle specific intents
-        if intent == "product_availability":
-            update_user_context(sender_id, step=None, order_retry_count=0)
-            handle_availability_request(sender_id, text, products_context, product_images, page_token, ad_id, context, entities)
-            return
-        elif intent == "photos":
-            update_user_context(sender_id, step=None, order_retry_count=0)
-            handle_photo_request(sender_id, text, products_context, product_images, page_token, ad_id, context, entities)
-            return
-        elif intent == "delivery":
-            update_user_context(sender_id, step=None, order_retry_count=0)
-            handle_delivery_request(sender_id, page_token, ad_id, context)
-            return
-        elif intent == "details":
-            update_user_context(sender_id, step=None, order_retry_count=0)
-            handle_details_request(sender_id, text, products_context, product_images, page_token, ad_id, context, entities)
-            return
-        elif intent == "dimensions":
-            update_user_context(sender_id, step=None, order_retry_count=0)
-            handle_dimensions_request(sender_id, text, products_context, page_token, ad_id, context, entities)
-            return
-        elif intent == "price_inquiry":
-            update_user_context(sender_id, step=None, order_retry_count=0)
-            handle_price_inquiry(sender_id, text, products_context, page_token, ad_id, context, entities)
-            return
-        elif intent == "total_price":
-            update_user_context(sender_id, step=None, order_retry_count=0)
-            handle_total_price_inquiry(sender_id, text, products_context, page_token, ad_id, context, entities)
-            return
-        elif intent == "product_list":
-            update_user_context(sender_id, step=None, order_retry_count=0)
-            handle_product_list_request(sender_id, products_context, product_images, page_token, ad_id, context)
-            return
-        elif intent == "how_to_order":
-            update_user_context(sender_id, step=None, order_retry_count=0)
-            handle_how_to_order(sender_id, page_token, ad_id)
-            return
+# User conversation state tracking. The store is shared by every worker and
+# survives restarts; a bounded in-process cache in front of it keeps reads local.
+USER_STATE_BACKEND = os.environ.get("USER_STATE_BACKEND", "sqlite")  # memory | sqlite | redis
+USER_STATE_TTL = int(os.environ.get("USER_STATE_TTL", 7 * 24 * 3600))  # idle conversations are forgotten
+USER_STATE_CACHE_SIZE = int(os.environ.get("USER_STATE_CACHE_SIZE", 5000))
+USER_STATE_CACHE_IDLE = int(os.environ.get("USER_STATE_CACHE_IDLE", 3600))  # drop from memory, not from the store
+USER_STATE_REVALIDATE_AFTER = float(os.environ.get("USER_STATE_REVALIDATE_AFTER", 1.0))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+USER_STATE_DEFAULTS = {
+    "step": None,
+    "ad_id": None,
+    "product": None,
+    "product_name": None,
+    "location": None,
+    "phone": None,
+    "name": None,
+    "address": None,
+    "last_topic": None,
+    "asked_location": False,
+    "asked_order": False,
+    "order_retry_count": 0,
+    "collecting_name": False,
+    "collecting_address": False,
+    "collecting_phone": False,
+}
 
-        # Flow management
-        step = context.get("step")
-        
-        if step == "ask_location":
-            if is_valid_location(text):
-                update_user_context(sender_id, location=text, step="ask_order")
-                
-                msg1 = "Hari! Delivery Rs.350.\n\nDear 💙"
-                send_message(sender_id, msg1, page_token)
-                save_message(sender_id, ad_id, "assistant", msg1)
-                
-                time.sleep(1)
-                
-                msg2 = "Order kamathi dha?\n\nDear 💙"
-                send_message(sender_id, msg2, page_token)
-                save_message(sender_id, ad_id, "assistant", msg2)
-                
-                update_user_context(sender_id, asked_order=True)
-                return
-            else:
-                update_user_context(sender_id, step=None)
-        
-        elif step == "ask_order":
-            wants_order = check_agreement(text)
-            
-            if intent in ["product_availability", "photos", "details", "price_inquiry", "product_list", "dimensions", "total_price"]:
-                update_user_context(sender_id, step=None, order_retry_count=0)
-                # Re-route to appropriate handler
-                return handle_message(sender_id, text, page_token)
-            
-            if wants_order:
-                # Start structured collection
-                update_user_context(sender_id, step="collect_name", order_retry_count=0)
-                details_msg = "Name eka ewanna dear.\n\nDear 💙"
-                send_message(sender_id, details_msg, page_token)
-                save_message(sender_id, ad_id, "assistant", details_msg)
-                return
-            else:
-                retry_count = context.get("order_retry_count", 0)
-                
-                if retry_count >= 2:
-                    print(f"⚠️ Too many retries, clearing state", flush=True)
-                    update_user_context(sender_id, step=None, order_retry_count=0)
-                    
-                    msg = "Mata message karanna dear, help karannam!\n\nDear 💙"
-                    send_message(sender_id, msg, page_token)
-                    save_message(sender_id, ad_id, "assistant", msg)
-                    return
-                
-                update_user_context(sender_id, order_retry_count=retry_count + 1)
-                retry_msg = "Ow kiyanna sir/madam.\n\nDear 💙"
-                send_message(sender_id, retry_msg, page_token)
-                save_message(sender_id, ad_id, "assistant", retry_msg)
-                return
+USER_STATE_STORE_ERRORS = (sqlite3.Error,) + ((redis.RedisError,) if redis else ())
 
-        # Use AI for general conversation
-        reply = get_ai_response(text, history, products_context, product_images, sender_id, ad_id, context)
-        
-        validation_result = validate_reply_strict(reply, products_context, text)
-        if not validation_result["valid"]:
-            print(f"❌ Invalid reply: {validation_result['reason']}", flush=True)
-            reply = get_fallback_response(text, products_context, intent)
-        
-        if "SEND_IMAGES" in reply:
-            reply = reply.replace("SEND_IMAGES", "").strip()
-            if product_images:
-                for img_url in product_images[:10]:
-                    send_image(sender_id, img_url, page_token)
-                    time.sleep(0.3)
-        
-        if "START_LOCATION_FLOW" in reply:
-            reply = reply.replace("START_LOCATION_FLOW", "").strip()
-            if not context.get("asked_location"):
-                update_user_context(sender_id, step="ask_location", asked_location=True)
-        
-        send_message(sender_id, reply, page_token)
-        save_message(sender_id, ad_id, "assistant", reply)
 
-    except Exception as e:
-        print(f"Error in handle_message: {e}", flush=True)
-        send_message(sender_id, "Sorry dear, issue ekak.\n\nDear 💙", page_token)
+def encode_user_state(context):
+    """Compact JSON of only the fields that differ from USER_STATE_DEFAULTS"""
+    changed = {k: v for k, v in context.items() if USER_STATE_DEFAULTS.get(k, object()) != v}
+    return json.dumps(changed, ensure_ascii=False, separators=(",", ":"))
 
 
-# ======================
-# AI-POWERED INTENT DETECTION - ENHANCED
-# ======================
+def decode_user_state(blob):
+    context = dict(USER_STATE_DEFAULTS)
+    context.update(json.loads(blob))
+    return context
 
-def detect_intent_with_ai(user_message, history, context, products_context):
-    """Use OpenAI to detect user intent - ULTRA SMART!"""
-    try:
-        context_info = ""
-        if context.get("product_name"):
-            context_info += f"User was talking about: {context['product_name']}\n"
-        if context.get("location"):
-            context_info += f"User location: {context['location']}\n"
-        
-        recent_history = ""
-        if history:
-            for msg in history[-2:]:
-                recent_history += f"{msg['role']}: {msg['message']}\n"
-        
-        prompt = f"""You are an intent classifier for a Sri Lankan e-commerce chatbot.
 
-AVAILABLE INTENTS:
-1. product_availability - User asking if product exists/available (thiyanawada, available, stock, ithiri)
-2. photos - User wants images (photo, photos, pics, pictures, image, foto, 4to, pintura, පින්තූර, ewanna, dana)
-3. delivery - User asking delivery charges (delivery, courier, charges, chargers, කරවන්න, delivery eka)
-4. details - User wants full specifications (details, visthara, specification, විස්තර, info, more info)
-5. dimensions - User asking specific measurements (height, width, size, adi, uchayak, usa, uyathai, dimensions, උස, පළල)
-6. price_inquiry - User asking price only (how much, kiyada, gana, ganang, price, ගාන, කීයද, ගාන කීයද)
-7. total_price - User asking total with delivery (sampura gana, total, total eka, sampura, සම්පූර්ණ ගාන)
-8. product_list - User asking what products available (mona products, products mona, kohomada, මොනවද)
-9. how_to_order - User asking how to place order
-10. greeting - User says hello, hi, ayubowan
-11. agreement - User says yes, ow, ok, kamathi (ඔව්, හරි, කැමති)
-12. disagreement - User says no, nehe, epa (නැහැ, එපා)
-13. general - Everything else
+class SQLiteUserStateStore:
+    """User states in the local database, shared by every gunicorn worker on this host"""
 
-PRODUCTS AVAILABLE:
-{products_context[:500] if products_context else "No products"}
+    backend = "sqlite"
+    PRUNE_EVERY = 500
 
-CONVERSATION CONTEXT:
-{context_info}
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._writes = 0
+        self._lock = threading.Lock()
 
-RECENT CHAT:
-{recent_history}
+    def load(self, sender_id, now):
+        """(version, blob) or None if missing or idle past the TTL"""
+        return get_db().execute(
+            "SELECT version, state FROM user_states WHERE sender_id = ? AND updated_at >= ?",
+            (sender_id, now - self.ttl),
+        ).fetchone()
 
-USER MESSAGE: "{user_message}"
+    def get_version(self, sender_id, now):
+        row = get_db().execute(
+            "SELECT version FROM user_states WHERE sender_id = ? AND updated_at >= ?",
+            (sender_id, now - self.ttl),
+        ).fetchone()
+        return row[0] if row else None
 
-Respond in JSON:
-{{
-  "intent": "intent_name",
-  "confidence": 0.0-1.0,
-  "entities": {{
-    "product": "product name if mentioned",
-    "quantity": "number if mentioned"
-  }}
-}}
+    def save(self, sender_id, version, blob, now):
+        conn = get_db()
+        conn.execute(
+            "INSERT OR REPLACE INTO user_states (sender_id, state, version, updated_at) VALUES (?, ?, ?, ?)",
+            (sender_id, blob, version, now),
+        )
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.PRUNE_EVERY == 0
+        if prune:
+            conn.execute("DELETE FROM user_states WHERE updated_at < ?", (now - self.ttl,))
 
-Examples:
-"mona products dha thiyanai" → {{"intent": "product_list", "confidence": 0.95, "entities": {{}}}}
-"how much" → {{"intent": "price_inquiry", "confidence": 0.9, "entities": {{}}}}
-"ගාන කීයද" → {{"intent": "price_inquiry", "confidence": 0.95, "entities": {{}}}}
-"sampura gana" → {{"intent": "total_price", "confidence": 0.95, "entities": {{}}}}
-"racks thiyanawada" → {{"intent": "product_availability", "confidence": 0.95, "entities": {{"product": "rack"}}}}
-"photos ewanna" → {{"intent": "photos", "confidence": 0.95, "entities": {{}}}}
-"4to dana" → {{"intent": "photos", "confidence": 0.9, "entities": {{}}}}
-"delivery charges" → {{"intent": "delivery", "confidence": 0.95, "entities": {{}}}}
-"height kiyada" → {{"intent": "dimensions", "confidence": 0.95, "entities": {{}}}}
-"usa eka" → {{"intent": "dimensions", "confidence": 0.9, "entities": {{}}}}
-"visthara denna" → {{"intent": "details", "confidence": 0.95, "entities": {{}}}}
-"""
+    def delete(self, sender_id):
+        get_db().execute("DELETE FROM user_states WHERE sender_id = ?", (sender_id,))
 
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are an intent classification expert. Always respond with valid JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=150,
-            temperature=0.3,
-            timeout=20
-        )
+    def count(self):
+        return get_db().execute("SELECT COUNT(*) FROM user_states").fetchone()[0]
 
-        result = response.choices[0].message.content.strip()
-        
-        try:
-            intent_data = json.loads(result)
-            return intent_data
-        except:
-            print(f"Failed to parse JSON: {result}", flush=True)
-            return {
-                "intent": "general",
-                "confidence": 0.5,
-                "entities": {}
-            }
 
-    except (ConnectionError, TimeoutError, httpx.ConnectError, httpx.TimeoutException) as e:
-        print(f"Intent detection connection error: {type(e).__name__} - {str(e)}", flush=True)
-        return {
-            "intent": "general",
-            "confidence": 0.5,
-            "entities": {}
-        }
-    except Exception as e:
-        print(f"Intent detection error: {e}", flush=True)
-        return {
-            "intent": "general",
-            "confidence": 0.5,
-            "entities": {}
-        }
+class RedisUserStateStore:
+    """User states in a Redis-compatible server; expiry is left to the server"""
 
+    backend = "redis"
+    KEY_PREFIX = "user_state:"
 
-def extract_product_from_query(text):
-    """Extract specific product name from user query"""
-    text_lower = text.lower()
-    
-    if "4 tier" in text_lower or "4tier" in text_lower or "4 layer" in text_lower or "four tier" in text_lower:
-        return "4 tier"
-    if "3 tier" in text_lower or "3tier" in text_lower or "3 layer" in text_lower or "three tier" in text_lower:
-        return "3 tier"
-    if "triangle" in text_lower:
-        return "triangle"
-    if "foldable" in text_lower:
-        return "foldable"
-    if "cloth rack" in text_lower:
-        return "cloth rack"
-    if "storage rack" in text_lower or "storage" in text_lower:
-        return "storage"
-    if "rack" in text_lower or "racks" in text_lower:
-        return "rack"
-    
-    return None
+    def __init__(self, url, ttl):
+        self.ttl = ttl
+        self.client = redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2)
 
+    def load(self, sender_id, now):
+        version, blob = self.client.hmget(self.KEY_PREFIX + sender_id, "v", "s")
+        return (int(version), blob.decode()) if blob is not None else None
 
-def extract_phone_number(text):
-    """Extract phone number from text"""
-    phone_patterns = [
-        r"(0\d{9})",
-        r"(\+94\d{9})",
-        r"(94\d{9})",
-    ]
-    for pattern in phone_patterns:
-        match = re.search(pattern, text.replace(" ", "").replace("-", ""))
-        if match:
-            return match.group(1)
+    def get_version(self, sender_id, now):
+        version = self.client.hget(self.KEY_PREFIX + sender_id, "v")
+        return int(version) if version is not None else None
+
+    def save(self, sender_id, version, blob, now):
+        key = self.KEY_PREFIX + sender_id
+        pipe = self.client.pipeline()
+        pipe.hset(key, mapping={"v": version, "s": blob})
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def delete(self, sender_id):
+        self.client.delete(self.KEY_PREFIX + sender_id)
+
+    def count(self):
+        return None
+
+
+class UserStateCache:
+    """Write-through cache of user contexts in front of a state store.
+
+    Entries are [context, version, checked_at] in an LRUCache. A cached context
+    is trusted for revalidate_after seconds; after that one version lookup tells
+    us whether another worker changed it. Without a store the cache is the state,
+    so entries then live for the full state TTL.
+    """
+
+    def __init__(self, store, max_entries, idle_ttl, revalidate_after):
+        self.store = store
+        self.revalidate_after = revalidate_after
+        self._entries = LRUCache(max_entries, idle_ttl, sizeof=lambda entry: len(encode_user_state(entry[0])))
+        self.stats = {"revalidations": 0, "loads": 0, "writes": 0, "errors": 0}
+
+    def get(self, sender_id):
+        now = time.time()
+        entry = self._entries.get(sender_id)
+        if entry is not None and (self.store is None or now - entry[2] < self.revalidate_after):
+            return entry[0]
+
+        entry = self._revalidate(sender_id, entry, now)
+        return entry[0]
+
+    def _revalidate(self, sender_id, entry, now):
+        loaded = None
+        if self.store is not None:
+            try:
+                if entry is not None:
+                    self.stats["revalidations"] += 1
+                    if (self.store.get_version(sender_id, now) or 0) == entry[1]:
+                        entry[2] = now
+                        return entry
+                self.stats["loads"] += 1
+                loaded = self.store.load(sender_id, now)
+            except USER_STATE_STORE_ERRORS as e:
+                self.stats["errors"] += 1
+                print(f"User state store error: {e}", flush=True)
+                if entry is not None:
+                    return entry
+
+        if loaded:
+            entry = [decode_user_state(loaded[1]), loaded[0], now]
+        else:
+            entry = [dict(USER_STATE_DEFAULTS), 0, now]
+        self._entries.put(sender_id, entry)
+        return entry
+
+    def update(self, sender_id, **kwargs):
+        """Apply changes in place (callers holding the context see them) and write through"""
+        context = self.get(sender_id)
+        context.update(kwargs)
+
+        now = time.time()
+        version = time.time_ns()
+        entry = self._entries.peek(sender_id)
+        if entry is not None and entry[0] is context:
+            entry[1], entry[2] = version, now
+
+        if self.store is not None:
+            try:
+                self.store.save(sender_id, version, encode_user_state(context), now)
+                self.stats["writes"] += 1
+            except USER_STATE_STORE_ERRORS as e:
+                self.stats["errors"] += 1
+                print(f"User state store error: {e}", flush=True)
+        return context
+
+    def expire(self, sender_id):
+        """Make the next get check the store's version instead of trusting the cache"""
+        entry = self._entries.peek(sender_id)
+        if entry is not None:
+            entry[2] = 0.0
+
+    def reset(self, sender_id):
+        self._entries.pop(sender_id)
+        if self.store is not None:
+            try:
+                self.store.delete(sender_id)
+            except USER_STATE_STORE_ERRORS as e:
+                self.stats["errors"] += 1
+                print(f"User state store error: {e}", flush=True)
+
+    def get_stats(self):
+        stats = self._entries.get_stats()
+        stats.update(self.stats)
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def make_user_state_store():
+    if USER_STATE_BACKEND == "redis":
+        if redis is not None:
+            return RedisUserStateStore(REDIS_URL, USER_STATE_TTL)
+        print("⚠️ USER_STATE_BACKEND=redis but the redis package is missing, using sqlite", flush=True)
+        return SQLiteUserStateStore(USER_STATE_TTL)
+    if USER_STATE_BACKEND == "sqlite":
+        return SQLiteUserStateStore(USER_STATE_TTL)
     return None
 
 
-def is_valid_location(text):
-    """Check if text is a valid Sri Lankan location"""
-    locations = [
-        "colombo", "kandy", "galle", "jaffna", "negombo", "matara", "kurunegala",
-        "anuradhapura", "trincomalee", "batticaloa", "ratnapura", "badulla", "ampara",
-        "hambantota", "kalutara", "kegalle", "kilinochchi", "mannar", "monaragala",
-        "mullaitivu", "nuwara eliya", "polonnaruwa", "puttalam", "vavuniya",
-        "homagama", "maharagama", "dehiwala", "mount lavinia", "moratuwa", "panadura",
-        "nugegoda", "kotte", "kaduwela", "kelaniya", "wattala", "ja-ela",
-        "road", "street", "lane", "town", "city", "gama", "watta"
-    ]
-    
-    text_lower = text.lower()
-    
-    if any(loc in text_lower for loc in locations):
-        return True
-    
-    if len(text.split()) <= 3 and not any(word in text_lower for word in ["delivery", "order", "price", "photo", "kamathi", "kiyada", "kohamada", "thiyanawada"]):
-        return True
-    
-    return False
+user_state_store = make_user_state_store()
+user_states = UserStateCache(
+    user_state_store,
+    USER_STATE_CACHE_SIZE,
+    min(USER_STATE_CACHE_IDLE, USER_STATE_TTL) if user_state_store is not None else USER_STATE_TTL,
+    USER_STATE_REVALIDATE_AFTER,
+)
 
 
-# ======================
-# Context-aware handlers - ENHANCED
-# ======================
+def get_user_context(sender_id):
+    """Get or create user context memory"""
+    return user_states.get(sender_id)
 
-def handle_total_price_inquiry(sender_id, user_text, products_context, page_token, ad_id, context, entities):
-    """Handle 'sampura gana' - total price with delivery"""
-    
-    specific_product = entities.get("product") or extract_product_from_query(user_text) or context.get("product_name")
-    
-    if specific_product and products_context:
-        # Extract price for specific product
-        products_lines = products_context.split("\n")
-        
-        for line in products_lines:
-            if " - Rs." in line and specific_product in line.lower():
-                # Extract price
-                price_match = re.search(r'Rs\.?\s*([\d,]+)', line)
-                if price_match:
-                    price_str = price_match.group(1).replace(',', '')
-                    try:
-                        product_price = int(price_str)
-                        total_price = product_price + 350
-                        
-                        msg = f"{specific_product}:\nProduct: Rs.{product_price:,}\nDelivery: Rs.350\n━━━━━━━\nTotal: Rs.{total_price:,}\n\nDear 💙"
-                        send_message(sender_id, msg, page_token)
-                        save_message(sender_id, ad_id, "assistant", msg)
-                        
-                        if not context.get("asked_order"):
-                            time.sleep(1)
-                            msg2 = "Order kamathi dha?\n\nDear 💙"
-                            send_message(sender_id, msg2, page_token)
-                            save_message(sender_id, ad_id, "assistant", msg2)
-                            update_user_context(sender_id, asked_order=True)
-                        return
-                    except:
-                        pass
-    
-    # Generic response if no specific product
-    msg = "Product price + Delivery Rs.350 = Total\n\nMata product name ekak ewanna, total eka kiyanna.\n\nDear 💙"
-    send_message(sender_id, msg, page_token)
-    save_message(sender_id, ad_id, "assistant", msg)
 
+def update_user_context(sender_id, **kwargs):
+    """Update user context with new information"""
+    context = user_states.update(sender_id, **kwargs)
+    print(f"💾 Updated context: step={context.get('step')}, product={context.get('product_name')}", flush=True)
 
-def handle_dimensions_request(sender_id, user_text, products_context, page_token, ad_id, context, entities):
-    """Handle dimension requests - height, width, size"""
-    
-    specific_product = entities.get("product") or extract_product_from_query(user_text) or context.get("product_name")
-    
-    if products_context:
-        if specific_product:
-            # Filter for specific product
-            filtered_details = []
-            products_lines = products_context.split("\n")
-            
-            capturing = False
-            for line in products_lines:
-                if " - Rs." in line and specific_product in line.lower():
-                    capturing = True
-                    filtered_details.append(line)
-                elif " - Rs." in line and capturing:
-                    break
-                elif capturing and line.strip():
-                    filtered_details.append(line)
-            
-            if filtered_details:
-                details_text = "\n".join(filtered_details)
-                msg = f"Mehenna {specific_product} dimensions:\n\n{details_text}\n\nDear 💙"
-            else:
-                msg = f"Dimensions:\n\n{products_context}\n\nDear 💙"
-        else:
-            msg = f"Dimensions:\n\n{products_context}\n\nDear 💙"
-        
-        send_message(sender_id, msg, page_token)
-        save_message(sender_id, ad_id, "assistant", msg)
-        
-        if not context.get("asked_order"):
-            time.sleep(1)
-            msg2 = "Order kamathi dha?\n\nDear 💙"
-            send_message(sender_id, msg2, page_token)
-            save_message(sender_id, ad_id, "assistant", msg2)
-            update_user_context(sender_id, asked_order=True)
-    else:
-        msg = "Dimensions nehe dear.\n\nDear 💙"
-        send_message(sender_id, msg, page_token)
-        save_message(sender_id, ad_id, "assistant", msg)
 
+def reset_user_context(sender_id):
+    """Forget a user's conversation state (e.g. after an order is saved)"""
+    user_states.reset(sender_id)
 
-def handle_price_inquiry(sender_id, user_text, products_context, page_token, ad_id, context, entities):
-    """Handle 'how much', 'gana kiyada', price questions"""
-    
-    specific_product = entities.get("product") or extract_product_from_query(user_text) or context.get("product_name")
-    
-    if specific_product and products_context:
-        filtered_products = []
-        products_lines = products_context.split("\n")
-        
-        for line in products_lines:
-            if " - Rs." in line and specific_product in line.lower():
-                filtered_products.append(line)
-        
-        if filtered_products:
-            msg = f"Mehenna {specific_product} price:\n\n" + "\n".join(filtered_products) + "\n\nDear 💙"
-        else:
-            msg = f"Mehenna prices:\n\n{products_context}\n\nDear 💙"
-    elif products_context:
-        msg = f"Mehenna prices:\n\n{products_context}\n\nDear 💙"
-    else:
-        msg = "Mata product name ekak ewanna, price kiyanna.\n\nDear 💙"
-    
-    send_message(sender_id, msg, page_token)
-    save_message(sender_id, ad_id, "assistant", msg)
-    
-    if not context.get("asked_order"):
-        time.sleep(1)
-        msg2 = "Order kamathi dha?\n\nDear 💙"
-        send_message(sender_id, msg2, page_token)
-        save_message(sender_id, ad_id, "assistant", msg2)
-        update_user_context(sender_id, asked_order=True)
 
+def get_user_state_stats():
+    stats = user_states.get_stats()
+    stats["backend"] = user_states.store.backend if user_states.store is not None else "memory"
+    try:
+        stats["stored"] = user_states.store.count() if user_states.store is not None else None
+    except USER_STATE_STORE_ERRORS:
+        stats["stored"] = None
+    return stats
 
-def handle_product_list_request(sender_id, products_context, product_images, page_token, ad_id, context):
-    """Handle 'mona products thiyanada' - show ALL products"""
-    
-    if not products_context:
-        msg = "Mata minute ekak wait karanna, products load karanawa.\n\nDear 💙"
-        send_message(sender_id, msg, page_token)
-        save_message(sender_id, ad_id, "assistant", msg)
-        return
-    
-    msg = f"Mehenna ape products:\n\n{products_context}\n\nDear 💙"
-    send_message(sender_id, msg, page_token)
-    save_message(sender_id, ad_id, "assistant", msg)
+
+def extract_context_from_history(sender_id):
+    """Extract context from conversation history"""
+    history = get_cached_conversation_history(sender_id, limit=10)
+    context = get_user_context(sender_id)
     
-    if product_images:
-        time.sleep(0.5)
-        for img_url in product_images[:10]:
-            send_image(sender_id, img_url, page_token)
-            time.sleep(0.3)
+    for msg in reversed(history):
+        if msg["role"] == "user":
+            product = extract_product_from_query(msg["message"])
+            if product and not context.get("product_name"):
+                update_user_context(sender_id, product_name=product, last_topic=product)
+                break
     
-    if not context.get("asked_order"):
-        time.sleep(1)
-        msg2 = "Order kamathi dha?\n\nDear 💙"
-        send_message(sender_id, msg2, page_token)
-        save_message(sender_id, ad_id, "assistant", msg2)
-        update_user_context(sender_id, asked_order=True)
+    for msg in reversed(history):
+        if msg["role"] == "user":
+            if is_valid_location(msg["message"]) and not context.get("location"):
+                update_user_context(sender_id, location=msg["message"])
+                break
 
 
-def handle_availability_request(sender_id, user_text, products_context, product_images, page_token, ad_id, context, entities):
-    """Handle 'thiyanawada' questions"""
-    
-    specific_product = entities.get("product") or extract_product_from_query(user_text) or context.get("product_name")
-    
-    if specific_product:
-        searched_products, searched_images = search_products_by_query(specific_product)
+# =========
+# Endpoints
+# =========
+
+@app.route("/", methods=["GET", "POST"])
+def health():
+    if request.method == "GET" and request.args.get("hub.mode"):
+        mode = request.args.get("hub.mode")
+        token = request.args.get("hub.verify_token")
+        challenge = request.args.get("hub.challenge")
+
+        if mode == "subscribe" and token == VERIFY_TOKEN:
+            print("ROOT verification successful", flush=True)
+            return challenge, 200
+
+        return "Forbidden", 403
+
+    return "OK", 200
+
+
+@app.route("/webhook", methods=["GET", "POST"])
+def webhook():
+    if request.method == "GET":
+        mode = request.args.get("hub.mode")
+        token = request.args.get("hub.verify_token")
+        challenge = request.args.get("hub.challenge")
+
+        if mode == "subscribe" and token == VERIFY_TOKEN:
+            print("Webhook verification successful", flush=True)
+            return challenge, 200
+
+        return "Forbidden", 403
+
+    if request.method == "POST":
+        data = request.get_json(silent=True)
+        print("Webhook payload:", data, flush=True)
+
+        return dispatch_webhook_payload(data, enqueue_event)
+
+
+def dispatch_webhook_payload(data, enqueue):
+    """Validate, dedup and queue the messaging events of one webhook delivery.
+    Returns (body, status) for the response."""
+    if not isinstance(data, dict):
+        return "Bad Request", 400
+
+    all_queued = True
+    for entry in data.get("entry", []):
+        page_id = entry.get("id")
+        page_token = PAGE_MAP.get(page_id)
+
+        for event in entry.get("messaging", []):
+            if not event.get("sender", {}).get("id"):
+                continue
+            if "referral" not in event and not (event.get("message") and "text" in event["message"]):
+                continue
+
+            event_key = get_event_key(event)
+            if event_key and not mark_event_processed(event_key):
+                print(f"🔁 Skipping duplicate event {event_key}", flush=True)
+                continue
+
+            if not enqueue(page_token, event):
+                all_queued = False
+                # Let Meta's redelivery of this event through
+                if event_key:
+                    unmark_event_processed(event_key)
+
+    # Non-200 makes Meta redeliver the batch later, which is the backpressure we want
+    if not all_queued:
+        return "BUSY", 503
+
+    return "EVENT_RECEIVED", 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Internal stats; needs "Authorization: Bearer $METRICS_TOKEN" """
+    auth = request.headers.get("Authorization", "")
+    if not METRICS_TOKEN or not hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        return "Not Found", 404
+
+    return {
+        "event_queue": get_event_queue_stats(),
+        "dedup": get_dedup_stats(),
+        "sheets_writer": get_sheet_writer_stats(),
+        "fast_intent": dict(fast_intent_stats),
+        "response_cache": response_cache.get_stats(),
+        "intent_cache": intent_cache.get_stats(),
+        "products_cache": get_products_cache_stats(),
+        "user_states": get_user_state_stats(),
+        "conversation_cache": conversation_cache.get_stats(),
+        "async_events": get_async_event_stats(),
+        "outbound": get_outbound_stats(),
+    }, 200
+
+
+def process_event(page_token, event, typing=True):
+    """Handle one messaging event on a background worker. typing=False when the
+    caller has already shown the typing indicator for it."""
+    sender_id = event["sender"]["id"]
+
+    if "referral" in event:
+        ad_id = event["referral"].get("ref")
+        handle_ad_referral(sender_id, ad_id, page_token)
+
+    if event.get("message") and "text" in event["message"]:
+        text = event["message"]["text"]
+        print(f"Message from {sender_id}: {text}", flush=True)
+
+        # Show we are on it while history, intent and the reply are worked out
+        if typing:
+            send_sender_action(sender_id, "typing_on", page_token)
+
+        handle_message(sender_id, text, page_token)
+
+
+# ===================
+# Core flow handlers
+# ===================
+
+def handle_ad_referral(sender_id, ad_id, page_token):
+    """Handle new user from Click-to-Messenger ad"""
+    try:
+        save_message(sender_id, ad_id, "system", f"User arrived from ad {ad_id}")
+        record_ad_attribution(sender_id, ad_id)
+
+        products = get_products_for_ad(ad_id)
+
+        update_user_context(sender_id, step="ask_location", ad_id=ad_id, product=products.text if products else None)
+
+        if products:
+            product_message = f"Mehenna ape products:\n\n{products.text}"
+            send_message(sender_id, product_message, page_token)
+            save_message(sender_id, ad_id, "assistant", product_message)
+
+        if products and products.images:
+            send_images(sender_id, list(products.images[:10]), page_token)
+
+        location_msg = "Location eka kohada?\n\nDear 💙"
+        send_message(sender_id, location_msg, page_token)
+        save_message(sender_id, ad_id, "assistant", location_msg)
         
-        if searched_products:
-            msg = f"Ow {specific_product} thiyanawa dear!\n\n{searched_products}\n\nDear 💙"
-            send_message(sender_id, msg, page_token)
-            save_message(sender_id, ad_id, "assistant", msg)
-            
-            if searched_images:
-                time.sleep(0.5)
-                for img_url in searched_images[:10]:
-                    send_image(sender_id, img_url, page_token)
-                    time.sleep(0.3)
-            
-            if not context.get("asked_order"):
-                time.sleep(1)
-                msg2 = "Order kamathi dha?\n\nDear 💙"
-                send_message(sender_id, msg2, page_token)
-                save_message(sender_id, ad_id, "assistant", msg2)
-                update_user_context(sender_id, asked_order=True)
+        update_user_context(sender_id, asked_location=True)
+
+        print(f"Ad referral: sender={sender_id}, ad_id={ad_id}", flush=True)
+    except Exception as e:
+        print(f"Error in handle_ad_referral: {e}", flush=True)
+
+
+class MessageTurn:
+    """Everything the handlers need about one inbound message, gathered up front"""
+
+    __slots__ = ("sender_id", "text", "page_token", "context", "ad_id", "products", "products_context", "product_images", "history")
+
+    def __init__(self, sender_id, text, page_token):
+        self.sender_id = sender_id
+        self.text = text
+        self.page_token = page_token
+
+
+def handle_message(sender_id, text, page_token):
+    """Main message handler with AI-POWERED INTENT DETECTION"""
+    try:
+        turn = begin_message_turn(sender_id, text, page_token)
+        if turn is None:
             return
+
+        # AI-POWERED INTENT DETECTION (keyword fast path first)
+        ai_turn = None
+        intent_data = detect_intent_fast_path(text)
+        if intent_data:
+            intent_source = "fast"
+        elif use_combined_llm_turn(sender_id):
+            ai_turn = get_ai_turn(text, turn.history, turn.products_context, turn.context)
+            intent_data = ai_turn
+            intent_source = "combined"
         else:
-            msg = f"Nehe dear, {specific_product} nehe.\n\nDear 💙"
-            send_message(sender_id, msg, page_token)
-            save_message(sender_id, ad_id, "assistant", msg)
+            intent_data = detect_intent_with_ai(text, turn.history, turn.context, turn.products_context)
+            intent_source = "two_call"
+
+        routed = route_message_turn(turn, intent_data, intent_source)
+        if routed == REROUTE_MESSAGE:
+            handle_message(sender_id, text, page_token)
+            return
+        if routed:
+            return
+
+        # Use AI for general conversation
+        if ai_turn and ai_turn["reply"]:
+            reply = ai_turn["reply"]
+        else:
+            reply = get_ai_response(text, turn.history, turn.products_context, turn.product_images, sender_id, turn.ad_id, turn.context)
+
+        finish_message_turn(turn, reply, intent_data["intent"])
+
+    except Exception as e:
+        print(f"Error in handle_message: {e}", flush=True)
+        send_message(sender_id, "Sorry dear, issue ekak.\n\nDear 💙", page_token)
+
+
+async def handle_message_async(sender_id, text, page_token):
+    """handle_message for the ASGI path: LLM calls are awaited, local work runs in threads,
+    and replies queued by the shared handlers are sent from the event loop"""
+    outbox = reply_outbox.get()
+    try:
+        turn = await asyncio.to_thread(begin_message_turn, sender_id, text, page_token)
+        if turn is None:
+            return
+
+        ai_turn = None
+        # Product extraction may have to (re)load the catalog from Sheets
+        intent_data = await asyncio.to_thread(detect_intent_fast_path, text)
+        if intent_data:
+            intent_source = "fast"
+        elif use_combined_llm_turn(sender_id):
+            ai_turn = await get_ai_turn_async(text, turn.history, turn.products_context, turn.context)
+            intent_data = ai_turn
+            intent_source = "combined"
+        else:
+            intent_data = await detect_intent_with_ai_async(text, turn.history, turn.context, turn.products_context)
+            intent_source = "two_call"
+
+        routed = await asyncio.to_thread(route_message_turn, turn, intent_data, intent_source)
+        if routed == REROUTE_MESSAGE:
+            await handle_message_async(sender_id, text, page_token)
+            return
+        if routed:
             return
+
+        if ai_turn and ai_turn["reply"]:
+            reply = ai_turn["reply"]
+        else:
+            reply = await get_ai_response_async(text, turn.history, turn.products_context, turn.product_images, sender_id, turn.ad_id, turn.context)
+
+        await asyncio.to_thread(finish_message_turn, turn, reply, intent_data["intent"])
+
+    except Exception as e:
+        print(f"Error in handle_message: {e}", flush=True)
+        send_message(sender_id, "Sorry dear, issue ekak.\n\nDear 💙", page_token)
+    finally:
+        if outbox is not None:
+            await flush_reply_outbox(outbox)
+
+
+def begin_message_turn(sender_id, text, page_token):
+    """Load state and products, update context, and handle the contact-collection steps.
+    Returns the MessageTurn, or None if the message was fully handled here."""
+    context = get_user_context(sender_id)
+    ad_id = context.get("ad_id") or get_user_ad_id(sender_id)
     
-    if products_context:
-        msg = f"Ow thiyanawa dear!\n\n{products_context}\n\nDear 💙"
-    else:
-        msg = "Mata product name ekak ewanna dear.\n\nDear 💙"
+    save_message(sender_id, ad_id, "user", text)
+
+    # Get products (structured; text is only rendered for prompts and replies)
+    products = get_products_for_ad(ad_id) if ad_id else None
     
-    send_message(sender_id, msg, page_token)
-    save_message(sender_id, ad_id, "assistant", msg)
+    if not products:
+        products = get_all_products()
+        print(f"Using ALL products", flush=True)
     
-    if product_images:
-        time.sleep(0.5)
-        for img_url in product_images[:10]:
-            send_image(sender_id, img_url, page_token)
-            time.sleep(0.3)
-
-
-def handle_photo_request(sender_id, user_text, products_context, product_images, page_token, ad_id, context, entities):
-    """Handle photos - foto, 4to, pintura, pics"""
+    if not context.get("product_name"):
+        extract_context_from_history(sender_id)
+        context = get_user_context(sender_id)
     
-    specific_product = entities.get("product") or extract_product_from_query(user_text) or context.get("product_name")
+    current_product = extract_product_from_query(text)
+    if current_product:
+        update_user_context(sender_id, product_name=current_product, last_topic=current_product)
     
-    if specific_product and products_context:
-        filtered_images = get_specific_product_images(specific_product, ad_id)
-        
-        if filtered_images:
-            for img_url in filtered_images[:10]:
-                send_image(sender_id, img_url, page_token)
-                time.sleep(0.3)
-            
-            msg = f"Mehenna {specific_product} photos dear!\n\nDear 💙"
-            send_message(sender_id, msg, page_token)
-            save_message(sender_id, ad_id, "assistant", msg)
-            
-            if not context.get("asked_order"):
-                time.sleep(1)
-                msg2 = "Order kamathi dha?\n\nDear 💙"
-                send_message(sender_id, msg2, page_token)
-                save_message(sender_id, ad_id, "assistant", msg2)
-                update_user_context(sender_id, asked_order=True)
-            return
+    if is_valid_location(text) and not context.get("location"):
+        update_user_context(sender_id, location=text)
+        print(f"📍 Saved location: {text}", flush=True)
     
-    if product_images:
-        for img_url in product_images[:10]:
-            send_image(sender_id, img_url, page_token)
-            time.sleep(0.3)
-        
-        msg = "Mehenna photos dear!\n\nDear 💙"
+    # STRUCTURED CONTACT COLLECTION
+    if context.get("step") == "collect_name":
+        update_user_context(sender_id, name=text, step="collect_address")
+        msg = "Address eka ewanna dear.\n\nDear 💙"
         send_message(sender_id, msg, page_token)
         save_message(sender_id, ad_id, "assistant", msg)
-        
-        if not context.get("asked_order"):
-            time.sleep(1)
-            msg2 = "Order kamathi dha?\n\nDear 💙"
-            send_message(sender_id, msg2, page_token)
-            save_message(sender_id, ad_id, "assistant", msg2)
-            update_user_context(sender_id, asked_order=True)
-    else:
-        msg = "Photos nehe dear, mata message karanna.\n\nDear 💙"
+        return None
+    
+    if context.get("step") == "collect_address":
+        update_user_context(sender_id, address=text, step="collect_phone")
+        msg = "Phone number ewanna dear.\n\nDear 💙"
         send_message(sender_id, msg, page_token)
         save_message(sender_id, ad_id, "assistant", msg)
+        return None
+    
+    if context.get("step") == "collect_phone":
+        phone = extract_phone_number(text)
+        if phone:
+            update_user_context(sender_id, phone=phone)
+            
+            # Save order
+            lead_info = {
+                "name": context.get("name", ""),
+                "address": context.get("address", ""),
+                "phone": phone
+            }
+            save_complete_order(sender_id, ad_id, lead_info, products)
+            
+            # Thank you message
+            thank_msg = f"Thank you dear! {phone} ekata call karanawa soon.\n\nDear 💙"
+            send_message(sender_id, thank_msg, page_token)
+            save_message(sender_id, ad_id, "assistant", thank_msg)
+            
+            # Reset state
+            reset_user_context(sender_id)
+            return None
+        else:
+            msg = "Phone number ekak ewanna (Example: 0771234567)\n\nDear 💙"
+            send_message(sender_id, msg, page_token)
+            save_message(sender_id, ad_id, "assistant", msg)
+            return None
+    
+    # Check if user is sending complete contact details (old method)
+    if detect_contact_details(text):
+        handle_contact_details(sender_id, text, page_token, ad_id, products)
+        return None
 
+    turn = MessageTurn(sender_id, text, page_token)
+    turn.context = context
+    turn.ad_id = ad_id
+    turn.products = products
+    turn.products_context = products.text if products else None
+    turn.product_images = list(products.images) if products else []
+    turn.history = get_cached_conversation_history(sender_id, limit=30)
+    return turn
 
-def get_specific_product_images(product_keyword, ad_id):
-    """Get images for a specific product only"""
-    try:
-        records = get_cached_products()
-        if not records:
-            return []
-
-        for row in records:
-            if str(row.get("ad_id")) == str(ad_id) or not ad_id:
-                image_urls = []
-                
-                for i in range(1, 6):
-                    name_key = f"product_{i}_name"
-                    product_name = str(row.get(name_key, "")).lower()
-                    
-                    if product_keyword in product_name:
-                        for img_num in range(1, 4):
-                            image_key = f"product_{i}_image_{img_num}"
-                            img_url = row.get(image_key)
-                            if img_url and img_url.startswith("http"):
-                                image_urls.append(img_url)
-                        
-                        if image_urls:
-                            return image_urls
 
-        return []
+REROUTE_MESSAGE = "reroute"
 
-    except Exception as e:
-        print(f"Error getting specific product images: {e}", flush=True)
-        return []
 
+def route_message_turn(turn, intent_data, intent_source):
+    """Dispatch to the intent handlers and the order flow. Returns True if the message was
+    answered, False if it should get a general AI reply, or REROUTE_MESSAGE if the whole
+    turn should run again now that the order step was cleared."""
+    sender_id, text, page_token = turn.sender_id, turn.text, turn.page_token
+    context, ad_id, products = turn.context, turn.ad_id, turn.products
 
-def handle_delivery_request(sender_id, page_token, ad_id, context):
-    """Handle delivery charges"""
-    msg1 = "Delivery Rs.350 dear! Island-wide.\n\nDear 💙"
-    send_message(sender_id, msg1, page_token)
-    save_message(sender_id, ad_id, "assistant", msg1)
+    intent = intent_data["intent"]
+    confidence = intent_data["confidence"]
+    entities = intent_data["entities"]
     
-    if not context.get("asked_order"):
-        time.sleep(1)
-        msg2 = "Order kamathi dha?\n\nDear 💙"
-        send_message(sender_id, msg2, page_token)
-        save_message(sender_id, ad_id, "assistant", msg2)
-        update_user_context(sender_id, asked_order=True)
+    print(f"🤖 AI Intent ({intent_source}): {intent} (confidence: {confidence}), Entities: {entities}", flush=True)
 
+    # Handle specific intents
+    if intent == "product_availability":
+        update_user_context(sender_id, step=None, order_retry_count=0)
+        handle_availability_request(sender_id, text, products, page_token, ad_id, context, entities)
+        return True
+    elif intent == "photos":
+        update_user_context(sender_id, step=None, order_retry_count=0)
+        handle_photo_request(sender_id, text, products, page_token, ad_id, context, entities)
+        return True
+    elif intent == "delivery":
+        update_user_context(sender_id, step=None, order_retry_count=0)
+        handle_delivery_request(sender_id, page_token, ad_id, context)
+        return True
+    elif intent == "details":
+        update_user_context(sender_id, step=None, order_retry_count=0)
+        handle_details_request(sender_id, text, products, page_token, ad_id, context, entities)
+        return True
+    elif intent == "dimensions":
+        update_user_context(sender_id, step=None, order_retry_count=0)
+        handle_dimensions_request(sender_id, text, products, page_token, ad_id, context, entities)
+        return True
+    elif intent == "price_inquiry":
+        update_user_context(sender_id, step=None, order_retry_count=0)
+        handle_price_inquiry(sender_id, text, products, page_token, ad_id, context, entities)
+        return True
+    elif intent == "total_price":
+        update_user_context(sender_id, step=None, order_retry_count=0)
+        handle_total_price_inquiry(sender_id, text, products, page_token, ad_id, context, entities)
+        return True
+    elif intent == "product_list":
+        update_user_context(sender_id, step=None, order_retry_count=0)
+        handle_product_list_request(sender_id, products, page_token, ad_id, context)
+        return True
+    elif intent == "how_to_order":
+        update_user_context(sender_id, step=None, order_retry_count=0)
+        handle_how_to_order(sender_id, page_token, ad_id)
+        return True
 
-def handle_details_request(sender_id, user_text, products_context, product_images, page_token, ad_id, context, entities):
-    """Handle details - visthara"""
+    # Flow management
+    step = context.get("step")
     
-    if products_context:
-        specific_product = entities.get("product") or extract_product_from_query(user_text)
-        
-        if not specific_product:
-            history = get_cached_conversation_history(sender_id, limit=5)
-            
-            for msg in reversed(history[-6:]):
-                if msg["role"] == "user":
-                    product_in_history = extract_product_from_query(msg["message"])
-                    if product_in_history:
-                        specific_product = product_in_history
-                        break
-        
-        if not specific_product and context.get("product_name"):
-            specific_product = context.get("product_name")
-        
-        if specific_product:
-            filtered_details = []
-            products_lines = products_context.split("\n")
+    if step == "ask_location":
+        if is_valid_location(text):
+            update_user_context(sender_id, location=text, step="ask_order")
             
-            capturing = False
-            for line in products_lines:
-                if " - Rs." in line and specific_product in line.lower():
-                    capturing = True
-                    filtered_details.append(line)
-                elif " - Rs." in line and capturing:
-                    break
-                elif capturing and line.strip():
-                    filtered_details.append(line)
+            msg1 = "Hari! Delivery Rs.350.\n\nDear 💙"
+            send_message(sender_id, msg1, page_token)
+            save_message(sender_id, ad_id, "assistant", msg1)
             
-            if filtered_details:
-                details_text = "\n".join(filtered_details)
-                msg = f"Mehenna {specific_product} details!\n\n{details_text}\n\nDear 💙"
-            else:
-                msg = f"Mehenna details!\n\n{products_context}\n\nDear 💙"
+            ask_to_order(sender_id, page_token, ad_id)
+            return True
         else:
-            msg = f"Mehenna details!\n\n{products_context}\n\nDear 💙"
+            update_user_context(sender_id, step=None)
+    
+    elif step == "ask_order":
+        wants_order = check_agreement(text)
         
-        send_message(sender_id, msg, page_token)
-        save_message(sender_id, ad_id, "assistant", msg)
+        if intent in ["product_availability", "photos", "details", "price_inquiry", "product_list", "dimensions", "total_price"]:
+            update_user_context(sender_id, step=None, order_retry_count=0)
+            # Re-route to appropriate handler (the caller runs the turn again)
+            return REROUTE_MESSAGE
         
-        if not context.get("asked_order"):
-            time.sleep(1)
-            msg2 = "Order kamathi dha?\n\nDear 💙"
-            send_message(sender_id, msg2, page_token)
-            save_message(sender_id, ad_id, "assistant", msg2)
-            update_user_context(sender_id, asked_order=True)
-    else:
-        msg = "Details nehe dear, mata message karanna.\n\nDear 💙"
-        send_message(sender_id, msg, page_token)
-        save_message(sender_id, ad_id, "assistant", msg)
-
-
-def handle_how_to_order(sender_id, page_token, ad_id):
-    """Handle 'how to order' questions"""
-    msg = "Order karanna:\n1. Product select karanna\n2. Location ewanna\n3. Name, address, phone ewanna\n\nMata message karanna dear!\n\nDear 💙"
-    send_message(sender_id, msg, page_token)
-    save_message(sender_id, ad_id, "assistant", msg)
+        if wants_order:
+            # Start structured collection
+            update_user_context(sender_id, step="collect_name", order_retry_count=0)
+            details_msg = "Name eka ewanna dear.\n\nDear 💙"
+            send_message(sender_id, details_msg, page_token)
+            save_message(sender_id, ad_id, "assistant", details_msg)
+            return True
+        else:
+            retry_count = context.get("order_retry_count", 0)
+            
+            if retry_count >= 2:
+                print(f"⚠️ Too many retries, clearing state", flush=True)
+                update_user_context(sender_id, step=None, order_retry_count=0)
+                
+                msg = "Mata message karanna dear, help karannam!\n\nDear 💙"
+                send_message(sender_id, msg, page_token)
+                save_message(sender_id, ad_id, "assistant", msg)
+                return True
+            
+            update_user_context(sender_id, order_retry_count=retry_count + 1)
+            retry_msg = "Ow kiyanna sir/madam.\n\nDear 💙"
+            send_message(sender_id, retry_msg, page_token)
+            save_message(sender_id, ad_id, "assistant", retry_msg)
+            return True
 
+    return False
 
-def get_fallback_response(text, products_context, intent):
-    """Fallback response"""
-    if products_context:
-        return f"Mehenna products:\n\n{products_context}\n\nDear 💙"
-    else:
-        return "Mata message karanna dear!\n\nDear 💙"
 
+def finish_message_turn(turn, reply, intent):
+    """Validate the AI reply, act on its control markers and send it"""
+    sender_id, page_token, context = turn.sender_id, turn.page_token, turn.context
 
-def validate_reply_strict(reply, products_context, user_message):
-    """STRICT validation"""
+    validation_result = validate_reply_strict(reply, turn.products_context, turn.text)
+    if not validation_result["valid"]:
+        print(f"❌ Invalid reply: {validation_result['reason']}", flush=True)
+        reply = get_fallback_response(turn.text, turn.products_context, intent)
     
-    forbidden_words = [
-        "fridge", "refrigerator", "samsung", "lg", "microwave",
-        "gas cooker", "200l", "frost-free", "5 star", "warranty"
-    ]
+    if "SEND_IMAGES" in reply:
+        reply = reply.replace("SEND_IMAGES", "").strip()
+        if turn.product_images:
+            send_images(sender_id, turn.product_images[:10], page_token)
     
-    for word in forbidden_words:
-        if word in reply.lower():
-            if not products_context or word not in products_context.lower():
-                return {"valid": False, "reason": f"Mentioned forbidden product: {word}"}
+    if "START_LOCATION_FLOW" in reply:
+        reply = reply.replace("START_LOCATION_FLOW", "").strip()
+        if not context.get("asked_location"):
+            update_user_context(sender_id, step="ask_location", asked_location=True)
     
-    return {"valid": True, "reason": ""}
+    send_message(sender_id, reply, page_token)
+    save_message(sender_id, turn.ad_id, "assistant", reply)
 
 
-# -------------
-# Helper functions
-# -------------
+# ======================
+# AI-POWERED INTENT DETECTION - ENHANCED
+# ======================
 
-def detect_contact_details(text):
-    """Detect if message contains phone number + other details"""
-    has_phone = bool(re.search(r'0\d{9}|94\d{9}|\+94\d{9}', text.replace(' ', '').replace('-', '')))
-    
-    address_indicators = ['no:', 'no.', 'road', 'street', 'colombo', 'kandy', 'galle', 'negombo', 'kurunegala', 'matara', 'anuradhapura']
-    has_address = any(indicator in text.lower() for indicator in address_indicators)
-    
-    has_name = bool(re.search(r'[A-Z][a-z]+\s+[A-Z][a-z]+', text))
+# Shared by the intent classifier and the combined single-call turn
+INTENT_DEFINITIONS = """AVAILABLE INTENTS:
+1. product_availability - User asking if product exists/available (thiyanawada, available, stock, ithiri)
+2. photos - User wants images (photo, photos, pics, pictures, image, foto, 4to, pintura, පින්තූර, ewanna, dana)
+3. delivery - User asking delivery charges (delivery, courier, charges, chargers, කරවන්න, delivery eka)
+4. details - User wants full specifications (details, visthara, specification, විස්තර, info, more info)
+5. dimensions - User asking specific measurements (height, width, size, adi, uchayak, usa, uyathai, dimensions, උස, පළල)
+6. price_inquiry - User asking price only (how much, kiyada, gana, ganang, price, ගාන, කීයද, ගාන කීයද)
+7. total_price - User asking total with delivery (sampura gana, total, total eka, sampura, සම්පූර්ණ ගාන)
+8. product_list - User asking what products available (mona products, products mona, kohomada, මොනවද)
+9. how_to_order - User asking how to place order
+10. greeting - User says hello, hi, ayubowan
+11. agreement - User says yes, ow, ok, kamathi (ඔව්, හරි, කැමති)
+12. disagreement - User says no, nehe, epa (නැහැ, එපා)
+13. general - Everything else"""
+
+INTENT_EXAMPLES = """Examples:
+"mona products dha thiyanai" → {"intent": "product_list", "confidence": 0.95, "entities": {}}
+"how much" → {"intent": "price_inquiry", "confidence": 0.9, "entities": {}}
+"ගාන කීයද" → {"intent": "price_inquiry", "confidence": 0.95, "entities": {}}
+"sampura gana" → {"intent": "total_price", "confidence": 0.95, "entities": {}}
+"racks thiyanawada" → {"intent": "product_availability", "confidence": 0.95, "entities": {"product": "rack"}}
+"photos ewanna" → {"intent": "photos", "confidence": 0.95, "entities": {}}
+"4to dana" → {"intent": "photos", "confidence": 0.9, "entities": {}}
+"delivery charges" → {"intent": "delivery", "confidence": 0.95, "entities": {}}
+"height kiyada" → {"intent": "dimensions", "confidence": 0.95, "entities": {}}
+"usa eka" → {"intent": "dimensions", "confidence": 0.9, "entities": {}}
+"visthara denna" → {"intent": "details", "confidence": 0.95, "entities": {}}
+"""
+
+def detect_intent_with_ai(user_message, history, context, products_context):
+    """Use OpenAI to detect user intent - ULTRA SMART!"""
+    cached, cache_key = lookup_cached_intent(user_message, history)
+    if cached is not None:
+        return cached
+
+    try:
+        response = client.chat.completions.create(**build_intent_request(user_message, history, context, products_context))
+        return parse_intent_response(response, cache_key)
+
+    except (ConnectionError, TimeoutError, httpx.ConnectError, httpx.TimeoutException) as e:
+        print(f"Intent detection connection error: {type(e).__name__} - {str(e)}", flush=True)
+        return dict(FALLBACK_INTENT)
+    except Exception as e:
+        print(f"Intent detection error: {e}", flush=True)
+        return dict(FALLBACK_INTENT)
+
+
+async def detect_intent_with_ai_async(user_message, history, context, products_context):
+    """detect_intent_with_ai on AsyncOpenAI, for the ASGI path"""
+    cached, cache_key = lookup_cached_intent(user_message, history)
+    if cached is not None:
+        return cached
+
+    try:
+        response = await async_client.chat.completions.create(**build_intent_request(user_message, history, context, products_context))
+        return parse_intent_response(response, cache_key)
+
+    except (ConnectionError, TimeoutError, httpx.ConnectError, httpx.TimeoutException) as e:
+        print(f"Intent detection connection error: {type(e).__name__} - {str(e)}", flush=True)
+        return dict(FALLBACK_INTENT)
+    except Exception as e:
+        print(f"Intent detection error: {e}", flush=True)
+        return dict(FALLBACK_INTENT)
+
+
+def lookup_cached_intent(user_message, history):
+    cache_key = get_intent_cache_key(user_message, history)
+    if cache_key:
+        cached, _ = intent_cache.get(cache_key)
+        if cached is not None:
+            print(f"✅ Using cached intent for '{cache_key[1]}'", flush=True)
+            # Entities were never cached; handlers fall back to the message and this user's context
+            return dict(cached, entities={}), cache_key
+    return None, cache_key
+
+
+def build_intent_request(user_message, history, context, products_context):
+    """chat.completions.create arguments for intent classification"""
+    context_info = ""
+    if context.get("product_name"):
+        context_info += f"User was talking about: {context['product_name']}\n"
+    if context.get("location"):
+        context_info += f"User location: {context['location']}\n"
     
-    has_multiple_lines = len([l for l in text.split('\n') if l.strip()]) >= 2
+    recent_history = ""
+    if history:
+        for msg in history[-2:]:
+            recent_history += f"{msg['role']}: {msg['message']}\n"
     
-    return has_phone and (has_address or has_name or has_multiple_lines)
+    prompt = f"""You are an intent classifier for a Sri Lankan e-commerce chatbot.
 
+{INTENT_DEFINITIONS}
 
-def check_agreement(text):
-    """Check if user agrees/says yes"""
-    agreement_keywords = [
-        "yes", "ow", "හරි", "ඔව්", "ok", "oka", "එහෙනම්",
-        "ඕනා", "කැමති", "kamathi", "hari", "okey", "okay"
-    ]
-    text_lower = text.lower()
-    return any(keyword in text_lower for keyword in agreement_keywords)
+PRODUCTS AVAILABLE:
+{products_context[:500] if products_context else "No products"}
 
+CONVERSATION CONTEXT:
+{context_info}
 
-def handle_contact_details(sender_id, text, page_token, ad_id, products_context):
-    """Handle when user sends complete contact details (legacy)"""
-    lead_info = extract_full_lead_info(text)
+RECENT CHAT:
+{recent_history}
+
+USER MESSAGE: "{user_message}"
+
+Respond in JSON:
+{{
+  "intent": "intent_name",
+  "confidence": 0.0-1.0,
+  "entities": {{
+    "product": "product name if mentioned",
+    "quantity": "number if mentioned"
+  }}
+}}
+
+{INTENT_EXAMPLES}"""
+
+    return {
+        "model": LLM_MODEL,
+        "messages": [
+            {"role": "system", "content": "You are an intent classification expert. Always respond with valid JSON."},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": 150,
+        "temperature": 0.3,
+        "timeout": 20,
+    }
+
+
+def parse_intent_response(response, cache_key):
+    result = response.choices[0].message.content.strip()
     
-    if lead_info.get("phone"):
-        save_complete_order(sender_id, ad_id, lead_info, products_context)
-        
-        confirm_msg = f"Thank you dear! {lead_info.get('phone')} ekata call karanawa soon.\n\nDear 💙"
-        send_message(sender_id, confirm_msg, page_token)
-        save_message(sender_id, ad_id, "assistant", confirm_msg)
-        
-        if sender_id in user_states:
-            del user_states[sender_id]
+    try:
+        intent_data = json.loads(result)
+        if cache_key and isinstance(intent_data, dict) and intent_data.get("intent"):
+            # The key is only the message; entities come from the sender's context and catalog
+            intent_cache.put(cache_key, {"intent": intent_data["intent"], "confidence": intent_data.get("confidence", 0.5)})
+        return intent_data
+    except:
+        print(f"Failed to parse JSON: {result}", flush=True)
+        return dict(FALLBACK_INTENT)
+
+
+# ======================
+# Fast-path intent classifier
+# ======================
+
+FAST_INTENT_THRESHOLD = float(os.environ.get("FAST_INTENT_THRESHOLD", 0.85))
+
+# Keyword lists from INTENT_DEFINITIONS and check_agreement. Generic words from the
+# prompt ("ewanna", "dana", "kohomada") are left out - on their own they say nothing.
+FAST_INTENT_KEYWORDS = {
+    "total_price": ["sampura gana", "sampura", "total eka", "total", "සම්පූර්ණ ගාන", "සම්පූර්ණ"],
+    "dimensions": ["height", "width", "size", "adi", "uchayak", "usa", "uyathai", "dimension", "dimensions", "උස", "පළල"],
+    "delivery": ["delivery", "delivery eka", "courier", "charges", "chargers", "කරවන්න"],
+    "photos": ["photo", "photos", "pics", "pictures", "picture", "image", "images", "foto", "4to", "pintura", "පින්තූර"],
+    "details": ["details", "visthara", "specification", "specifications", "විස්තර", "info", "more info"],
+    "product_list": ["mona products", "products mona", "මොනවද"],
+    "product_availability": ["thiyanawada", "thiyanawa da", "available", "stock", "ithiri"],
+    "price_inquiry": ["how much", "kiyada", "gana", "ganang", "price", "ගාන", "කීයද", "ගාන කීයද"],
+    "how_to_order": ["how to order", "order karanne kohomada", "order karanna kohomada"],
+    "greeting": ["hello", "hi", "hey", "ayubowan", "ආයුබෝවන්"],
+    "agreement": ["yes", "ow", "හරි", "ඔව්", "ok", "oka", "එහෙනම්", "ඕනා", "කැමති", "kamathi", "hari", "okey", "okay"],
+    "disagreement": ["no", "nehe", "epa", "නැහැ", "එපා"],
+}
+
+# When both match, the key intent wins: "sampura gana" is total_price, "height kiyada" is dimensions
+FAST_INTENT_OVERRIDES = {
+    "total_price": {"price_inquiry", "delivery"},
+    "dimensions": {"price_inquiry"},
+    "product_list": {"product_availability"},
+}
+
+# Small-talk intents only count when the message is nothing but that
+FAST_WEAK_INTENTS = {"greeting", "agreement", "disagreement"}
+
+# Latin \b does not work for Sinhala (vowel signs are not \w), so spell the boundary out
+_WORD_CHAR = r"[\w\u0D80-\u0DFF]"
+FAST_INTENT_PATTERNS = {
+    intent: re.compile(
+        r"(?<!" + _WORD_CHAR + r")(?:"
+        + "|".join(re.escape(kw).replace(r"\ ", r"\s+") for kw in sorted(keywords, key=len, reverse=True))
+        + r")(?!" + _WORD_CHAR + r")"
+    )
+    for intent, keywords in FAST_INTENT_KEYWORDS.items()
+}
+
+fast_intent_stats = {"hits": 0, "fallthrough": 0}
+
+
+def classify_intent_fast(text):
+    """Keyword classifier run before the LLM. Returns intent data with a confidence, or None."""
+    text_lower = text.lower().strip()
+    words = len(text_lower.split())
+    if not words:
+        return None
+
+    matched = {intent for intent, pattern in FAST_INTENT_PATTERNS.items() if pattern.search(text_lower)}
+    strong = matched - FAST_WEAK_INTENTS
+    for intent, dominated in FAST_INTENT_OVERRIDES.items():
+        if intent in strong:
+            strong -= dominated
+
+    if strong:
+        candidates = strong
+        confidence = 0.95 if len(strong) == 1 else 0.6
+    elif matched:
+        candidates = matched
+        confidence = 0.9 if len(matched) == 1 and words <= 3 else 0.6
     else:
-        retry_msg = "Phone number ewanna.\n\nDear 💙"
-        send_message(sender_id, retry_msg, page_token)
-        save_message(sender_id, ad_id, "assistant", retry_msg)
+        return None
 
+    # Long messages usually say more than the keyword does
+    if words > 5:
+        confidence -= 0.05 * (words - 5)
 
-def extract_full_lead_info(text):
-    """Extract contact details from text"""
-    info = {}
+    entities = {}
+    product = extract_product_from_query(text)
+    if product:
+        entities["product"] = product
+
+    return {
+        "intent": sorted(candidates)[0],
+        "confidence": round(max(confidence, 0.0), 2),
+        "entities": entities,
+    }
 
+
+def detect_intent_fast_path(text):
+    """Fast-path result if it clears FAST_INTENT_THRESHOLD, else None (ask the LLM)"""
+    intent_data = classify_intent_fast(text)
+    if intent_data and intent_data["confidence"] >= FAST_INTENT_THRESHOLD:
+        fast_intent_stats["hits"] += 1
+        return intent_data
+
+    fast_intent_stats["fallthrough"] += 1
+    return None
+
+
+def extract_product_from_query(text):
+    """Extract specific product name from user query, using the catalog search index"""
+    catalog = get_cached_products()
+    if not catalog:
+        return None
+
+    return catalog.extract_product(text)
+
+
+def extract_phone_number(text):
+    """Extract phone number from text"""
     phone_patterns = [
         r"(0\d{9})",
         r"(\+94\d{9})",
@@ -1095,402 +2616,2453 @@ def extract_full_lead_info(text):
     for pattern in phone_patterns:
         match = re.search(pattern, text.replace(" ", "").replace("-", ""))
         if match:
-            info["phone"] = match.group(1)
-            break
+            return match.group(1)
+    return None
 
-    qty_patterns = [
-        r"(?:qty|quantity|keeyek)[:\s]*(\d+)",
-        r"(\d+)\s*(?:ekak|ganna|layer|tier)",
+
+def is_valid_location(text):
+    """Check if text is a valid Sri Lankan location"""
+    locations = [
+        "colombo", "kandy", "galle", "jaffna", "negombo", "matara", "kurunegala",
+        "anuradhapura", "trincomalee", "batticaloa", "ratnapura", "badulla", "ampara",
+        "hambantota", "kalutara", "kegalle", "kilinochchi", "mannar", "monaragala",
+        "mullaitivu", "nuwara eliya", "polonnaruwa", "puttalam", "vavuniya",
+        "homagama", "maharagama", "dehiwala", "mount lavinia", "moratuwa", "panadura",
+        "nugegoda", "kotte", "kaduwela", "kelaniya", "wattala", "ja-ela",
+        "road", "street", "lane", "town", "city", "gama", "watta"
     ]
-    for pattern in qty_patterns:
-        match = re.search(pattern, text.lower())
-        if match:
-            info["quantity"] = match.group(1)
-            break
+    
+    text_lower = text.lower()
+    
+    if any(loc in text_lower for loc in locations):
+        return True
+    
+    if len(text.split()) <= 3 and not any(word in text_lower for word in ["delivery", "order", "price", "photo", "kamathi", "kiyada", "kohamada", "thiyanawada"]):
+        return True
+    
+    return False
 
-    lines = [l.strip() for l in text.split("\n") if l.strip()]
-    for i, line in enumerate(lines):
-        if re.match(r"^[A-Z][a-z]+(\s+[A-Z][a-z]+)+$", line):
-            info["name"] = line[:50]
-            break
-        elif i == 0 and not re.search(r'\d{9}', line):
-            if re.match(r"^[A-Z][a-z]+", line):
-                info["name"] = line[:50]
-                break
 
-    address_lines = []
-    for i, line in enumerate(lines):
-        if any(ind in line.lower() for ind in ["no:", "no.", "road", "street", "colombo", "kandy", "galle"]):
-            address_lines.append(line)
-        elif i > 0 and not re.search(r'\d{9,10}', line.replace(" ", "")) and len(line) > 5:
-            if not re.match(r"^\d+$", line):
-                address_lines.append(line)
+# ======================
+# Context-aware handlers - ENHANCED
+# ======================
+
+def handle_total_price_inquiry(sender_id, user_text, products, page_token, ad_id, context, entities):
+    """Handle 'sampura gana' - total price with delivery"""
+    
+    specific_product = entities.get("product") or extract_product_from_query(user_text) or context.get("product_name")
+    
+    if specific_product and products:
+        product = next((p for p in products.find_all(specific_product) if p.price_value is not None), None)
+        
+        if product:
+            total_price = product.price_value + 350
+            
+            msg = f"{specific_product}:\nProduct: Rs.{product.price_value:,}\nDelivery: Rs.350\n━━━━━━━\nTotal: Rs.{total_price:,}\n\nDear 💙"
+            send_message(sender_id, msg, page_token)
+            save_message(sender_id, ad_id, "assistant", msg)
+            
+            if not context.get("asked_order"):
+                ask_to_order(sender_id, page_token, ad_id)
+            return
+    
+    # Generic response if no specific product
+    msg = "Product price + Delivery Rs.350 = Total\n\nMata product name ekak ewanna, total eka kiyanna.\n\nDear 💙"
+    send_message(sender_id, msg, page_token)
+    save_message(sender_id, ad_id, "assistant", msg)
+
+
+def handle_dimensions_request(sender_id, user_text, products, page_token, ad_id, context, entities):
+    """Handle dimension requests - height, width, size"""
+    
+    specific_product = entities.get("product") or extract_product_from_query(user_text) or context.get("product_name")
+    
+    if products:
+        product = products.find(specific_product) if specific_product else None
+        
+        if product:
+            msg = f"Mehenna {specific_product} dimensions:\n\n{product.dimensions_text}\n\nDear 💙"
+        else:
+            msg = f"Dimensions:\n\n{products.text}\n\nDear 💙"
+        
+        send_message(sender_id, msg, page_token)
+        save_message(sender_id, ad_id, "assistant", msg)
+        
+        if not context.get("asked_order"):
+            ask_to_order(sender_id, page_token, ad_id)
+    else:
+        msg = "Dimensions nehe dear.\n\nDear 💙"
+        send_message(sender_id, msg, page_token)
+        save_message(sender_id, ad_id, "assistant", msg)
+
+
+def handle_price_inquiry(sender_id, user_text, products, page_token, ad_id, context, entities):
+    """Handle 'how much', 'gana kiyada', price questions"""
+    
+    specific_product = entities.get("product") or extract_product_from_query(user_text) or context.get("product_name")
+    
+    if specific_product and products:
+        filtered_products = products.find_all(specific_product)
+        
+        if filtered_products:
+            msg = f"Mehenna {specific_product} price:\n\n" + "\n".join(p.price_line for p in filtered_products) + "\n\nDear 💙"
+        else:
+            msg = f"Mehenna prices:\n\n{products.text}\n\nDear 💙"
+    elif products:
+        msg = f"Mehenna prices:\n\n{products.text}\n\nDear 💙"
+    else:
+        msg = "Mata product name ekak ewanna, price kiyanna.\n\nDear 💙"
+    
+    send_message(sender_id, msg, page_token)
+    save_message(sender_id, ad_id, "assistant", msg)
+    
+    if not context.get("asked_order"):
+        ask_to_order(sender_id, page_token, ad_id)
+
+
+def handle_product_list_request(sender_id, products, page_token, ad_id, context):
+    """Handle 'mona products thiyanada' - show ALL products"""
+    
+    if not products:
+        msg = "Mata minute ekak wait karanna, products load karanawa.\n\nDear 💙"
+        send_message(sender_id, msg, page_token)
+        save_message(sender_id, ad_id, "assistant", msg)
+        return
+    
+    msg = f"Mehenna ape products:\n\n{products.text}\n\nDear 💙"
+    send_message(sender_id, msg, page_token)
+    save_message(sender_id, ad_id, "assistant", msg)
+    
+    if products.images:
+        send_images(sender_id, list(products.images[:10]), page_token)
+    
+    if not context.get("asked_order"):
+        ask_to_order(sender_id, page_token, ad_id)
+
+
+def handle_availability_request(sender_id, user_text, products, page_token, ad_id, context, entities):
+    """Handle 'thiyanawada' questions"""
+    
+    specific_product = entities.get("product") or extract_product_from_query(user_text) or context.get("product_name")
+    
+    if specific_product:
+        searched_products, searched_images = search_products_by_query(specific_product)
+        
+        if searched_products:
+            msg = f"Ow {specific_product} thiyanawa dear!\n\n{searched_products}\n\nDear 💙"
+            send_message(sender_id, msg, page_token)
+            save_message(sender_id, ad_id, "assistant", msg)
+            
+            if searched_images:
+                send_images(sender_id, searched_images[:10], page_token)
+            
+            if not context.get("asked_order"):
+                ask_to_order(sender_id, page_token, ad_id)
+            return
+        else:
+            msg = f"Nehe dear, {specific_product} nehe.\n\nDear 💙"
+            send_message(sender_id, msg, page_token)
+            save_message(sender_id, ad_id, "assistant", msg)
+            return
+    
+    if products:
+        msg = f"Ow thiyanawa dear!\n\n{products.text}\n\nDear 💙"
+    else:
+        msg = "Mata product name ekak ewanna dear.\n\nDear 💙"
+    
+    send_message(sender_id, msg, page_token)
+    save_message(sender_id, ad_id, "assistant", msg)
+    
+    if products and products.images:
+        send_images(sender_id, list(products.images[:10]), page_token)
+
+
+def handle_photo_request(sender_id, user_text, products, page_token, ad_id, context, entities):
+    """Handle photos - foto, 4to, pintura, pics"""
+    
+    specific_product = entities.get("product") or extract_product_from_query(user_text) or context.get("product_name")
+    
+    if specific_product and products:
+        product = next((p for p in products.find_all(specific_product) if p.images), None)
+        filtered_images = list(product.images) if product else []
+        
+        if filtered_images:
+            send_images(sender_id, filtered_images[:10], page_token)
+            
+            msg = f"Mehenna {specific_product} photos dear!\n\nDear 💙"
+            send_message(sender_id, msg, page_token)
+            save_message(sender_id, ad_id, "assistant", msg)
+            
+            if not context.get("asked_order"):
+                ask_to_order(sender_id, page_token, ad_id)
+            return
+    
+    if products and products.images:
+        send_images(sender_id, list(products.images[:10]), page_token)
+        
+        msg = "Mehenna photos dear!\n\nDear 💙"
+        send_message(sender_id, msg, page_token)
+        save_message(sender_id, ad_id, "assistant", msg)
+        
+        if not context.get("asked_order"):
+            ask_to_order(sender_id, page_token, ad_id)
+    else:
+        msg = "Photos nehe dear, mata message karanna.\n\nDear 💙"
+        send_message(sender_id, msg, page_token)
+        save_message(sender_id, ad_id, "assistant", msg)
+
+
+def handle_delivery_request(sender_id, page_token, ad_id, context):
+    """Handle delivery charges"""
+    msg1 = "Delivery Rs.350 dear! Island-wide.\n\nDear 💙"
+    send_message(sender_id, msg1, page_token)
+    save_message(sender_id, ad_id, "assistant", msg1)
+    
+    if not context.get("asked_order"):
+        ask_to_order(sender_id, page_token, ad_id)
+
+
+def handle_details_request(sender_id, user_text, products, page_token, ad_id, context, entities):
+    """Handle details - visthara"""
+    
+    if products:
+        specific_product = entities.get("product") or extract_product_from_query(user_text)
+        
+        if not specific_product:
+            history = get_cached_conversation_history(sender_id, limit=5)
+            
+            for msg in reversed(history[-6:]):
+                if msg["role"] == "user":
+                    product_in_history = extract_product_from_query(msg["message"])
+                    if product_in_history:
+                        specific_product = product_in_history
+                        break
+        
+        if not specific_product and context.get("product_name"):
+            specific_product = context.get("product_name")
+        
+        product = products.find(specific_product) if specific_product else None
+        
+        if product:
+            msg = f"Mehenna {specific_product} details!\n\n{product.text}\n\nDear 💙"
+        else:
+            msg = f"Mehenna details!\n\n{products.text}\n\nDear 💙"
+        
+        send_message(sender_id, msg, page_token)
+        save_message(sender_id, ad_id, "assistant", msg)
+        
+        if not context.get("asked_order"):
+            ask_to_order(sender_id, page_token, ad_id)
+    else:
+        msg = "Details nehe dear, mata message karanna.\n\nDear 💙"
+        send_message(sender_id, msg, page_token)
+        save_message(sender_id, ad_id, "assistant", msg)
+
+
+def ask_to_order(sender_id, page_token, ad_id):
+    """Follow an answer with the order question, FOLLOW_UP_DELAY after it.
+    The delay is scheduled, so the caller does not wait for it."""
+    msg = "Order kamathi dha?\n\nDear 💙"
+    send_message(sender_id, msg, page_token, delay=FOLLOW_UP_DELAY)
+    save_message(sender_id, ad_id, "assistant", msg)
+    update_user_context(sender_id, asked_order=True)
+
+
+def handle_how_to_order(sender_id, page_token, ad_id):
+    """Handle 'how to order' questions"""
+    msg = "Order karanna:\n1. Product select karanna\n2. Location ewanna\n3. Name, address, phone ewanna\n\nMata message karanna dear!\n\nDear 💙"
+    send_message(sender_id, msg, page_token)
+    save_message(sender_id, ad_id, "assistant", msg)
+
+
+def get_fallback_response(text, products_context, intent):
+    """Fallback response"""
+    if products_context:
+        return f"Mehenna products:\n\n{products_context}\n\nDear 💙"
+    else:
+        return "Mata message karanna dear!\n\nDear 💙"
+
+
+def validate_reply_strict(reply, products_context, user_message):
+    """STRICT validation"""
+    
+    forbidden_words = [
+        "fridge", "refrigerator", "samsung", "lg", "microwave",
+        "gas cooker", "200l", "frost-free", "5 star", "warranty"
+    ]
+    
+    for word in forbidden_words:
+        if word in reply.lower():
+            if not products_context or word not in products_context.lower():
+                return {"valid": False, "reason": f"Mentioned forbidden product: {word}"}
+    
+    return {"valid": True, "reason": ""}
+
+
+# -------------
+# Helper functions
+# -------------
+
+def detect_contact_details(text):
+    """Detect if message contains phone number + other details"""
+    has_phone = bool(re.search(r'0\d{9}|94\d{9}|\+94\d{9}', text.replace(' ', '').replace('-', '')))
+    
+    address_indicators = ['no:', 'no.', 'road', 'street', 'colombo', 'kandy', 'galle', 'negombo', 'kurunegala', 'matara', 'anuradhapura']
+    has_address = any(indicator in text.lower() for indicator in address_indicators)
+    
+    has_name = bool(re.search(r'[A-Z][a-z]+\s+[A-Z][a-z]+', text))
+    
+    has_multiple_lines = len([l for l in text.split('\n') if l.strip()]) >= 2
+    
+    return has_phone and (has_address or has_name or has_multiple_lines)
+
+
+def check_agreement(text):
+    """Check if user agrees/says yes"""
+    agreement_keywords = [
+        "yes", "ow", "හරි", "ඔව්", "ok", "oka", "එහෙනම්",
+        "ඕනා", "කැමති", "kamathi", "hari", "okey", "okay"
+    ]
+    text_lower = text.lower()
+    return any(keyword in text_lower for keyword in agreement_keywords)
+
+
+def handle_contact_details(sender_id, text, page_token, ad_id, products):
+    """Handle when user sends complete contact details (legacy)"""
+    lead_info = extract_full_lead_info(text)
+    
+    if lead_info.get("phone"):
+        save_complete_order(sender_id, ad_id, lead_info, products)
+        
+        confirm_msg = f"Thank you dear! {lead_info.get('phone')} ekata call karanawa soon.\n\nDear 💙"
+        send_message(sender_id, confirm_msg, page_token)
+        save_message(sender_id, ad_id, "assistant", confirm_msg)
+        
+        reset_user_context(sender_id)
+    else:
+        retry_msg = "Phone number ewanna.\n\nDear 💙"
+        send_message(sender_id, retry_msg, page_token)
+        save_message(sender_id, ad_id, "assistant", retry_msg)
+
+
+def extract_full_lead_info(text):
+    """Extract contact details from text"""
+    info = {}
+
+    phone_patterns = [
+        r"(0\d{9})",
+        r"(\+94\d{9})",
+        r"(94\d{9})",
+    ]
+    for pattern in phone_patterns:
+        match = re.search(pattern, text.replace(" ", "").replace("-", ""))
+        if match:
+            info["phone"] = match.group(1)
+            break
+
+    qty_patterns = [
+        r"(?:qty|quantity|keeyek)[:\s]*(\d+)",
+        r"(\d+)\s*(?:ekak|ganna|layer|tier)",
+    ]
+    for pattern in qty_patterns:
+        match = re.search(pattern, text.lower())
+        if match:
+            info["quantity"] = match.group(1)
+            break
+
+    lines = [l.strip() for l in text.split("\n") if l.strip()]
+    for i, line in enumerate(lines):
+        if re.match(r"^[A-Z][a-z]+(\s+[A-Z][a-z]+)+$", line):
+            info["name"] = line[:50]
+            break
+        elif i == 0 and not re.search(r'\d{9}', line):
+            if re.match(r"^[A-Z][a-z]+", line):
+                info["name"] = line[:50]
+                break
+
+    address_lines = []
+    for i, line in enumerate(lines):
+        if any(ind in line.lower() for ind in ["no:", "no.", "road", "street", "colombo", "kandy", "galle"]):
+            address_lines.append(line)
+        elif i > 0 and not re.search(r'\d{9,10}', line.replace(" ", "")) and len(line) > 5:
+            if not re.match(r"^\d+$", line):
+                address_lines.append(line)
+
+    if address_lines:
+        info["address"] = " ".join(address_lines)[:200]
+
+    return info
+
+
+def save_complete_order(sender_id, ad_id, lead_info, products):
+    """Save order to Leads sheet"""
+    try:
+        product_name = "Order Placed"
+        if products and products.first_name:
+            product_name = products.first_name.strip()[:50]
+
+        if lead_info.get("quantity"):
+            product_name = f"{product_name} (Qty: {lead_info['quantity']})"
+
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        enqueue_sheet_row("Leads", [
+            sender_id,
+            ad_id or "",
+            lead_info.get("name", ""),
+            lead_info.get("address", ""),
+            lead_info.get("phone", ""),
+            product_name,
+            timestamp,
+            "ordered",
+        ])
+
+        print(f"✅ Saved order: {lead_info}", flush=True)
+
+    except Exception as e:
+        print(f"Error saving order: {e}", flush=True)
+
+
+# =========================
+# AI response generation
+# =========================
+
+SALES_ASSISTANT_PROMPT = """You are a friendly sales assistant for Social Mart Sri Lanka.
+
+LANGUAGE RULES:
+1. Use SIMPLE SINGLISH (2-4 words per sentence)
+2. Mix Sinhala/English naturally
+3. Keep SHORT (1-2 sentences)
+4. Always end with "Dear 💙"
+
+PRODUCT RULES:
+1. ONLY mention products in "AVAILABLE PRODUCTS"
+2. Use EXACT names and prices
+3. NEVER invent products
+
+CONTEXT AWARENESS:
+- If user asked about a product before, remember it
+- Don't repeat questions already asked
+- Be natural and conversational
+
+DON'T ask "Order kamathi dha?" in every message!
+
+"""
+
+# "combined" = one call returning intent + reply, "two_call" = detect_intent_with_ai then
+# get_ai_response, "ab" = combined for LLM_AB_COMBINED_PERCENT of senders
+LLM_TURN_MODE = os.environ.get("LLM_TURN_MODE", "combined")
+LLM_AB_COMBINED_PERCENT = int(os.environ.get("LLM_AB_COMBINED_PERCENT", 50))
+
+FALLBACK_INTENT = {"intent": "general", "confidence": 0.5, "entities": {}}
+
+
+def use_combined_llm_turn(sender_id):
+    """Which LLM path this sender gets; A/B buckets are stable per sender"""
+    if LLM_TURN_MODE == "ab":
+        return zlib.crc32(str(sender_id).encode()) % 100 < LLM_AB_COMBINED_PERCENT
+    return LLM_TURN_MODE == "combined"
+
+
+# Per-user context fields build_reply_prompt writes into the prompt. The response
+# cache keys on all of them, so add any new one here too.
+REPLY_PROMPT_CONTEXT_FIELDS = ("product_name", "location")
+
+
+def build_reply_prompt(products_context, context):
+    """System prompt for reply generation: sales rules + products + what we know about the user"""
+    system_prompt = SALES_ASSISTANT_PROMPT
+
+    if products_context:
+        system_prompt += f"\nAVAILABLE PRODUCTS:\n{products_context}\n"
+    
+    if context.get("product_name"):
+        system_prompt += f"\nCONTEXT: User is interested in {context['product_name']}"
+    if context.get("location"):
+        system_prompt += f"\nCONTEXT: User location is {context['location']}"
+
+    return system_prompt
+
+
+def finish_reply(reply):
+    if not reply.endswith("Dear 💙") and "Dear 💙" not in reply:
+        reply = reply + "\n\nDear 💙"
+    return reply
+
+
+# =========================
+# Response cache
+# =========================
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 500))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 1800))
+RESPONSE_CACHE_MAX_WORDS = int(os.environ.get("RESPONSE_CACHE_MAX_WORDS", 6))
+RESPONSE_CACHE_EMBEDDINGS = os.environ.get("RESPONSE_CACHE_EMBEDDINGS", "0") == "1"
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", 0.93))
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+EMOJI_RE = re.compile("[\U0001F000-\U0001FAFF\u2600-\u27BF\uFE0F\u200D]")
+PUNCTUATION_RE = re.compile(r"[^\w\s\u0D80-\u0DFF]")
+
+
+def normalize_message(text):
+    """Lowercase, drop emoji and punctuation, collapse whitespace"""
+    text = EMOJI_RE.sub(" ", text.lower())
+    text = PUNCTUATION_RE.sub(" ", text)
+    return " ".join(text.split())
+
+
+class ResponseCache:
+    """LRU + TTL cache of LLM replies, with optional embedding-similarity lookup.
+
+    Keys are (kind, normalized message, scope); scope holds everything else the
+    reply depends on, and similarity lookups only compare entries in the same scope.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key, embed=None):
+        """Exact lookup; on a miss, `embed()` (if given) supplies a vector for a similarity lookup.
+        Returns (value or None, embedding or None)."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry["created"] < self.ttl:
+                self._entries.move_to_end(key)
+                entry["hits"] += 1
+                self.stats["hits"] += 1
+                return entry["value"], None
+
+        embedding = embed() if embed else None
+
+        with self._lock:
+            if embedding is not None:
+                best_key, best_score = None, RESPONSE_CACHE_SIMILARITY
+                for other_key, other in self._entries.items():
+                    if other_key[0] != key[0] or other_key[2] != key[2] or other["embedding"] is None:
+                        continue
+                    if now - other["created"] >= self.ttl:
+                        continue
+                    score = sum(a * b for a, b in zip(embedding, other["embedding"]))
+                    if score >= best_score:
+                        best_key, best_score = other_key, score
+                if best_key is not None:
+                    entry = self._entries[best_key]
+                    self._entries.move_to_end(best_key)
+                    entry["hits"] += 1
+                    self.stats["semantic_hits"] += 1
+                    return entry["value"], embedding
+
+            self.stats["misses"] += 1
+            return None, embedding
+
+    def put(self, key, value, embedding=None):
+        with self._lock:
+            self._entries[key] = {"value": value, "created": time.time(), "hits": 0, "embedding": embedding}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats["invalidations"] += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self._entries)
+            # Counts only - keys are customer messages and may hold names or phone numbers
+            stats["top_hits"] = sorted((entry["hits"] for entry in self._entries.values()), reverse=True)[:10]
+            stats["entries_reused"] = sum(1 for entry in self._entries.values() if entry["hits"])
+        lookups = stats["hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["hits"] + stats["semantic_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+
+def get_response_cache_key(kind, user_message, products_context, context):
+    """Cache key for a reply, or None if the message is too long to be a repeat"""
+    normalized = normalize_message(user_message)
+    if not normalized or len(normalized.split()) > RESPONSE_CACHE_MAX_WORDS:
+        return None
+
+    products_hash = hashlib.sha1((products_context or "").encode()).hexdigest()[:16]
+    # Everything per-user that reaches the prompt, or one customer's reply is served to another
+    prompt_context = tuple(str(context.get(field) or "").strip().lower() for field in REPLY_PROMPT_CONTEXT_FIELDS)
+    scope = (products_hash, context.get("step") or "") + prompt_context
+    return (kind, normalized, scope)
+
+
+def get_message_embedding(normalized_message):
+    """Unit-length embedding for similarity lookups, or None if disabled/unavailable"""
+    if not RESPONSE_CACHE_EMBEDDINGS:
+        return None
+    try:
+        response = client.embeddings.create(model=EMBEDDING_MODEL, input=normalized_message, timeout=5)
+        vector = response.data[0].embedding
+        norm = sum(v * v for v in vector) ** 0.5
+        return [v / norm for v in vector] if norm else None
+    except Exception as e:
+        print(f"Embedding error: {e}", flush=True)
+        return None
+
+
+def lookup_cached_response(kind, user_message, products_context, context):
+    """(cached value or None, key, embedding) - key/embedding are reused to store the fresh value"""
+    key = get_response_cache_key(kind, user_message, products_context, context)
+    if key is None:
+        return None, None, None
+
+    cached, embedding = response_cache.get(key, lambda: get_message_embedding(key[1]))
+    if cached is not None:
+        print(f"✅ Using cached {kind} for '{key[1]}'", flush=True)
+    return cached, key, embedding
+
+
+# =========================
+# Intent cache
+# =========================
+
+INTENT_CACHE_SIZE = int(os.environ.get("INTENT_CACHE_SIZE", 2000))
+INTENT_CACHE_TTL = int(os.environ.get("INTENT_CACHE_TTL", 6 * 3600))
+INTENT_CACHE_KEY_LAST_TURN = os.environ.get("INTENT_CACHE_KEY_LAST_TURN", "0") == "1"
+
+# Part of every key, so editing the intent prompt retires old entries immediately
+INTENT_PROMPT_VERSION = hashlib.sha1((INTENT_DEFINITIONS + INTENT_EXAMPLES).encode()).hexdigest()[:12]
+
+# Sinhala script -> the Singlish spelling customers also use
+SINHALA_TRANSLITERATIONS = {
+    "ගාන": "gana",
+    "කීයද": "kiyada",
+    "ඔව්": "ow",
+    "හරි": "hari",
+    "කැමති": "kamathi",
+    "නැහැ": "nehe",
+    "එපා": "epa",
+    "ඕනා": "ona",
+    "එහෙනම්": "ehenam",
+    "පින්තූර": "photos",
+    "විස්තර": "visthara",
+    "උස": "usa",
+    "පළල": "palala",
+    "සම්පූර්ණ": "sampura",
+    "මොනවද": "monawada",
+    "තියෙනවද": "thiyanawada",
+    "ආයුබෝවන්": "ayubowan",
+}
+
+# Common Singlish spelling variants -> one spelling
+SINGLISH_VARIANTS = {
+    "kiyadha": "kiyada",
+    "kiyda": "kiyada",
+    "keeyada": "kiyada",
+    "thiyenawada": "thiyanawada",
+    "thiyanawadha": "thiyanawada",
+    "thiyanawda": "thiyanawada",
+    "tiyanawada": "thiyanawada",
+    "photo": "photos",
+    "pics": "photos",
+    "pic": "photos",
+    "foto": "photos",
+    "4to": "photos",
+    "okay": "ok",
+    "okey": "ok",
+    "oka": "ok",
+    "dha": "da",
+}
+
+REPEATED_CHAR_RE = re.compile(r"(.)\1{2,}")
+
+
+def fold_message(text):
+    """Normalize for intent caching: case, emoji, punctuation, script and spelling variants, whitespace"""
+    words = []
+    for word in normalize_message(text).split():
+        word = SINHALA_TRANSLITERATIONS.get(word, word)
+        word = REPEATED_CHAR_RE.sub(r"\1", word)  # "hiiii" -> "hi"
+        words.append(SINGLISH_VARIANTS.get(word, word))
+    return "".join(words)
+
+
+intent_cache = ResponseCache(INTENT_CACHE_SIZE, INTENT_CACHE_TTL)
+
+
+def get_intent_cache_key(user_message, history):
+    folded = fold_message(user_message)
+    if not folded:
+        return None
+
+    last_turn = ""
+    if INTENT_CACHE_KEY_LAST_TURN:
+        for msg in reversed(history or []):
+            if msg["role"] == "assistant":
+                last_turn = fold_message(msg["message"])
+                break
+
+    return ("intent", folded, (INTENT_PROMPT_VERSION, last_turn))
+
+
+def get_ai_turn(user_message, history, products_context, context):
+    """One OpenAI call that classifies the message and writes the reply together.
+
+    Returns the detect_intent_with_ai fields plus "reply" (None if the call failed,
+    in which case the caller can still fall back to get_ai_response).
+    """
+    cached, cache_key, embedding = lookup_cached_response("turn", user_message, products_context, context)
+    if cached is not None:
+        return dict(cached)
+
+    try:
+        response = client.chat.completions.create(**build_ai_turn_request(user_message, history, products_context, context))
+        return parse_ai_turn_response(response, cache_key, embedding)
+
+    except (ConnectionError, TimeoutError, httpx.ConnectError, httpx.TimeoutException) as e:
+        print(f"OpenAI turn connection error: {type(e).__name__} - {str(e)}", flush=True)
+        return dict(FALLBACK_INTENT, reply=None)
+    except Exception as e:
+        print(f"OpenAI turn error: {e}", flush=True)
+        return dict(FALLBACK_INTENT, reply=None)
+
+
+async def get_ai_turn_async(user_message, history, products_context, context):
+    """get_ai_turn on AsyncOpenAI, for the ASGI path"""
+    # The cache lookup may embed the message (a blocking HTTP call), so keep it off the loop
+    cached, cache_key, embedding = await asyncio.to_thread(
+        lookup_cached_response, "turn", user_message, products_context, context
+    )
+    if cached is not None:
+        return dict(cached)
+
+    try:
+        response = await async_client.chat.completions.create(**build_ai_turn_request(user_message, history, products_context, context))
+        return parse_ai_turn_response(response, cache_key, embedding)
+
+    except (ConnectionError, TimeoutError, httpx.ConnectError, httpx.TimeoutException) as e:
+        print(f"OpenAI turn connection error: {type(e).__name__} - {str(e)}", flush=True)
+        return dict(FALLBACK_INTENT, reply=None)
+    except Exception as e:
+        print(f"OpenAI turn error: {e}", flush=True)
+        return dict(FALLBACK_INTENT, reply=None)
+
+
+def build_ai_turn_request(user_message, history, products_context, context):
+    """chat.completions.create arguments for the combined intent + reply call"""
+    system_prompt = build_reply_prompt(products_context, context)
+    system_prompt += f"""
+
+TASK:
+Classify the user's last message and write your reply to it.
+
+{INTENT_DEFINITIONS}
+
+{INTENT_EXAMPLES}
+Respond ONLY with JSON:
+{{
+  "intent": "intent_name",
+  "confidence": 0.0-1.0,
+  "entities": {{
+    "product": "product name if mentioned",
+    "quantity": "number if mentioned"
+  }},
+  "reply": "your reply to the user, following the language and product rules"
+}}
+"""
+
+    return {
+        "model": LLM_MODEL,
+        "messages": build_chat_messages(system_prompt, history, user_message),
+        "max_tokens": 220,
+        "temperature": 0.3,
+        "response_format": {"type": "json_object"},
+        "timeout": 25,
+    }
+
+
+def parse_ai_turn_response(response, cache_key, embedding):
+    result = response.choices[0].message.content.strip()
+
+    try:
+        turn = json.loads(result)
+    except ValueError:
+        print(f"Failed to parse JSON: {result}", flush=True)
+        return dict(FALLBACK_INTENT, reply=None)
+
+    reply = str(turn.get("reply") or "").strip()
+    turn = {
+        "intent": turn.get("intent") or "general",
+        "confidence": turn.get("confidence", 0.5),
+        "entities": turn.get("entities") or {},
+        "reply": finish_reply(reply) if reply else None,
+    }
+    if cache_key and turn["reply"]:
+        response_cache.put(cache_key, turn, embedding)
+    return dict(turn)
+
+
+def build_chat_messages(system_prompt, history, user_message):
+    messages = [{"role": "system", "content": system_prompt}]
+
+    for msg in history[-12:]:
+        messages.append({"role": msg["role"], "content": msg["message"]})
+
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+def get_ai_response(user_message, history, products_context, product_images, sender_id, ad_id, context):
+    """Generate AI response with context awareness"""
+    cached, cache_key, embedding = lookup_cached_response("reply", user_message, products_context, context)
+    if cached is not None:
+        return cached
+
+    try:
+        response = client.chat.completions.create(**build_ai_response_request(user_message, history, products_context, context))
+        return parse_ai_response(response, cache_key, embedding)
+
+    except (ConnectionError, TimeoutError, httpx.ConnectError, httpx.TimeoutException) as e:
+        print(f"OpenAI connection error: {type(e).__name__} - {str(e)}", flush=True)
+        return "Sorry dear, issue ekak.\n\nDear 💙"
+    except Exception as e:
+        print(f"OpenAI error: {e}", flush=True)
+        return "Sorry dear, issue ekak.\n\nDear 💙"
+
+
+async def get_ai_response_async(user_message, history, products_context, product_images, sender_id, ad_id, context):
+    """get_ai_response on AsyncOpenAI, for the ASGI path"""
+    cached, cache_key, embedding = await asyncio.to_thread(
+        lookup_cached_response, "reply", user_message, products_context, context
+    )
+    if cached is not None:
+        return cached
+
+    try:
+        response = await async_client.chat.completions.create(**build_ai_response_request(user_message, history, products_context, context))
+        return parse_ai_response(response, cache_key, embedding)
+
+    except (ConnectionError, TimeoutError, httpx.ConnectError, httpx.TimeoutException) as e:
+        print(f"OpenAI connection error: {type(e).__name__} - {str(e)}", flush=True)
+        return "Sorry dear, issue ekak.\n\nDear 💙"
+    except Exception as e:
+        print(f"OpenAI error: {e}", flush=True)
+        return "Sorry dear, issue ekak.\n\nDear 💙"
+
+
+def build_ai_response_request(user_message, history, products_context, context):
+    return {
+        "model": LLM_MODEL,
+        "messages": build_chat_messages(build_reply_prompt(products_context, context), history, user_message),
+        "max_tokens": 60,
+        "temperature": 0.3,
+        "timeout": 25,
+    }
+
+
+def parse_ai_response(response, cache_key, embedding):
+    reply = finish_reply(response.choices[0].message.content.strip())
+
+    if cache_key:
+        response_cache.put(cache_key, reply, embedding)
+    return reply
+
+
+# =========================
+# Product data from sheets
+# =========================
+
+# Singlish spellings and plain-English variants customers use for catalog words
+SEARCH_SYNONYMS = {
+    "four": "4",
+    "three": "3",
+    "two": "2",
+    "five": "5",
+    "layer": "tier",
+    "layers": "tier",
+    "tiers": "tier",
+    "raka": "rack",
+    "rakka": "rack",
+    "reck": "rack",
+    "රාක්ක": "rack",
+    "clothes": "cloth",
+    "redi": "cloth",
+    "fold": "foldable",
+    "folding": "foldable",
+}
+
+SEARCH_TOKEN_RE = re.compile(r"[\w\u0D80-\u0DFF]+")
+DIGIT_LETTER_RE = re.compile(r"(\d)([a-z])")
+
+
+def tokenize_search_text(text):
+    """Lowercased, synonym-folded, de-pluralized tokens ("4Tier Racks" -> ["4", "tier", "rack"])"""
+    text = DIGIT_LETTER_RE.sub(r"\1 \2", str(text or "").lower())
+    tokens = []
+    for word in SEARCH_TOKEN_RE.findall(text):
+        word = SEARCH_SYNONYMS.get(word, word)
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def get_trigrams(token):
+    padded = f"${token}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    """Optimal string alignment distance (a transposition counts as one edit), capped at limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class SearchResult:
+    __slots__ = ("product", "score", "matched")
+
+    def __init__(self, product, score, matched):
+        self.product = product
+        self.score = score
+        self.matched = matched
+
+
+class ProductSearchIndex:
+    """Token inverted index over product names and details with trigram fuzzy matching.
+
+    A product only matches if the query hits its name; details hits just rank.
+    """
+
+    NAME_WEIGHT = 3.0
+    DETAILS_WEIGHT = 1.0
+    FUZZY_FACTOR = 0.7
+
+    def __init__(self, products):
+        self.products = products
+        self.name_index = {}
+        self.details_index = {}
+        self.trigram_index = {}
+
+        for idx, product in enumerate(products):
+            for token in set(tokenize_search_text(product.name)):
+                self.name_index.setdefault(token, []).append(idx)
+            for token in set(tokenize_search_text(product.details)):
+                self.details_index.setdefault(token, []).append(idx)
+
+        for token in set(self.name_index) | set(self.details_index):
+            if len(token) >= 3:
+                for trigram in get_trigrams(token):
+                    self.trigram_index.setdefault(trigram, set()).add(token)
+
+    def resolve(self, token):
+        """Vocabulary tokens a query token stands for, with a match factor (1.0 = exact)"""
+        if token in self.name_index or token in self.details_index:
+            return [(token, 1.0)]
+        if len(token) < 3:
+            return []
+
+        max_distance = 1 if len(token) <= 4 else 2
+        candidates = set()
+        for trigram in get_trigrams(token):
+            candidates |= self.trigram_index.get(trigram, set())
+
+        matches = []
+        for candidate in candidates:
+            distance = edit_distance(token, candidate, max_distance)
+            if distance <= max_distance:
+                factor = self.FUZZY_FACTOR * (1 - distance / max(len(token), len(candidate)))
+                matches.append((candidate, factor))
+        return matches
+
+    def search(self, query, names_only=False):
+        """Ranked SearchResults, best first.
+
+        names_only is for spotting a product in an ordinary message, where a fuzzy
+        hit is usually just another word ("back" ~ "rack", "close" ~ "cloth"): it
+        matches name words exactly, and a bare number ("Colombo 3") never counts.
+        """
+        scores = {}
+        matched = {}
+
+        for token in set(tokenize_search_text(query)):
+            if names_only:
+                resolved = [(token, 1.0)] if token in self.name_index else []
+            else:
+                resolved = self.resolve(token)
+            for vocab_token, factor in resolved:
+                for idx in self.name_index.get(vocab_token, ()):
+                    scores[idx] = scores.get(idx, 0.0) + self.NAME_WEIGHT * factor
+                    matched.setdefault(idx, set()).add(vocab_token)
+                if not names_only:
+                    for idx in self.details_index.get(vocab_token, ()):
+                        scores[idx] = scores.get(idx, 0.0) + self.DETAILS_WEIGHT * factor
+
+        results = []
+        for idx, tokens in matched.items():
+            if names_only and all(token.isdigit() for token in tokens):
+                continue
+            # Prefer products whose whole name was asked for ("4 tier" over "3 tier" for "4 tier rack")
+            name_tokens = set(tokenize_search_text(self.products[idx].name))
+            coverage = len(tokens & name_tokens) / len(name_tokens) if name_tokens else 0.0
+            results.append(SearchResult(self.products[idx], round(scores[idx] + coverage, 4), tokens))
+
+        results.sort(key=lambda r: -r.score)
+        return results
+
+
+PRICE_NUMBER_RE = re.compile(r"\d[\d,]*")
+DIMENSION_LINE_RE = re.compile(
+    r"\d\s*(?:cm|mm|m|ft|feet|inch|inches|in|\"|')\b|\d\s*[x×]\s*\d|height|width|length|depth|size|dimension",
+    re.IGNORECASE,
+)
+
+
+class Product:
+    """One product_{i}_* group from an Ad_Products row"""
+
+    __slots__ = ("name", "name_lower", "price", "price_value", "details", "dimensions", "images", "text")
+
+    def __init__(self, name, price, details, images):
+        self.name = name
+        self.name_lower = name.lower()
+        self.price = price
+        self.details = details
+        self.images = images
+        self.text = f"{name} - {price}" + (f"\n{details}" if details else "")
+
+        # Numeric price and measurement lines, parsed once instead of regexed out of rendered text
+        price_match = PRICE_NUMBER_RE.search(str(price or ""))
+        self.price_value = int(price_match.group().replace(",", "")) if price_match else None
+        detail_lines = [line.strip() for line in str(details or "").splitlines() if line.strip()]
+        self.dimensions = tuple(line for line in detail_lines if DIMENSION_LINE_RE.search(line)) or tuple(detail_lines)
+
+    @property
+    def price_line(self):
+        return f"{self.name} - {self.price}"
+
+    @property
+    def dimensions_text(self):
+        return "\n".join((self.price_line,) + self.dimensions)
+
+
+class ProductList:
+    """An ordered set of products with its preformatted context text"""
+
+    __slots__ = ("products", "text", "images")
+
+    def __init__(self, products, images=None):
+        self.products = products
+        self.text = "\n\n".join(p.text for p in products)
+        self.images = tuple(img for p in products for img in p.images) if images is None else images
+
+    def __bool__(self):
+        return bool(self.products)
+
+    def find_all(self, product_keyword):
+        """Products whose name contains the keyword (e.g. "rack" or "4 tier rack")"""
+        keyword = str(product_keyword or "").lower()
+        if not keyword:
+            return []
+        return [p for p in self.products if keyword in p.name_lower]
+
+    def find(self, product_keyword):
+        matches = self.find_all(product_keyword)
+        return matches[0] if matches else None
+
+    @property
+    def first_name(self):
+        return self.products[0].name if self.products else None
+
+
+class Catalog:
+    """Immutable snapshot of Ad_Products, built once per refresh.
+
+    Rows are parsed and context strings formatted here, so per-message lookups
+    are dict hits instead of walks over product_{i}_* keys.
+    """
+
+    __slots__ = (
+        "products", "by_ad", "by_name", "images", "image_urls", "all",
+        "search_index", "_extract_lookups",
+    )
+
+    MAX_PRODUCTS_PER_ROW = 5
+    MAX_IMAGES_PER_PRODUCT = 3
+    _MISSING = object()
+
+    def __init__(self, records):
+        by_ad = {}
+        by_name = {}
+        images = []
+
+        for row in records:
+            row_products = []
+            for i in range(1, self.MAX_PRODUCTS_PER_ROW + 1):
+                name = row.get(f"product_{i}_name")
+                if not name:
+                    continue
+
+                product_images = tuple(
+                    img for img in (row.get(f"product_{i}_image_{n}") for n in range(1, self.MAX_IMAGES_PER_PRODUCT + 1))
+                    if img and str(img).startswith("http")
+                )
+                product = Product(str(name), row.get(f"product_{i}_price", ""), row.get(f"product_{i}_details", ""), product_images)
+                row_products.append(product)
+
+                # First occurrence wins, like the old "seen_products" walk
+                if product.name not in by_name:
+                    by_name[product.name] = product
+                    images.extend(img for img in product_images if img not in images)
+
+            by_ad.setdefault(str(row.get("ad_id")), ProductList(tuple(row_products)))
+
+        self.products = tuple(by_name.values())
+        self.by_ad = MappingProxyType(by_ad)
+        self.by_name = MappingProxyType(by_name)
+        self.images = tuple(images)
+        self.image_urls = frozenset(img for ad in by_ad.values() for img in ad.images)
+        self.all = ProductList(self.products, self.images[:20])
+        self.search_index = ProductSearchIndex(self.products)
+        self._extract_lookups = {}
+
+    def get_ad(self, ad_id):
+        return self.by_ad.get(str(ad_id))
+
+    def search(self, query, limit=5):
+        return [r.product for r in self.search_index.search(query)[:limit]]
+
+    def extract_product(self, text):
+        """Product keyword a message refers to: the product's name if one clearly wins,
+        else the name words the equally matched products share ("rack" for "racks thiyanawada")"""
+        # Shared by every request thread, which may clear() it at any time: one
+        # .get() is atomic, a membership test followed by a lookup is not
+        keyword = self._extract_lookups.get(text, self._MISSING)
+        if keyword is not self._MISSING:
+            return keyword
+
+        results = self.search_index.search(text, names_only=True)
+        keyword = None
+        if results:
+            top = results[0]
+            # Results hit by exactly the same words are indistinguishable to the customer
+            tied = [r for r in results if r.matched == top.matched]
+            if len(tied) == 1:
+                keyword = top.product.name_lower
+            else:
+                common = set.intersection(*(r.matched for r in tied))
+                keyword = self._longest_name_run(top.product.name_lower, common) or top.product.name_lower
+
+        if len(self._extract_lookups) > 1024:
+            self._extract_lookups.clear()
+        self._extract_lookups[text] = keyword
+        return keyword
+
+    @staticmethod
+    def _longest_name_run(name_lower, tokens):
+        """Longest run of consecutive words in the name whose tokens are all in `tokens`"""
+        best, run = [], []
+        for word in name_lower.split():
+            word_tokens = tokenize_search_text(word)
+            if word_tokens and all(t in tokens for t in word_tokens):
+                run.append(word)
+                if len(run) > len(best):
+                    best = list(run)
+            else:
+                run = []
+        return " ".join(best)
+
+
+def get_all_products():
+    """Get ALL products from all ads as a ProductList (None if unavailable)"""
+    try:
+        catalog = get_cached_products()
+        if not catalog:
+            return None
+
+        return catalog.all or None
+
+    except Exception as e:
+        print(f"Error getting all products: {e}", flush=True)
+        return None
+
+
+def get_products_for_ad(ad_id):
+    """Get the ProductList for a specific ad (None if unknown)"""
+    try:
+        catalog = get_cached_products()
+        if not catalog:
+            return None
+
+        return catalog.get_ad(ad_id) or None
+
+    except Exception as e:
+        print(f"Error getting products: {e}", flush=True)
+        return None
+
+
+def search_products_by_query(query):
+    """Search ALL products in sheet by query (ranked, typo-tolerant)"""
+    try:
+        catalog = get_cached_products()
+        if not catalog:
+            return None, []
+
+        found_products = catalog.search(query, limit=len(catalog.products))
+
+        if found_products:
+            products_text = "\n\n".join(p.text for p in found_products[:5])
+            found_images = [img for p in found_products for img in p.images]
+
+            print(f"✅ Found {len(found_products)} products", flush=True)
+            return products_text, found_images[:15]
+
+        return None, []
+
+    except Exception as e:
+        print(f"Error in search: {e}", flush=True)
+        return None, []
+
+
+# ================
+# Graph API client
+# ================
+
+GRAPH_CONNECT_TIMEOUT = float(os.environ.get("GRAPH_CONNECT_TIMEOUT", 5))
+GRAPH_READ_TIMEOUT = float(os.environ.get("GRAPH_READ_TIMEOUT", 20))
+GRAPH_MAX_RETRIES = int(os.environ.get("GRAPH_MAX_RETRIES", 3))
+GRAPH_MAX_RETRY_WAIT = float(os.environ.get("GRAPH_MAX_RETRY_WAIT", 30))
+GRAPH_POOL_SIZE = int(os.environ.get("GRAPH_POOL_SIZE", 10))
+
+# Graph error codes that mean "slow down" rather than "bad request"
+GRAPH_RATE_LIMIT_CODES = {4, 17, 32, 613}
+
+# Pacing for Send API calls per page, replacing fixed sleeps between messages
+GRAPH_SEND_RATE = float(os.environ.get("GRAPH_SEND_RATE", 10))
+GRAPH_SEND_BURST = int(os.environ.get("GRAPH_SEND_BURST", 5))
+
+IMAGE_UPLOAD_WORKERS = int(os.environ.get("IMAGE_UPLOAD_WORKERS", 8))
+IMAGE_PREWARM_WORKERS = int(os.environ.get("IMAGE_PREWARM_WORKERS", 2))  # catalog prewarm, kept off the customer pool
+
+# One keep-alive session per page token, so pages never share pools or throttling
+graph_sessions = {}
+graph_send_limiters = {}
+graph_throttled_until = {}
+graph_sessions_lock = threading.Lock()
+
+
+def get_graph_session(page_token):
+    with graph_sessions_lock:
+        session = graph_sessions.get(page_token)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=GRAPH_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.params = {"access_token": page_token}
+            graph_sessions[page_token] = session
+        return session
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` calls per second with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a slot and return how long to wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve a slot even if we have to wait for it, so waiters queue fairly
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_send_limiter(page_token):
+    with graph_sessions_lock:
+        limiter = graph_send_limiters.get(page_token)
+        if limiter is None:
+            limiter = RateLimiter(GRAPH_SEND_RATE, GRAPH_SEND_BURST)
+            graph_send_limiters[page_token] = limiter
+        return limiter
+
+
+def graph_post(page_token, path, payload):
+    """POST to the Graph API, retrying 5xx/429 and rate-limit errors. Returns the last response or None."""
+    url = f"https://graph.facebook.com/{GRAPH_API_VERSION}/{path}"
+    session = get_graph_session(page_token)
+    r = None
+
+    limiter = get_send_limiter(page_token)
+
+    for attempt in range(GRAPH_MAX_RETRIES + 1):
+        limiter.acquire()
+        wait = graph_throttled_until.get(page_token, 0) - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        try:
+            r = session.post(url, json=payload, timeout=(GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT))
+        except requests.exceptions.ConnectionError as e:
+            # Never reached Facebook, so retrying cannot double-send
+            if attempt == GRAPH_MAX_RETRIES:
+                print(f"Graph API connection error: {e}", flush=True)
+                return None
+            time.sleep(min(2 ** attempt, GRAPH_MAX_RETRY_WAIT))
+            continue
+        except requests.exceptions.Timeout as e:
+            print(f"Graph API timeout: {e}", flush=True)
+            return None
+
+        if not is_graph_retryable(r) or attempt == GRAPH_MAX_RETRIES:
+            return r
+
+        delay = get_graph_retry_delay(r, attempt)
+        if delay > GRAPH_MAX_RETRY_WAIT:
+            print(f"⚠️ Graph API rate limited for {delay:.0f}s, giving up", flush=True)
+            return r
+
+        print(f"⚠️ Graph API {r.status_code}, retrying in {delay:.1f}s", flush=True)
+        with graph_sessions_lock:
+            graph_throttled_until[page_token] = max(graph_throttled_until.get(page_token, 0), time.time() + delay)
+
+    return r
+
+
+def is_graph_retryable(r):
+    if r.status_code == 429 or r.status_code >= 500:
+        return True
+    if r.status_code >= 400:
+        try:
+            error = r.json().get("error", {})
+        except ValueError:
+            return False
+        return error.get("code") in GRAPH_RATE_LIMIT_CODES or bool(error.get("is_transient"))
+    return False
+
+
+def get_graph_retry_delay(r, attempt):
+    """Seconds to wait, from Retry-After or the usage headers, else exponential backoff"""
+    retry_after = r.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+
+    usage = r.headers.get("X-Business-Use-Case-Usage")
+    if usage:
+        try:
+            minutes = max(
+                entry.get("estimated_time_to_regain_access", 0)
+                for entries in json.loads(usage).values()
+                for entry in entries
+            )
+            if minutes:
+                return minutes * 60
+        except (ValueError, AttributeError, TypeError):
+            pass
+
+    return float(2 ** attempt)
+
+
+def send_image(recipient_id, image_url, page_token):
+    """Send image via Messenger"""
+    if not page_token:
+        return
+
+    payload = {
+        "recipient": {"id": recipient_id},
+        "message": {
+            "attachment": {
+                "type": "image",
+                "payload": {
+                    "url": image_url,
+                    "is_reusable": True,
+                },
+            }
+        },
+    }
+
+    r = graph_post(page_token, "me/messages", payload)
+    print(f"Send image: {r.status_code if r is not None else 'failed'}", flush=True)
+
+    # Sent with is_reusable, so keep the attachment_id for next time
+    if r is not None and r.status_code == 200:
+        try:
+            attachment_id = r.json().get("attachment_id")
+        except ValueError:
+            attachment_id = None
+        if attachment_id:
+            store_attachment_id(PAGE_ID_BY_TOKEN.get(page_token, ""), image_url, attachment_id)
+
+
+# Uploads for images a customer is waiting on. A KeyedExecutor (one lane per URL)
+# like the event workers, so it still takes work while atexit drains the outbound
+# lanes; catalog prewarm has its own smaller pool and never queues ahead of these.
+image_upload_lock = threading.Lock()
+image_upload_state = {"executor": None}
+attachment_prewarm_pool = ThreadPoolExecutor(max_workers=IMAGE_PREWARM_WORKERS, thread_name_prefix="attachment-prewarm")
+
+
+def get_image_upload_pool():
+    with image_upload_lock:
+        if image_upload_state["executor"] is None:
+            image_upload_state["executor"] = KeyedExecutor(IMAGE_UPLOAD_WORKERS, IMAGE_UPLOAD_WORKERS * 64, name="image-upload")
+        return image_upload_state["executor"]
+
+
+def shutdown_image_uploads():
+    """Called once the outbound lanes, the only callers, have drained"""
+    with image_upload_lock:
+        executor = image_upload_state["executor"]
+        image_upload_state["executor"] = None
+    if executor is not None:
+        executor.shutdown()
+
+
+def upload_image_attachment(image_url, page_token):
+    """Upload an image with the Attachment Upload API and return its attachment_id"""
+    payload = {
+        "message": {
+            "attachment": {
+                "type": "image",
+                "payload": {
+                    "url": image_url,
+                    "is_reusable": True,
+                },
+            }
+        },
+    }
+
+    r = graph_post(page_token, "me/message_attachments", payload)
+    if r is None or r.status_code != 200:
+        print(f"Image upload failed: {r.status_code if r is not None else 'no response'}", flush=True)
+        return None
+
+    try:
+        return r.json().get("attachment_id")
+    except ValueError:
+        return None
+
+
+def send_image_attachment(recipient_id, attachment_id, page_token):
+    """Send a previously uploaded image by attachment_id"""
+    payload = {
+        "recipient": {"id": recipient_id},
+        "message": {
+            "attachment": {
+                "type": "image",
+                "payload": {"attachment_id": attachment_id},
+            }
+        },
+    }
+
+    r = graph_post(page_token, "me/messages", payload)
+    print(f"Send image: {r.status_code if r is not None else 'failed'}", flush=True)
+    return r is not None and r.status_code == 200
+
+
+def send_images(recipient_id, image_urls, page_token):
+    """Send images in order: upload them all concurrently, then deliver one by one.
+
+    Facebook fetches and processes each image during upload, which is the slow
+    part, so doing that in parallel leaves only the quick sends sequential.
+    """
+    if not page_token or not image_urls:
+        return
+
+    outbox = reply_outbox.get()
+    if outbox is not None:
+        outbox.append(("images", recipient_id, list(image_urls), page_token, 0))
+        return
+
+    schedule_outbound(recipient_id, page_token, 0, deliver_images, recipient_id, list(image_urls), page_token)
+
+
+def deliver_images(recipient_id, image_urls, page_token):
+    attachment_ids = upload_attachments(image_urls, page_token)
+
+    for image_url, attachment_id in zip(image_urls, attachment_ids):
+        if attachment_id and send_image_attachment(recipient_id, attachment_id, page_token):
+            continue
+        if attachment_id:
+            # Facebook no longer knows this attachment - forget it and send by URL
+            evict_attachment_id(PAGE_ID_BY_TOKEN.get(page_token, ""), image_url)
+        send_image(recipient_id, image_url, page_token)
+
+
+def upload_attachments(image_urls, page_token):
+    """attachment_id (or None) for each image; the ones not cached yet upload concurrently"""
+    page_id = PAGE_ID_BY_TOKEN.get(page_token, "")
+    attachment_ids = [get_cached_attachment_id(page_id, url) for url in image_urls]
+    missing = [i for i, attachment_id in enumerate(attachment_ids) if not attachment_id]
+    if not missing:
+        return attachment_ids
+
+    done = threading.Semaphore(0)
+
+    def upload(i):
+        try:
+            attachment_ids[i] = get_or_upload_attachment(image_urls[i], page_token)
+        finally:
+            done.release()
+
+    for i in missing:
+        if not get_image_upload_pool().submit(image_urls[i], upload, i):
+            upload(i)  # pool full: upload on this lane instead
+    for _ in missing:
+        done.acquire()
+    return attachment_ids
+
+
+
+# Async twins of the calls above, used by the ASGI path. One AsyncClient per
+# page token, created on the serving event loop.
+graph_async_clients = {}
+
+
+def get_graph_async_client(page_token):
+    client = graph_async_clients.get(page_token)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            params={"access_token": page_token},
+            timeout=httpx.Timeout(GRAPH_READ_TIMEOUT, connect=GRAPH_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=GRAPH_POOL_SIZE, max_keepalive_connections=GRAPH_POOL_SIZE),
+        )
+        graph_async_clients[page_token] = client
+    return client
+
+
+async def graph_post_async(page_token, path, payload):
+    """graph_post without blocking the event loop; same retry and throttling rules"""
+    url = f"https://graph.facebook.com/{GRAPH_API_VERSION}/{path}"
+    client = get_graph_async_client(page_token)
+    r = None
+
+    limiter = get_send_limiter(page_token)
+
+    for attempt in range(GRAPH_MAX_RETRIES + 1):
+        wait = max(limiter.reserve(), graph_throttled_until.get(page_token, 0) - time.time())
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        try:
+            r = await client.post(url, json=payload)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            # Never reached Facebook, so retrying cannot double-send
+            if attempt == GRAPH_MAX_RETRIES:
+                print(f"Graph API connection error: {e}", flush=True)
+                return None
+            await asyncio.sleep(min(2 ** attempt, GRAPH_MAX_RETRY_WAIT))
+            continue
+        except httpx.TimeoutException as e:
+            print(f"Graph API timeout: {e}", flush=True)
+            return None
+
+        if not is_graph_retryable(r) or attempt == GRAPH_MAX_RETRIES:
+            return r
+
+        delay = get_graph_retry_delay(r, attempt)
+        if delay > GRAPH_MAX_RETRY_WAIT:
+            print(f"⚠️ Graph API rate limited for {delay:.0f}s, giving up", flush=True)
+            return r
+
+        print(f"⚠️ Graph API {r.status_code}, retrying in {delay:.1f}s", flush=True)
+        with graph_sessions_lock:
+            graph_throttled_until[page_token] = max(graph_throttled_until.get(page_token, 0), time.time() + delay)
+
+    return r
+
+
+async def send_message_async(recipient_id, text, page_token):
+    if not page_token:
+        return
+
+    payload = {
+        "recipient": {"id": recipient_id},
+        "message": {"text": text},
+    }
+
+    r = await graph_post_async(page_token, "me/messages", payload)
+    print(f"Send message: {r.status_code if r is not None else 'failed'}", flush=True)
+
+
+async def send_sender_action_async(recipient_id, action, page_token):
+    if not page_token:
+        return
+
+    payload = {
+        "recipient": {"id": recipient_id},
+        "sender_action": action,
+    }
+
+    r = await graph_post_async(page_token, "me/messages", payload)
+    if r is None or r.status_code != 200:
+        print(f"Sender action {action}: {r.status_code if r is not None else 'failed'}", flush=True)
+
+
+async def send_image_async(recipient_id, image_url, page_token):
+    payload = {
+        "recipient": {"id": recipient_id},
+        "message": {
+            "attachment": {
+                "type": "image",
+                "payload": {
+                    "url": image_url,
+                    "is_reusable": True,
+                },
+            }
+        },
+    }
+
+    r = await graph_post_async(page_token, "me/messages", payload)
+    print(f"Send image: {r.status_code if r is not None else 'failed'}", flush=True)
 
-    if address_lines:
-        info["address"] = " ".join(address_lines)[:200]
+    if r is not None and r.status_code == 200:
+        try:
+            attachment_id = r.json().get("attachment_id")
+        except ValueError:
+            attachment_id = None
+        if attachment_id:
+            store_attachment_id(PAGE_ID_BY_TOKEN.get(page_token, ""), image_url, attachment_id)
 
-    return info
 
+async def get_or_upload_attachment_async(image_url, page_token):
+    page_id = PAGE_ID_BY_TOKEN.get(page_token, "")
+    attachment_id = get_cached_attachment_id(page_id, image_url)
+    if attachment_id:
+        return attachment_id
+
+    payload = {
+        "message": {
+            "attachment": {
+                "type": "image",
+                "payload": {
+                    "url": image_url,
+                    "is_reusable": True,
+                },
+            }
+        },
+    }
+
+    r = await graph_post_async(page_token, "me/message_attachments", payload)
+    if r is None or r.status_code != 200:
+        print(f"Image upload failed: {r.status_code if r is not None else 'no response'}", flush=True)
+        return None
 
-def save_complete_order(sender_id, ad_id, lead_info, products_context):
-    """Save order to Leads sheet"""
     try:
-        sheet = get_sheet()
-        if not sheet:
-            return
+        attachment_id = r.json().get("attachment_id")
+    except ValueError:
+        return None
+    if attachment_id:
+        store_attachment_id(page_id, image_url, attachment_id)
+    return attachment_id
 
-        leads_sheet = sheet.worksheet("Leads")
 
-        product_name = "Order Placed"
-        if products_context:
-            lines = products_context.split("\n")
-            for line in lines:
-                if line.strip() and " - " in line:
-                    product_name = line.strip().split(" - ")[0][:50]
-                    break
+async def send_images_async(recipient_id, image_urls, page_token):
+    """send_images on the event loop: concurrent uploads, then in-order sends"""
+    if not page_token or not image_urls:
+        return
 
-        if lead_info.get("quantity"):
-            product_name = f"{product_name} (Qty: {lead_info['quantity']})"
+    attachment_ids = await asyncio.gather(*(get_or_upload_attachment_async(url, page_token) for url in image_urls))
 
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for image_url, attachment_id in zip(image_urls, attachment_ids):
+        if attachment_id:
+            payload = {
+                "recipient": {"id": recipient_id},
+                "message": {"attachment": {"type": "image", "payload": {"attachment_id": attachment_id}}},
+            }
+            r = await graph_post_async(page_token, "me/messages", payload)
+            print(f"Send image: {r.status_code if r is not None else 'failed'}", flush=True)
+            if r is not None and r.status_code == 200:
+                continue
+            evict_attachment_id(PAGE_ID_BY_TOKEN.get(page_token, ""), image_url)
+        await send_image_async(recipient_id, image_url, page_token)
 
-        leads_sheet.append_row([
-            sender_id,
-            ad_id or "",
-            lead_info.get("name", ""),
-            lead_info.get("address", ""),
-            lead_info.get("phone", ""),
-            product_name,
-            timestamp,
-            "ordered",
-        ])
+# =====================
+# Attachment ID cache
+# =====================
 
-        print(f"✅ Saved order: {lead_info}", flush=True)
+# (page_id, image_url) -> attachment_id, backed by the image_attachments table
+attachment_cache = {}
+attachment_cache_lock = threading.Lock()
+attachment_cache_state = {"loaded": False}
+attachment_prewarm_lock = threading.Lock()
 
-    except Exception as e:
-        print(f"Error saving order: {e}", flush=True)
 
+def load_attachment_cache():
+    with attachment_cache_lock:
+        if attachment_cache_state["loaded"]:
+            return
+        try:
+            rows = get_db().execute("SELECT page_id, image_url, attachment_id FROM image_attachments").fetchall()
+        except sqlite3.Error as e:
+            print(f"Error loading attachment cache: {e}", flush=True)
+            rows = []
+        for page_id, image_url, attachment_id in rows:
+            attachment_cache[(page_id, image_url)] = attachment_id
+        attachment_cache_state["loaded"] = True
+
+
+def get_cached_attachment_id(page_id, image_url):
+    """Memory first, then image_attachments: another worker may have uploaded it since we loaded"""
+    load_attachment_cache()
+    attachment_id = attachment_cache.get((page_id, image_url))
+    if attachment_id:
+        return attachment_id
 
-# =========================
-# AI response generation
-# =========================
+    try:
+        row = get_db().execute(
+            "SELECT attachment_id FROM image_attachments WHERE page_id = ? AND image_url = ?", (page_id, image_url)
+        ).fetchone()
+    except sqlite3.Error as e:
+        print(f"Error reading attachment id: {e}", flush=True)
+        return None
+    if row is None:
+        return None
+    with attachment_cache_lock:
+        attachment_cache[(page_id, image_url)] = row[0]
+    return row[0]
 
-def get_ai_response(user_message, history, products_context, product_images, sender_id, ad_id, context):
-    """Generate AI response with context awareness"""
+
+def store_attachment_id(page_id, image_url, attachment_id):
+    with attachment_cache_lock:
+        attachment_cache[(page_id, image_url)] = attachment_id
     try:
-        system_prompt = """You are a friendly sales assistant for Social Mart Sri Lanka.
+        get_db().execute(
+            """INSERT OR REPLACE INTO image_attachments (page_id, image_url, attachment_id, uploaded_at)
+               VALUES (?, ?, ?, ?)""",
+            (page_id, image_url, attachment_id, time.time()),
+        )
+    except sqlite3.Error as e:
+        print(f"Error saving attachment id: {e}", flush=True)
 
-LANGUAGE RULES:
-1. Use SIMPLE SINGLISH (2-4 words per sentence)
-2. Mix Sinhala/English naturally
-3. Keep SHORT (1-2 sentences)
-4. Always end with "Dear 💙"
 
-PRODUCT RULES:
-1. ONLY mention products in "AVAILABLE PRODUCTS"
-2. Use EXACT names and prices
-3. NEVER invent products
+def evict_attachment_id(page_id, image_url):
+    with attachment_cache_lock:
+        attachment_cache.pop((page_id, image_url), None)
+    try:
+        get_db().execute("DELETE FROM image_attachments WHERE page_id = ? AND image_url = ?", (page_id, image_url))
+    except sqlite3.Error as e:
+        print(f"Error evicting attachment id: {e}", flush=True)
 
-CONTEXT AWARENESS:
-- If user asked about a product before, remember it
-- Don't repeat questions already asked
-- Be natural and conversational
 
-DON'T ask "Order kamathi dha?" in every message!
+def get_or_upload_attachment(image_url, page_token):
+    """attachment_id for an image on this page, uploading it the first time"""
+    page_id = PAGE_ID_BY_TOKEN.get(page_token, "")
+    attachment_id = get_cached_attachment_id(page_id, image_url)
+    if attachment_id:
+        return attachment_id
 
-"""
+    attachment_id = upload_image_attachment(image_url, page_token)
+    if attachment_id:
+        store_attachment_id(page_id, image_url, attachment_id)
+    return attachment_id
 
-        if products_context:
-            system_prompt += f"\nAVAILABLE PRODUCTS:\n{products_context}\n"
-        
-        if context.get("product_name"):
-            system_prompt += f"\nCONTEXT: User is interested in {context['product_name']}"
-        if context.get("location"):
-            system_prompt += f"\nCONTEXT: User location is {context['location']}"
 
-        messages = [{"role": "system", "content": system_prompt}]
+def start_attachment_prewarm(image_urls):
+    threading.Thread(target=prewarm_attachments, args=(image_urls,), name="attachment-prewarm", daemon=True).start()
+
 
-        for msg in history[-12:]:
-            messages.append({"role": msg["role"], "content": msg["message"]})
+def prewarm_attachments(image_urls):
+    """After a catalog refresh: drop ids for images no longer in the sheet, upload the new ones"""
+    if not attachment_prewarm_lock.acquire(blocking=False):
+        return
+    try:
+        load_attachment_cache()
+
+        with attachment_cache_lock:
+            stale = [key for key in attachment_cache if key[1] not in image_urls]
+        for page_id, image_url in stale:
+            evict_attachment_id(page_id, image_url)
+
+        for page_id, page_token in PAGE_MAP.items():
+            missing = [url for url in image_urls if not get_cached_attachment_id(page_id, url)]
+            if missing:
+                uploaded = sum(1 for attachment_id in attachment_prewarm_pool.map(
+                    lambda url: get_or_upload_attachment(url, page_token), missing
+                ) if attachment_id)
+                print(f"📎 Pre-uploaded {uploaded}/{len(missing)} images", flush=True)
+
+        if stale:
+            print(f"📎 Evicted {len(stale)} stale attachment ids", flush=True)
+    except Exception as e:
+        print(f"Error pre-uploading images: {e}", flush=True)
+    finally:
+        attachment_prewarm_lock.release()
 
-        messages.append({"role": "user", "content": user_message})
 
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=60,
-            temperature=0.3,
-            timeout=25
-        )
+# ====================
+# Conversation logging
+# ====================
 
-        reply = response.choices[0].message.content.strip()
+HISTORY_IMPORT_JOB = "conversation_history_from_sheet"
+HISTORY_IMPORT_RETRY = float(os.environ.get("HISTORY_IMPORT_RETRY", 60))
 
-        if not reply.endswith("Dear 💙") and "Dear 💙" not in reply:
-            reply = reply + "\n\nDear 💙"
+history_import_lock = threading.Lock()
+history_import_state = {"started": False, "done": False}
+history_import_wakeup = threading.Event()
 
-        return reply
 
-    except (ConnectionError, TimeoutError, httpx.ConnectError, httpx.TimeoutException) as e:
-        print(f"OpenAI connection error: {type(e).__name__} - {str(e)}", flush=True)
-        return "Sorry dear, issue ekak.\n\nDear 💙"
+def save_message(sender_id, ad_id, role, message):
+    """Save to the local conversation store and mirror to the Conversations sheet"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    try:
+        cursor = get_db().execute(
+            "INSERT INTO messages (sender_id, ad_id, created_at, role, message) VALUES (?, ?, ?, ?, ?)",
+            (str(sender_id), str(ad_id or ""), timestamp, role, message),
+        )
+
+        # The sender lock keeps other workers out of this turn, so the ring stays complete
+        cached = conversation_cache.peek(sender_id)
+        if cached:
+            if role in ["user", "assistant"]:
+                cached[0].append({"role": role, "message": message})
+            cached[2] = cursor.lastrowid
+
     except Exception as e:
-        print(f"OpenAI error: {e}", flush=True)
-        return "Sorry dear, issue ekak.\n\nDear 💙"
+        print(f"Error saving message: {e}", flush=True)
 
+    enqueue_sheet_row("Conversations", [
+        sender_id,
+        ad_id or "",
+        timestamp,
+        role,
+        message,
+    ])
 
-# =========================
-# Product data from sheets
-# =========================
 
-def get_all_products():
-    """Get ALL products from all ads"""
+def load_recent_messages(sender_id, limit):
+    """Last `limit` user/assistant messages for a sender, oldest first"""
+    start_history_import()
     try:
-        records = get_cached_products()
-        if not records:
-            return None, []
+        # Imported sheet history is inserted after newer local rows, so order by time first
+        rows = get_db().execute(
+            """SELECT role, message FROM messages
+               WHERE sender_id = ? AND role IN ('user', 'assistant')
+               ORDER BY created_at DESC, id DESC LIMIT ?""",
+            (str(sender_id), limit),
+        ).fetchall()
+        return [{"role": role, "message": message} for role, message in reversed(rows)]
 
-        all_products_text = ""
-        all_images = []
-        seen_products = set()
+    except Exception as e:
+        print(f"Error loading history: {e}", flush=True)
+        return []
 
-        for row in records:
-            for i in range(1, 6):
-                name_key = f"product_{i}_name"
-                price_key = f"product_{i}_price"
-                details_key = f"product_{i}_details"
 
-                prod_name = row.get(name_key)
-                
-                if prod_name and prod_name not in seen_products:
-                    seen_products.add(prod_name)
-                    
-                    product_line = f"{prod_name} - {row.get(price_key, '')}"
-                    
-                    details = row.get(details_key, "")
-                    if details:
-                        product_line += f"\n{details}"
-                    
-                    all_products_text += product_line + "\n\n"
-
-                    for img_num in range(1, 4):
-                        image_key = f"product_{i}_image_{img_num}"
-                        img_url = row.get(image_key)
-                        if img_url and img_url.startswith("http") and img_url not in all_images:
-                            all_images.append(img_url)
-
-        return all_products_text.strip(), all_images[:20]
+def start_history_import():
+    """Import earlier conversations from the sheet once, in the background.
+    Until it finishes, senders only see the history stored locally."""
+    if history_import_state["started"]:
+        return
+    with history_import_lock:
+        if history_import_state["started"]:
+            return
+        history_import_state["started"] = True
+        threading.Thread(target=history_import_loop, name="history-import", daemon=True).start()
 
-    except Exception as e:
-        print(f"Error getting all products: {e}", flush=True)
-        return None, []
 
+def history_import_loop():
+    """Claim and run the import; retry after HISTORY_IMPORT_RETRY if it fails or
+    another worker holds the claim (it may die before finishing)"""
+    while not history_import_state["done"]:
+        try:
+            history_import_state["done"] = run_history_import()
+        except Exception as e:
+            print(f"Error importing conversation history: {e}", flush=True)
+        if history_import_state["done"] or history_import_wakeup.wait(HISTORY_IMPORT_RETRY):
+            return
 
-def get_products_for_ad(ad_id):
-    """Get products and images for specific ad"""
-    try:
-        records = get_cached_products()
-        if not records:
-            return None, []
 
-        for row in records:
-            if str(row.get("ad_id")) == str(ad_id):
-                products_text = ""
-                image_urls = []
-
-                for i in range(1, 6):
-                    name_key = f"product_{i}_name"
-                    price_key = f"product_{i}_price"
-                    details_key = f"product_{i}_details"
-
-                    if row.get(name_key):
-                        product_line = f"{row[name_key]} - {row.get(price_key, '')}"
-                        
-                        details = row.get(details_key, "")
-                        if details:
-                            product_line += f"\n{details}"
-                        
-                        products_text += product_line + "\n\n"
-
-                        for img_num in range(1, 4):
-                            image_key = f"product_{i}_image_{img_num}"
-                            if row.get(image_key):
-                                img_url = row[image_key]
-                                if img_url and img_url.startswith("http"):
-                                    image_urls.append(img_url)
-
-                return products_text.strip(), image_urls
+def run_history_import():
+    """Returns True once the import has completed (here or in another worker)"""
+    conn = get_db()
+    row = conn.execute("SELECT completed_at FROM backfill_jobs WHERE name = ?", (HISTORY_IMPORT_JOB,)).fetchone()
+    if row and row[0]:
+        return True
 
-        return None, []
+    now = time.time()
+    cur = conn.execute(
+        """INSERT INTO backfill_jobs (name, started_at) VALUES (?, ?)
+           ON CONFLICT (name) DO UPDATE SET started_at = excluded.started_at
+           WHERE completed_at IS NULL AND started_at < ?""",
+        (HISTORY_IMPORT_JOB, now, now - BACKFILL_CLAIM_TIMEOUT),
+    )
+    if cur.rowcount == 0:
+        return False
+
+    imported = None
+    try:
+        imported = import_history_from_sheet()
+    finally:
+        if imported is None:
+            # Release the claim so the next attempt (here or elsewhere) can run it
+            conn.execute("DELETE FROM backfill_jobs WHERE name = ? AND completed_at IS NULL", (HISTORY_IMPORT_JOB,))
+    return imported is not None
+
+
+def import_history_from_sheet():
+    """Copy the last CONVERSATION_RING_SIZE sheet messages of every sender into the
+    local store, skipping anything not older than what is already stored locally.
+    Returns the number of messages imported, or None if the sheet could not be read."""
+    conversations_sheet = get_worksheet("Conversations")
+    if not conversations_sheet:
+        return None
 
+    print("📥 Importing conversation history from sheet", flush=True)
+    try:
+        records = conversations_sheet.get_all_records()
     except Exception as e:
-        print(f"Error getting products: {e}", flush=True)
-        return None, []
+        print(f"Error reading Conversations sheet: {e}", flush=True)
+        return None
 
+    by_sender = {}
+    for record in records:
+        sender_id = str(record.get("sender_id") or "")
+        if sender_id and record.get("role") in ["user", "assistant"]:
+            by_sender.setdefault(sender_id, []).append(record)
+
+    conn = get_db()
+    earliest_local = dict(conn.execute("SELECT sender_id, MIN(created_at) FROM messages GROUP BY sender_id").fetchall())
+
+    rows = []
+    for sender_id, history in by_sender.items():
+        cutoff = earliest_local.get(sender_id)
+        if cutoff is not None:
+            history = [r for r in history if str(r.get("timestamp", "")) < cutoff]
+        rows.extend(
+            (sender_id, str(r.get("ad_id", "")), str(r.get("timestamp", "")), r["role"], str(r["message"]))
+            for r in history[-CONVERSATION_RING_SIZE:]
+        )
 
-def search_products_by_query(query):
-    """Search ALL products in sheet by query"""
+    conn.execute("BEGIN")
     try:
-        records = get_cached_products()
-        if not records:
-            return None, []
+        conn.executemany(
+            "INSERT INTO messages (sender_id, ad_id, created_at, role, message) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        conn.execute(
+            "UPDATE backfill_jobs SET completed_at = ?, rows = ? WHERE name = ?",
+            (time.time(), len(rows), HISTORY_IMPORT_JOB),
+        )
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
 
-        query_lower = query.lower()
-        keywords = re.findall(r'\w+', query_lower)
+    # Rings loaded before the import are missing the older messages
+    for sender_id in by_sender:
+        conversation_cache.pop(sender_id)
 
-        found_products = []
-        found_images = []
+    print(f"✅ Imported {len(rows)} messages for {len(by_sender)} senders from {len(records)} rows", flush=True)
+    return len(rows)
 
-        for row in records:
-            for i in range(1, 6):
-                name = str(row.get(f"product_{i}_name", "")).lower()
-                
-                if name:
-                    if any(kw in name for kw in keywords if len(kw) > 2):
-                        prod_name = row.get(f"product_{i}_name")
-                        prod_price = row.get(f"product_{i}_price")
-                        prod_details = row.get(f"product_{i}_details", "")
-
-                        if prod_name and prod_name not in [p["name"] for p in found_products]:
-                            found_products.append({
-                                "name": prod_name,
-                                "price": prod_price,
-                                "details": prod_details
-                            })
-
-                            for img_num in range(1, 4):
-                                img_url = row.get(f"product_{i}_image_{img_num}")
-                                if img_url and img_url.startswith("http"):
-                                    found_images.append(img_url)
 
-        if found_products:
-            products_text = ""
-            for prod in found_products[:5]:
-                products_text += f"{prod['name']} - {prod['price']}"
-                if prod['details']:
-                    products_text += f"\n{prod['details']}"
-                products_text += "\n\n"
+def shutdown_history_import():
+    history_import_wakeup.set()
 
-            print(f"✅ Found {len(found_products)} products", flush=True)
-            return products_text.strip(), found_images[:15]
 
-        return None, []
+def send_message(recipient_id, text, page_token, delay=0):
+    """Send text message (after `delay` seconds, without blocking the caller)"""
+    if not page_token:
+        return
 
-    except Exception as e:
-        print(f"Error in search: {e}", flush=True)
-        return None, []
+    outbox = reply_outbox.get()
+    if outbox is not None:
+        outbox.append(("text", recipient_id, text, page_token, delay))
+        return
 
+    schedule_outbound(recipient_id, page_token, delay, deliver_message, recipient_id, text, page_token)
 
-def send_image(recipient_id, image_url, page_token):
-    """Send image via Messenger"""
+
+def deliver_message(recipient_id, text, page_token):
+    payload = {
+        "recipient": {"id": recipient_id},
+        "message": {"text": text},
+    }
+
+    r = graph_post(page_token, "me/messages", payload)
+    print(f"Send message: {r.status_code if r is not None else 'failed'}", flush=True)
+
+
+def send_sender_action(recipient_id, action, page_token):
+    """typing_on / typing_off / mark_seen. Never goes through the outbox, but is
+    scheduled like a reply so it cannot overtake one."""
     if not page_token:
         return
 
-    url = f"https://graph.facebook.com/{GRAPH_API_VERSION}/me/messages"
-    params = {"access_token": page_token}
+    schedule_outbound(recipient_id, page_token, 0, deliver_sender_action, recipient_id, action, page_token)
+
+
+def deliver_sender_action(recipient_id, action, page_token):
     payload = {
         "recipient": {"id": recipient_id},
-        "message": {
-            "attachment": {
-                "type": "image",
-                "payload": {
-                    "url": image_url,
-                    "is_reusable": True,
-                },
-            }
-        },
+        "sender_action": action,
     }
 
-    r = requests.post(url, params=params, json=payload)
-    print(f"Send image: {r.status_code}", flush=True)
+    r = graph_post(page_token, "me/messages", payload)
+    if r is None or r.status_code != 200:
+        print(f"Sender action {action}: {r.status_code if r is not None else 'failed'}", flush=True)
 
 
-# ====================
-# Conversation logging
-# ====================
+# =====================
+# Ad attribution index
+# =====================
 
-def save_message(sender_id, ad_id, role, message):
-    """Save to Conversations sheet"""
+AD_ATTRIBUTION_BACKFILL = "ad_attribution_from_conversations"
+AD_ATTRIBUTION_RETRY = float(os.environ.get("AD_ATTRIBUTION_RETRY", 60))
+BACKFILL_CLAIM_TIMEOUT = 600  # a started backfill older than this belongs to a dead process
+
+# The newest sighting decides the ad; first_seen only ever moves earlier
+AD_ATTRIBUTION_UPSERT = """INSERT INTO ad_attribution (sender_id, ad_id, first_seen, last_seen) VALUES (?, ?, ?, ?)
+    ON CONFLICT (sender_id) DO UPDATE SET
+        first_seen = MIN(first_seen, excluded.first_seen),
+        ad_id = CASE WHEN excluded.last_seen >= last_seen THEN excluded.ad_id ELSE ad_id END,
+        last_seen = MAX(last_seen, excluded.last_seen)"""
+
+ad_attribution_lock = threading.Lock()
+ad_attribution_state = {"started": False, "done": False}
+ad_attribution_wakeup = threading.Event()
+
+
+def record_ad_attribution(sender_id, ad_id, seen_at=None):
+    """Remember which ad a sender came from"""
+    if not ad_id:
+        return
+    seen_at = seen_at or time.time()
     try:
-        sheet = get_sheet()
-        if not sheet:
-            return
+        get_db().execute(
+            AD_ATTRIBUTION_UPSERT,
+            (str(sender_id), str(ad_id), seen_at, seen_at),
+        )
+    except sqlite3.Error as e:
+        print(f"Error saving ad attribution: {e}", flush=True)
 
-        conversations_sheet = sheet.worksheet("Conversations")
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        conversations_sheet.append_row([
-            sender_id,
-            ad_id or "",
-            timestamp,
-            role,
-            message,
-        ])
+def get_user_ad_id(sender_id):
+    """Get ad_id for user from the local attribution index"""
+    try:
+        conn = get_db()
+        row = conn.execute("SELECT ad_id FROM ad_attribution WHERE sender_id = ?", (str(sender_id),)).fetchone()
+        if row:
+            return row[0]
+
+        # Senders from before the index existed show up once the backfill has run
+        start_ad_attribution_backfill()
+        return None
 
     except Exception as e:
-        print(f"Error saving message: {e}", flush=True)
+        print(f"Error getting ad_id: {e}", flush=True)
+        return None
 
 
-def get_conversation_history_from_sheet(sender_id, limit=30):
-    """Get conversation history FROM SHEET"""
-    try:
-        sheet = get_sheet()
-        if not sheet:
-            return []
+def start_ad_attribution_backfill():
+    """Build the index from the sheet once, in the background. Until it finishes,
+    senders that only the sheet knows about have no ad_id."""
+    if ad_attribution_state["started"]:
+        return
+    with ad_attribution_lock:
+        if ad_attribution_state["started"]:
+            return
+        ad_attribution_state["started"] = True
+        threading.Thread(target=ad_attribution_backfill_loop, name="ad-attribution-backfill", daemon=True).start()
 
-        conversations_sheet = sheet.worksheet("Conversations")
-        records = conversations_sheet.get_all_records()
 
-        user_messages = [r for r in records if str(r.get("sender_id")) == str(sender_id)]
-        user_messages = user_messages[-limit:]
+def ad_attribution_backfill_loop():
+    """Claim and run the backfill; retry after AD_ATTRIBUTION_RETRY if it fails or
+    another worker holds the claim (it may die before finishing)"""
+    while not ad_attribution_state["done"]:
+        try:
+            ad_attribution_state["done"] = run_ad_attribution_backfill()
+        except Exception as e:
+            print(f"Error backfilling ad attribution: {e}", flush=True)
+        if ad_attribution_state["done"] or ad_attribution_wakeup.wait(AD_ATTRIBUTION_RETRY):
+            return
+
+
+def run_ad_attribution_backfill():
+    """Returns True once the backfill has completed (here or in another worker)"""
+    conn = get_db()
+    row = conn.execute("SELECT completed_at FROM backfill_jobs WHERE name = ?", (AD_ATTRIBUTION_BACKFILL,)).fetchone()
+    if row and row[0]:
+        return True
+
+    now = time.time()
+    cur = conn.execute(
+        """INSERT INTO backfill_jobs (name, started_at) VALUES (?, ?)
+           ON CONFLICT (name) DO UPDATE SET started_at = excluded.started_at
+           WHERE completed_at IS NULL AND started_at < ?""",
+        (AD_ATTRIBUTION_BACKFILL, now, now - BACKFILL_CLAIM_TIMEOUT),
+    )
+    if cur.rowcount == 0:
+        return False
+    return backfill_ad_attribution()
+
+
+def shutdown_ad_attribution_backfill():
+    ad_attribution_wakeup.set()
+
 
-        return [
-            {"role": m["role"], "message": m["message"]}
-            for m in user_messages
-            if m["role"] in ["user", "assistant"]
-        ]
+def backfill_ad_attribution():
+    """One-time import of sender -> ad_id from the Conversations sheet"""
+    conversations_sheet = get_worksheet("Conversations")
+    if not conversations_sheet:
+        get_db().execute("DELETE FROM backfill_jobs WHERE name = ? AND completed_at IS NULL", (AD_ATTRIBUTION_BACKFILL,))
+        return False
 
+    print("📥 Backfilling ad attribution from Conversations sheet", flush=True)
+    try:
+        records = conversations_sheet.get_all_records()
     except Exception as e:
-        print(f"Error getting history: {e}", flush=True)
-        return []
+        print(f"Error backfilling ad attribution: {e}", flush=True)
+        get_db().execute("DELETE FROM backfill_jobs WHERE name = ? AND completed_at IS NULL", (AD_ATTRIBUTION_BACKFILL,))
+        return False
+
+    # Rows are in append order, so later rows overwrite earlier ones like the old reverse scan
+    attribution = {}
+    for position, record in enumerate(records):
+        sender_id = str(record.get("sender_id") or "")
+        ad_id = record.get("ad_id")
+        if not sender_id or not ad_id:
+            continue
+        try:
+            seen_at = datetime.strptime(str(record.get("timestamp")), "%Y-%m-%d %H:%M:%S").timestamp()
+        except ValueError:
+            seen_at = float(position)  # keeps row order for rows without a usable timestamp
+        previous = attribution.get(sender_id)
+        if previous:
+            attribution[sender_id] = (str(ad_id), min(previous[1], seen_at), max(previous[2], seen_at))
+        else:
+            attribution[sender_id] = (str(ad_id), seen_at, seen_at)
+
+    conn = get_db()
+    conn.execute("BEGIN")
+    try:
+        conn.executemany(
+            AD_ATTRIBUTION_UPSERT,
+            [(sender_id, ad_id, first_seen, last_seen) for sender_id, (ad_id, first_seen, last_seen) in attribution.items()],
+        )
+        conn.execute(
+            "UPDATE backfill_jobs SET completed_at = ?, rows = ? WHERE name = ?",
+            (time.time(), len(attribution), AD_ATTRIBUTION_BACKFILL),
+        )
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
 
+    print(f"✅ Backfilled ad attribution for {len(attribution)} senders from {len(records)} rows", flush=True)
+    return True
 
-def get_user_ad_id(sender_id):
-    """Get ad_id for user"""
+
+@app.cli.command("import-history")
+def import_history_command():
+    """Import earlier conversations from the Conversations sheet into the local store"""
+    get_db().execute("DELETE FROM backfill_jobs WHERE name = ?", (HISTORY_IMPORT_JOB,))
+    run_history_import()
+
+
+@app.cli.command("requeue-sheet-rows")
+def requeue_sheet_rows_command():
+    """Give dead-lettered Sheets rows another round of attempts"""
+    cursor = get_db().execute(
+        "UPDATE sheet_spool SET dead_at = NULL, attempts = 0, claimed_by = NULL, claimed_at = NULL WHERE dead_at IS NOT NULL"
+    )
+    print(f"Requeued {cursor.rowcount} rows", flush=True)
+
+
+@app.cli.command("backfill-attribution")
+def backfill_attribution_command():
+    """Rebuild the ad attribution index from the Conversations sheet"""
+    get_db().execute("DELETE FROM backfill_jobs WHERE name = ?", (AD_ATTRIBUTION_BACKFILL,))
+    run_ad_attribution_backfill()
+
+
+# =====================
+# ASYNC SERVING (ASGI)
+# =====================
+# ASYNC_MODE=1 (see gunicorn.conf.py) serves asgi_app on uvicorn workers, which
+# handles webhooks on an event loop: conversations wait on
+# OpenAI and Graph as coroutines instead of holding an event worker thread each.
+# Handlers are shared with the sync path; while a turn runs, send_message and
+# send_images append to reply_outbox and the loop delivers them afterwards.
+
+ASYNC_MAX_PENDING_EVENTS = int(os.environ.get("ASYNC_MAX_PENDING_EVENTS", 2000))
+ASYNC_MAX_CONCURRENT_EVENTS = int(os.environ.get("ASYNC_MAX_CONCURRENT_EVENTS", 500))
+
+reply_outbox = contextvars.ContextVar("reply_outbox", default=None)
+
+async_event_state = {"accepting": True, "semaphore": None}
+async_sender_tails = {}  # lane key -> task of that sender's latest event
+async_event_tasks = set()
+
+
+async def flush_reply_outbox(outbox):
+    """Deliver queued replies in order"""
+    while outbox:
+        kind, recipient_id, value, page_token, delay = outbox.pop(0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if kind == "text":
+            await send_message_async(recipient_id, value, page_token)
+        elif kind == "images":
+            await send_images_async(recipient_id, value, page_token)
+
+
+def enqueue_event_async(page_token, event):
+    """Schedule an event on the running loop, chained behind the same sender's previous event"""
+    if not async_event_state["accepting"] or len(async_event_tasks) >= ASYNC_MAX_PENDING_EVENTS:
+        with event_stats_lock:
+            event_stats["rejected"] += 1
+        return False
+
+    lane_key = get_lane_key(page_token, event)
+    if can_coalesce(event):
+        burst = join_burst(lane_key, event)
+        if burst is None:
+            return True
+        job = run_burst_async(page_token, lane_key, burst)
+    else:
+        job = process_event_async(page_token, event)
+
+    previous = async_sender_tails.get(lane_key)
+    task = asyncio.get_running_loop().create_task(run_event_async(lane_key, job, previous, time.time()))
+    async_sender_tails[lane_key] = task
+    async_event_tasks.add(task)
+
+    def forget(done):
+        async_event_tasks.discard(done)
+        if async_sender_tails.get(lane_key) is done:
+            del async_sender_tails[lane_key]
+
+    task.add_done_callback(forget)
+    with event_stats_lock:
+        event_stats["enqueued"] += 1
+        event_stats["max_queue_depth"] = max(event_stats["max_queue_depth"], len(async_event_tasks))
+    return True
+
+
+async def run_burst_async(page_token, lane_key, burst):
+    typing = burst_quiet_for(burst) > 0
+    if typing:
+        await send_sender_action_async(lane_key[1], "typing_on", page_token)
+    while (remaining := burst_quiet_for(burst)) > 0:
+        await asyncio.sleep(remaining)
+    await process_event_async(page_token, close_burst(lane_key, burst), typing=not typing)
+
+
+async def run_event_async(lane_key, job, previous, enqueued_at):
+    if previous is not None:
+        await asyncio.wait([previous])
+
+    if async_event_state["semaphore"] is None:
+        async_event_state["semaphore"] = asyncio.Semaphore(ASYNC_MAX_CONCURRENT_EVENTS)
+
+    async with async_event_state["semaphore"]:
+        wait = time.time() - enqueued_at
+        with event_stats_lock:
+            event_stats["last_wait"] = wait
+            event_stats["max_wait"] = max(event_stats["max_wait"], wait)
+
+        lock_fd = await acquire_sender_lock_async(lane_key)
+        try:
+            await job
+            with event_stats_lock:
+                event_stats["processed"] += 1
+        except Exception as e:
+            with event_stats_lock:
+                event_stats["failed"] += 1
+            print(f"Error processing event: {e}", flush=True)
+        finally:
+            release_sender_lock(lock_fd)
+
+
+async def process_event_async(page_token, event, typing=True):
+    """process_event for the ASGI path"""
+    sender_id = event["sender"]["id"]
+    outbox = []
+    token = reply_outbox.set(outbox)
     try:
-        sheet = get_sheet()
-        if not sheet:
-            return None
+        if "referral" in event:
+            ad_id = event["referral"].get("ref")
+            await asyncio.to_thread(handle_ad_referral, sender_id, ad_id, page_token)
+            await flush_reply_outbox(outbox)
+
+        if event.get("message") and "text" in event["message"]:
+            text = event["message"]["text"]
+            print(f"Message from {sender_id}: {text}", flush=True)
+
+            if typing:
+                await send_sender_action_async(sender_id, "typing_on", page_token)
+
+            await handle_message_async(sender_id, text, page_token)
+    finally:
+        reply_outbox.reset(token)
+
+
+async def shutdown_async_events(deadline):
+    """Stop accepting events and wait (until `deadline`) for the ones in flight"""
+    async_event_state["accepting"] = False
+    if async_event_tasks:
+        print(f"🛑 Draining {len(async_event_tasks)} async events", flush=True)
+        await asyncio.wait(list(async_event_tasks), timeout=max(0, deadline - time.time()))
+
+    for client in list(graph_async_clients.values()):
+        await client.aclose()
+    graph_async_clients.clear()
+
+
+def get_async_event_stats():
+    return {
+        "accepting": async_event_state["accepting"],
+        "pending": len(async_event_tasks),
+        "senders": len(async_sender_tails),
+        "max_pending": ASYNC_MAX_PENDING_EVENTS,
+        "max_concurrent": ASYNC_MAX_CONCURRENT_EVENTS,
+    }
 
-        conversations_sheet = sheet.worksheet("Conversations")
-        records = conversations_sheet.get_all_records()
 
-        for record in reversed(records):
-            if str(record.get("sender_id")) == str(sender_id):
-                ad_id = record.get("ad_id")
-                if ad_id:
-                    return ad_id
+async def asgi_app(scope, receive, send):
+    """ASGI entry point: webhook POSTs are handled on the loop, everything else goes to Flask"""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                deadline = time.time() + SHUTDOWN_TIMEOUT
+                await shutdown_async_events(deadline)
+                await asyncio.to_thread(shutdown_background_workers, deadline)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
 
-        return None
+    if scope["type"] != "http":
+        return
 
-    except Exception as e:
-        print(f"Error getting ad_id: {e}", flush=True)
-        return None
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
 
+    if scope["method"] == "POST" and scope["path"] == "/webhook":
+        try:
+            data = json.loads(body or b"null")
+        except ValueError:
+            data = None
+        print("Webhook payload:", data, flush=True)
+        # Dedup marks are SQLite writes, so validate and dedup off the loop;
+        # scheduling the events has to happen back on it
+        loop = asyncio.get_running_loop()
 
-def send_message(recipient_id, text, page_token):
-    """Send text message"""
-    if not page_token:
+        async def enqueue_on_loop(page_token, event):
+            return enqueue_event_async(page_token, event)
+
+        def enqueue(page_token, event):
+            return asyncio.run_coroutine_threadsafe(enqueue_on_loop(page_token, event), loop).result()
+
+        text, status = await asyncio.to_thread(dispatch_webhook_payload, data, enqueue)
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": text.encode()})
         return
 
-    url = f"https://graph.facebook.com/{GRAPH_API_VERSION}/me/messages"
-    params = {"access_token": page_token}
-    payload = {
-        "recipient": {"id": recipient_id},
-        "message": {"text": text},
+    status, headers, response_body = await asyncio.to_thread(call_flask, scope, body)
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": response_body})
+
+
+def call_flask(scope, body):
+    """Run one request through the Flask WSGI app (verification, health, /metrics)"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
     }
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value.decode("latin-1")
+        elif key != "CONTENT_LENGTH":
+            environ[f"HTTP_{key}"] = value.decode("latin-1")
+
+    response = {}
 
-    r = requests.post(url, params=params, json=payload)
-    print(f"Send message: {r.status_code}", flush=True)
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+        return lambda data: None
+
+    result = app(environ, start_response)
+    try:
+        response_body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], response_body
+
+
+def shutdown_background_workers(deadline=None):
+    """Drain queued events first, then deliver their replies, then flush the Sheets
+    rows they produced - all within one SHUTDOWN_TIMEOUT budget, so gunicorn's
+    graceful_timeout does not kill the worker halfway"""
+    deadline = deadline or time.time() + SHUTDOWN_TIMEOUT
+    shutdown_products_refresher()
+    shutdown_history_import()
+    shutdown_ad_attribution_backfill()
+    shutdown_event_workers(deadline)
+    shutdown_outbound_scheduler(deadline)
+    shutdown_sheet_writer(deadline)
+
+
+atexit.register(shutdown_background_workers)
 
 
 if __name__ == "__main__":
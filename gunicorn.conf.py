@@ -0,0 +1,20 @@
+import os
+import sys
+
+# Give the background workers time to finish queued messages and Sheets rows on shutdown.
+# app.py drains everything within one SHUTDOWN_TIMEOUT (default 25s); keep it below this.
+graceful_timeout = 30
+
+# ASYNC_MODE=1 serves the ASGI entry point on uvicorn workers, so one process
+# handles many conversations at once; unset keeps the sync Flask app
+if os.environ.get("ASYNC_MODE") == "1":
+    wsgi_app = "app:asgi_app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "app:app"
+
+
+def worker_exit(server, worker):
+    app_module = sys.modules.get("app")
+    if app_module is not None:
+        app_module.shutdown_background_workers()
@@ -0,0 +1,142 @@
+import os
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("BOT_DB_PATH", os.path.join(tempfile.mkdtemp(), "bot_data.sqlite3"))
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def executor():
+    executor = app.KeyedExecutor(4, 100, name="test-lane")
+    yield executor
+    executor.shutdown()
+
+
+def test_same_key_runs_in_order_one_at_a_time(executor):
+    seen = []
+    active = []
+
+    def job(n):
+        active.append(n)
+        assert len(active) == 1
+        time.sleep(0.01)
+        seen.append(n)
+        active.remove(n)
+
+    for n in range(10):
+        assert executor.submit("sender", job, n)
+
+    assert executor.join(5)
+    assert seen == list(range(10))
+
+
+def test_different_keys_run_in_parallel(executor):
+    # Each job waits for the other; they only both get through if they run at once
+    barrier = threading.Barrier(2, timeout=2)
+    passed = []
+
+    def job(key):
+        barrier.wait()
+        passed.append(key)
+
+    executor.submit("a", job, "a")
+    executor.submit("b", job, "b")
+
+    assert executor.join(5)
+    assert sorted(passed) == ["a", "b"]
+
+
+def test_full_executor_rejects():
+    executor = app.KeyedExecutor(1, 2, name="test-full")
+    release = threading.Event()
+    try:
+        assert executor.submit("a", lambda: release.wait() and None)
+        assert executor.submit("a", lambda: None)
+        assert not executor.submit("b", lambda: None)
+    finally:
+        release.set()
+        executor.join(5)
+        executor.shutdown()
+
+
+# =====================
+# Message coalescing
+# =====================
+
+def text_event(sender, text):
+    return {"sender": {"id": sender}, "message": {"mid": f"{sender}-{text}", "text": text}}
+
+
+@pytest.fixture
+def coalescing(monkeypatch):
+    """Small windows, no cross-process lock, and process_event replaced by a recorder"""
+    turns = []
+    monkeypatch.setattr(app, "SENDER_LOCK_DIR", None)
+    monkeypatch.setattr(app, "MESSAGE_COALESCE_WINDOW", 0.3)
+    monkeypatch.setattr(app, "MESSAGE_COALESCE_MAX_WAIT", 0.6)
+    monkeypatch.setattr(app, "send_sender_action", lambda *args: None)
+    monkeypatch.setattr(
+        app, "process_event",
+        lambda page_token, event, typing=True: turns.append((time.monotonic(), event["message"]["text"])),
+    )
+    return turns
+
+
+def test_burst_quiet_for_uses_the_window_and_the_max_wait(monkeypatch):
+    monkeypatch.setattr(app, "MESSAGE_COALESCE_WINDOW", 1.5)
+    monkeypatch.setattr(app, "MESSAGE_COALESCE_MAX_WAIT", 6)
+    burst = app.MessageBurst(text_event("u", "hi"))
+    now = time.time()
+
+    # Quiet for 1s of a 1.5s window
+    burst.first_at = burst.last_at = now - 1
+    assert app.burst_quiet_for(burst) == pytest.approx(0.5, abs=0.05)
+
+    # Still typing, but open for 5.8s of the 6s cap
+    burst.first_at, burst.last_at = now - 5.8, now
+    assert app.burst_quiet_for(burst) == pytest.approx(0.2, abs=0.05)
+
+    # Quiet for longer than the window
+    burst.first_at = burst.last_at = now - 2
+    assert app.burst_quiet_for(burst) <= 0
+
+
+def test_messages_inside_the_window_are_one_turn(coalescing):
+    start = time.monotonic()
+    for text in ["hi", "price?", "delivery?"]:
+        assert app.enqueue_event("T", text_event("burst-sender", text))
+        time.sleep(0.05)
+    last_sent = time.monotonic()
+
+    deadline = time.monotonic() + 5
+    while not coalescing and time.monotonic() < deadline:
+        time.sleep(0.02)
+    time.sleep(0.4)
+
+    assert [text for _, text in coalescing] == ["hi\nprice?\ndelivery?"]
+    assert coalescing[0][0] - last_sent >= 0.3 - app.TIMER_TICK
+    assert coalescing[0][0] - start < 0.6 + 0.3
+
+
+def test_a_chatty_sender_is_answered_at_max_wait(coalescing):
+    texts = [f"m{n}" for n in range(8)]
+    start = time.monotonic()
+    for text in texts:
+        assert app.enqueue_event("T", text_event("chatty-sender", text))
+        time.sleep(0.15)  # always inside the 0.3s window
+
+    deadline = time.monotonic() + 5
+    while "m7" not in "\n".join(text for _, text in coalescing) and time.monotonic() < deadline:
+        time.sleep(0.02)
+
+    assert len(coalescing) >= 2
+    # The first turn went out at the cap, before the sender's last message (at 1.05s)
+    assert 0.6 - app.TIMER_TICK <= coalescing[0][0] - start < 1.05
+    # Nothing lost or reordered across turns
+    assert "\n".join(text for _, text in coalescing).split("\n") == texts
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("BOT_DB_PATH", os.path.join(tempfile.mkdtemp(), "bot_data.sqlite3"))
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def executor():
+    executor = app.KeyedExecutor(4, 100, name="test-lane")
+    yield executor
+    executor.shutdown()
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = app.OutboundScheduler()
+    yield scheduler
+    scheduler.drain(time.time() + 5)
+    scheduler.executor.shutdown()
+
+
+def test_returned_delay_reruns_the_call_and_holds_the_lane(executor):
+    calls = []
+
+    def retry_once():
+        calls.append(("retry", time.monotonic()))
+        if len(calls) == 1:
+            return 0.2
+
+    executor.submit("sender", retry_once)
+    executor.submit("sender", lambda: calls.append(("next", time.monotonic())))
+
+    assert executor.join(5)
+    assert [name for name, _ in calls] == ["retry", "retry", "next"]
+    assert calls[1][1] - calls[0][1] >= 0.2 - app.TIMER_TICK
+
+
+def test_timer_wheel_runs_callbacks_in_due_order():
+    wheel = app.get_timer_wheel()
+    fired = []
+    done = threading.Event()
+    now = time.monotonic()
+
+    wheel.schedule(now + 0.2, lambda: (fired.append("late"), done.set()))
+    wheel.schedule(now + 0.1, lambda: fired.append("early"))
+    wheel.schedule(now + 0.1, lambda: fired.append("early-2"))
+
+    assert done.wait(2)
+    assert fired == ["early", "early-2", "late"]
+    assert time.monotonic() - now >= 0.2 - app.TIMER_TICK
+
+
+def test_delayed_send_is_not_overtaken_by_a_later_immediate_one(scheduler):
+    sent = []
+    scheduler.schedule(("P", "u"), 0.2, sent.append, "follow-up")
+    scheduler.schedule(("P", "u"), 0, sent.append, "reply")
+
+    assert scheduler.drain(time.time() + 5)
+    assert sent == ["follow-up", "reply"]
+
+
+def test_delayed_sends_keep_their_order_whatever_the_delays(scheduler):
+    sent = []
+    scheduler.schedule(("P", "u"), 0.3, sent.append, "first")
+    scheduler.schedule(("P", "u"), 0.1, sent.append, "second")
+
+    assert scheduler.drain(time.time() + 5)
+    assert sent == ["first", "second"]
+
+
+def test_other_recipients_do_not_wait_for_a_delayed_send(scheduler):
+    sent = []
+    scheduler.schedule(("P", "u"), 0.3, sent.append, "u: follow-up")
+    scheduler.schedule(("P", "v"), 0, sent.append, "v: reply")
+
+    assert scheduler.drain(time.time() + 5)
+    assert sent == ["v: reply", "u: follow-up"]
+
+
+def test_drain_gives_up_at_the_deadline(scheduler):
+    sent = []
+    scheduler.schedule(("P", "u"), 0.5, sent.append, "late")
+
+    assert not scheduler.drain(time.time() + 0.1)
+    assert sent == []
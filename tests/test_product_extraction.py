@@ -0,0 +1,82 @@
+import os
+import tempfile
+import threading
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("BOT_DB_PATH", os.path.join(tempfile.mkdtemp(), "bot_data.sqlite3"))
+
+import pytest
+
+import app
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    return app.Catalog([
+        {
+            "ad_id": 1,
+            "product_1_name": "4 Tier Rack",
+            "product_1_price": "Rs.4,500",
+            "product_2_name": "3 Tier Cloth Rack",
+            "product_2_price": "Rs.3,900",
+        },
+        {
+            "ad_id": 2,
+            "product_1_name": "Triangle Shoe Rack",
+            "product_1_price": "Rs.2,750",
+            "product_2_name": "Foldable Storage Rack",
+            "product_2_price": "Rs.5,200",
+        },
+    ])
+
+
+@pytest.mark.parametrize("text", [
+    "call me back",
+    "black color thiyanawada",
+    "photos show karanna",
+    "close karanna",
+    "store eka kohada",
+    "track number",
+    "Colombo 3",
+    "0771234567",
+])
+def test_ordinary_messages_do_not_name_a_product(catalog, text):
+    assert catalog.extract_product(text) is None
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("racks thiyanawada", "rack"),
+    ("4 tier rack price kiyada", "4 tier rack"),
+    ("shoe rack photos", "triangle shoe rack"),
+    ("cloth rack eka", "3 tier cloth rack"),
+    ("raka thiyanawada", "rack"),
+])
+def test_product_mentions_are_extracted(catalog, text, expected):
+    assert catalog.extract_product(text) == expected
+
+
+def test_search_still_tolerates_typos(catalog):
+    assert [p.name for p in catalog.search("triangel shoe rak", limit=1)] == ["Triangle Shoe Rack"]
+
+
+def test_lookup_cache_survives_concurrent_clears(catalog):
+    # Enough distinct texts to make every thread keep clearing the shared cache
+    texts = [f"rack {n}" for n in range(2000)] + ["racks thiyanawada", "call me back"] * 500
+    errors = []
+
+    def worker():
+        try:
+            for text in texts:
+                catalog.extract_product(text)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert catalog.extract_product("racks thiyanawada") == "rack"
+    assert catalog.extract_product("call me back") is None